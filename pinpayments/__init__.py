@@ -3,3 +3,5 @@ from __future__ import absolute_import, unicode_literals
 import logging
 
 logger = logging.getLogger(__name__)
+
+default_app_config = 'pinpayments.apps.PinPaymentsConfig'
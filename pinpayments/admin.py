@@ -1,13 +1,222 @@
 """ Administrative access to Pin data """
-from django.contrib import admin
+import re
+from datetime import datetime
+
+from django.conf import settings
+from django.conf.urls import url
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.admin.utils import get_fields_from_path
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import InvalidPage, Paginator
+from django.db.models import Q
+from django.forms.models import BaseInlineFormSet
+from django.http import HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
+from pinpayments import dashboard, jobs
+from pinpayments.exports import get_default_fields, get_field_names, iter_export
 from pinpayments.models import (
     PinRecipient, PinTransfer, PinTransaction, CustomerToken
-, CardToken)
+, BackgroundJob, BalanceSnapshot, CardToken, PinEvent, Plan, Subscription)
+from pinpayments.utils import estimate_count, get_exponent
+
+
+# Prefixes of the tokens Pin issues: charges, customers, cards, recipients,
+# transfers, bank accounts, refunds, events, plans and subscriptions
+TOKEN_PATTERN = re.compile(r'^(ch|cus|card|rp|tfer|ba|rf|evt|plan|sub)_[A-Za-z0-9_-]+$')
+
+
+def format_value(value, currency):
+    """ Formats a value with the number of decimal places its currency has """
+    return "{0:.{1}f} {2}".format(value, get_exponent(currency), currency)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that counts an unfiltered changelist from the database's
+    estimate of the table size, rather than COUNT(*), when the estimate
+    is above PIN_ADMIN_ESTIMATE_COUNT_ABOVE rows (default 100000).
+    The last pages may then be empty or missing.
+    """
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is not None and estimate > getattr(settings, 'PIN_ADMIN_ESTIMATE_COUNT_ABOVE', 100000):
+            return estimate
+        return super(EstimatedCountPaginator, self).count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Base for the admins of tables that grow large: no full result counts,
+    estimated counts, deferred heavy columns, and searches that can use
+    indexes. Search terms that look like Pin tokens are only matched
+    exactly against token_search_fields. Other terms are matched against
+    the '=' search_fields with case-sensitive exact lookups, as typed and
+    lowercased, rather than the case-insensitive ones the admin uses,
+    which most databases can't answer from a plain index. Search fields
+    without '=' fall back to the admin's search, which scans the table.
+    """
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+    deferred_fields = ()
+    token_search_fields = ()
+
+    def get_queryset(self, request):
+        queryset = super(LargeTableAdmin, self).get_queryset(request)
+        if self.deferred_fields:
+            queryset = queryset.defer(*self.deferred_fields)
+        return queryset
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if self.token_search_fields and TOKEN_PATTERN.match(term):
+            match = Q()
+            for field in self.token_search_fields:
+                match |= Q(**{field: term})
+            return queryset.filter(match), False
+
+        search_fields = self.get_search_fields(request)
+        if term and search_fields and all(name.startswith('=') for name in search_fields):
+            match = Q()
+            for name in search_fields:
+                field = get_fields_from_path(self.model, name[1:])[-1]
+                for value in set([term, term.lower()]):
+                    try:
+                        # terms that can't be stored in the field can't match, and may not even be queried
+                        field.run_validators(field.to_python(value))
+                    except ValidationError:
+                        continue
+                    match |= Q(**{name[1:]: value})
+            return queryset.filter(match) if match else queryset.none(), False
+        return super(LargeTableAdmin, self).get_search_results(request, queryset, search_term)
+
+
+class ExportAdminMixin(object):
+    """
+    Admin actions exporting the selected rows as CSV or JSON lines, after
+    asking which columns to export. The export is streamed from the
+    database, so it can cover any number of rows. Only the model's own
+    columns and those in export_related_fields can be exported.
+    """
+    actions = ['export_csv', 'export_jsonl']
+    export_related_fields = ()
+
+    def export_csv(self, request, queryset):
+        return self.export(request, queryset, 'csv')
+    export_csv.short_description = _('Export selected %(verbose_name_plural)s as CSV')
+
+    def export_jsonl(self, request, queryset):
+        return self.export(request, queryset, 'jsonl')
+    export_jsonl.short_description = _('Export selected %(verbose_name_plural)s as JSON lines')
+
+    def get_export_field_names(self):
+        """ Returns the columns staff may export """
+        return get_field_names(self.model) + list(self.export_related_fields)
+
+    def export(self, request, queryset, export_format):
+        opts = self.model._meta
+        fields = request.POST.getlist('export_fields')
+        allowed = self.get_export_field_names()
+        if request.POST.get('export') and fields:
+            for name in fields:
+                if name not in allowed:
+                    self.message_user(request, _('Unknown field {0}').format(name), messages.ERROR)
+                    return None
+            response = StreamingHttpResponse(
+                iter_export(queryset, fields, export_format),
+                content_type='text/csv' if export_format == 'csv' else 'application/x-ndjson'
+            )
+            response['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(
+                opts.model_name, export_format
+            )
+            return response
+
+        selected = fields or get_default_fields(self.model)
+        return TemplateResponse(request, 'pinpayments/admin/export.html', dict(
+            self.admin_site.each_context(request),
+            title=_('Export'),
+            opts=opts,
+            export_format=export_format,
+            fields=[(name, name in selected) for name in allowed],
+            selected=request.POST.getlist(ACTION_CHECKBOX_NAME),
+            select_across=request.POST.get('select_across', '0'),
+            action_checkbox_name=ACTION_CHECKBOX_NAME,
+            action='export_{0}'.format(export_format),
+        ))
+
+
+class BackgroundActionsMixin(object):
+    """
+    Adds the pinpayments.jobs actions named in background_actions as admin
+    actions. These queue the selected objects (up to PIN_JOB_MAX_OBJECTS,
+    default 10000) to be processed in the background, and redirect to a
+    page showing the job's progress.
+    """
+    background_actions = ()
+
+    def get_actions(self, request):
+        actions = super(BackgroundActionsMixin, self).get_actions(request)
+        for name in self.background_actions:
+            description = jobs.JOB_ACTIONS[name][0]
+            actions[name] = (self._background_action(name), name, description)
+        return actions
+
+    def _background_action(self, name):
+        def action(modeladmin, request, queryset):
+            limit = getattr(settings, 'PIN_JOB_MAX_OBJECTS', 10000)
+            object_ids = list(queryset.order_by().values_list('pk', flat=True)[:limit + 1])
+            if len(object_ids) > limit:
+                modeladmin.message_user(request, _('Select at most {0} objects.').format(limit))
+                return None
+            job = jobs.start_job(name, object_ids)
+            return HttpResponseRedirect(reverse('admin:pinpayments_backgroundjob_progress', args=[job.pk]))
+        return action
 
 
-class PinTransactionAdmin(admin.ModelAdmin):
+class PaginatedInlineFormSet(BaseInlineFormSet):
+    """ Inline formset showing one page of the related objects """
+    per_page = 20
+    page_number = 1
+
+    def get_queryset(self):
+        if not hasattr(self, 'page'):
+            paginator = Paginator(super(PaginatedInlineFormSet, self).get_queryset(), self.per_page)
+            try:
+                self.page = paginator.page(self.page_number)
+            except InvalidPage:
+                self.page = paginator.page(1)
+        return self.page.object_list
+
+
+class PaginatedTabularInline(admin.TabularInline):
+    """
+    Read-only tabular inline for relations that can have many objects,
+    showing per_page of them at a time, with links to the other pages
+    """
+    formset = PaginatedInlineFormSet
+    template = 'pinpayments/admin/paginated_tabular.html'
+    per_page = 20
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super(PaginatedTabularInline, self).get_formset(request, obj, **kwargs)
+        formset.per_page = self.per_page
+        formset.page_number = request.GET.get('{0}-page'.format(formset.get_default_prefix()), 1)
+        return formset
+
+
+class PinTransactionAdmin(ExportAdminMixin, BackgroundActionsMixin, LargeTableAdmin):
     """ Inspect transactions from here """
     list_display = (
         'date',
@@ -20,15 +229,24 @@ class PinTransactionAdmin(admin.ModelAdmin):
         'pin_response',
         'ip_address',
         'transaction_token',
+        'customer_token',
     )
+    list_select_related = ('customer_token',)
     search_fields = (
-        'email_address',
-        'ip_address',
-        'card_token',
+        '=email_address',
+        '=ip_address',
+    )
+    token_search_fields = (
         'transaction_token',
+        'card_token',
+        'customer_token__token',
     )
+    background_actions = ('resync_transactions', 'reprocess_transactions')
+    export_related_fields = ('customer_token__token',)
+    deferred_fields = ('pin_response_text',)
     list_filter = ('processed', 'succeeded', 'environment', 'currency')
     date_hierarchy = 'date'
+    raw_id_fields = ('customer_token', 'subscription')
     readonly_fields = (
         'date',
         'description',
@@ -56,8 +274,34 @@ class PinTransactionAdmin(admin.ModelAdmin):
         'pin_response_text',
     )
 
+    def get_urls(self):
+        info = (self.model._meta.app_label, self.model._meta.model_name)
+        return [
+            url(r'^dashboard/$', self.admin_site.admin_view(self.dashboard_view),
+                name='{0}_{1}_dashboard'.format(*info)),
+        ] + super(PinTransactionAdmin, self).get_urls()
+
+    def dashboard_view(self, request):
+        """ Payment KPIs, served from the cache and refreshed in the background """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        widgets = {}
+        for name, title, entry in dashboard.get_dashboard():
+            widgets[name] = dict(
+                title=title,
+                value=entry['value'],
+                computed=datetime.fromtimestamp(entry['computed'], timezone.utc),
+            )
+        return TemplateResponse(request, 'pinpayments/admin/dashboard.html', dict(
+            self.admin_site.each_context(request),
+            title=_('Payments dashboard'),
+            opts=self.model._meta,
+            days=getattr(settings, 'PIN_DASHBOARD_DAYS', 30),
+            widgets=widgets,
+        ))
 
-class PinTransactionInline(admin.TabularInline):
+
+class PinTransactionInline(PaginatedTabularInline):
     """
     Used to show transactions for a particular customer token, if using
     the Customer API.
@@ -74,14 +318,27 @@ class PinTransactionInline(admin.TabularInline):
         'ip_address',
     )
     readonly_fields = fields
-    extra = 0
-    can_delete = False
 
-    def has_add_permission(self, request):
-        return False
+    def get_queryset(self, request):
+        return super(PinTransactionInline, self).get_queryset(request).defer('pin_response_text')
+
+
+class CardTokenInline(PaginatedTabularInline):
+    """ Shows the cards of a customer token """
+    model = CardToken
+    fields = (
+        'token',
+        'scheme',
+        'display_number',
+        'expiry_month',
+        'expiry_year',
+        'primary',
+        'created',
+    )
+    readonly_fields = fields
 
 
-class CustomerTokenAdmin(admin.ModelAdmin):
+class CustomerTokenAdmin(BackgroundActionsMixin, LargeTableAdmin):
     """ Shows customer tokens """
     list_display = (
         'user',
@@ -90,25 +347,62 @@ class CustomerTokenAdmin(admin.ModelAdmin):
         'created',
         'active',
     )
-    search_fields = ('token', )
+    list_select_related = ('user',)
+    search_fields = ('^token', )
+    token_search_fields = ('token',)
+    background_actions = ('refresh_customers',)
     list_filter = ('environment', 'active')
     date_hierarchy = 'created'
+    raw_id_fields = ('user',)
+    readonly_fields = ('environment', 'token')
+    inlines = (CardTokenInline, PinTransactionInline)
+
+
+class CardTokenAdmin(LargeTableAdmin):
+    """ Shows card tokens """
+    list_display = (
+        'token',
+        'customer',
+        'scheme',
+        'display_number',
+        'expiry_month',
+        'expiry_year',
+        'primary',
+        'environment',
+        'created',
+    )
+    list_select_related = ('customer',)
+    search_fields = ('=token', '=customer__token')
+    token_search_fields = ('token', 'customer__token')
+    list_filter = ('environment', 'scheme', 'primary')
+    date_hierarchy = 'created'
+    raw_id_fields = ('customer',)
     readonly_fields = ('environment', 'token')
 
 
-class PinTransferAdmin(admin.ModelAdmin):
+class PinTransferAdmin(ExportAdminMixin, BackgroundActionsMixin, LargeTableAdmin):
     """ Shows the details of a transfer """
     list_display = (
         'created',
         'get_value',
         'recipient',
         'status',
+        'environment',
     )
+    list_select_related = ('recipient',)
     search_fields = (
-        'recipient',
+        '=recipient__email',
+        '=batch_reference',
+    )
+    token_search_fields = (
         'transfer_token',
+        'recipient__token',
     )
+    background_actions = ('refresh_transfers',)
+    export_related_fields = ('recipient__token',)
+    deferred_fields = ('pin_response_text',)
     date_hierarchy = 'created'
+    raw_id_fields = ('recipient',)
     readonly_fields = (
         'transfer_token',
         'status',
@@ -117,19 +411,23 @@ class PinTransferAdmin(admin.ModelAdmin):
         'amount',
         'recipient',
         'created',
+        'environment',
         'pin_response_text',
     )
 
     def has_add_permission(self, request):
         return False
 
+    def get_queryset(self, request):
+        return super(PinTransferAdmin, self).get_queryset(request).with_display_value()
+
     def get_value(self, obj):
-        return "{0:.2f} {1}".format(obj.value, obj.currency)
+        return format_value(obj.display_value, obj.currency)
     get_value.short_description = _('Value')
-    get_value.admin_order_field = 'amount'
+    get_value.admin_order_field = 'display_value'
 
 
-class PinTransferInline(admin.TabularInline):
+class PinTransferInline(PaginatedTabularInline):
     """ Shows transfers under recipients """
     model = PinTransfer
     fields = [
@@ -141,18 +439,16 @@ class PinTransferInline(admin.TabularInline):
         'transfer_token',
     ]
     readonly_fields = fields
-    extra = 0
-    can_delete = False
 
-    def has_add_permission(self, request):
-        return False
+    def get_queryset(self, request):
+        return super(PinTransferInline, self).get_queryset(request).defer('pin_response_text')
 
     def get_value(self, obj):
-        return "{0:.2f} {1}".format(obj.value, obj.currency)
+        return format_value(obj.value, obj.currency)
     get_value.short_description = _('Value')
 
 
-class PinRecipientAdmin(admin.ModelAdmin):
+class PinRecipientAdmin(LargeTableAdmin):
     """ Allows viewing and re-aliasing PinRecipients """
     list_display = (
         'token',
@@ -162,15 +458,136 @@ class PinRecipientAdmin(admin.ModelAdmin):
         'created',
         'bank_account',
     )
-    search_fields = ('token', 'email', 'name')
+    list_select_related = ('bank_account',)
+    search_fields = ('=email', '=name')
+    token_search_fields = ('token', 'bank_account__token')
     list_filter = ('environment',)
     date_hierarchy = 'created'
     inlines = (PinTransferInline,)
+    raw_id_fields = ('bank_account',)
     readonly_fields = list_display  # all the fields
 
 
+class PlanAdmin(admin.ModelAdmin):
+    """ Manage recurring billing plans """
+    list_display = (
+        'name',
+        'amount',
+        'currency',
+        'interval',
+        'interval_count',
+        'active',
+    )
+    search_fields = ('name',)
+    list_filter = ('active', 'interval', 'currency')
+
+
+class SubscriptionAdmin(admin.ModelAdmin):
+    """ Shows customers' subscriptions to plans """
+    list_display = (
+        'customer_token',
+        'plan',
+        'status',
+        'next_billing_date',
+        'retry_at',
+        'failed_attempts',
+    )
+    list_select_related = ('customer_token', 'plan')
+    list_filter = ('status', 'plan')
+    date_hierarchy = 'next_billing_date'
+    raw_id_fields = ('customer_token',)
+    readonly_fields = ('failed_attempts', 'lease_owner', 'lease_expires', 'created')
+
+
+class BalanceSnapshotAdmin(LargeTableAdmin):
+    """ Shows recorded account balances """
+    list_display = (
+        'recorded',
+        'environment',
+        'currency',
+        'available',
+        'pending',
+    )
+    list_filter = ('environment', 'currency')
+    date_hierarchy = 'recorded'
+    readonly_fields = list_display
+
+
+class PinEventAdmin(LargeTableAdmin):
+    """ Shows the events received from Pin, and whether they were applied """
+    list_display = (
+        'received',
+        'environment',
+        'event_type',
+        'token',
+        'processed',
+    )
+    list_filter = ('environment', 'event_type')
+    token_search_fields = ('token',)
+    deferred_fields = ('payload',)
+    date_hierarchy = 'received'
+    readonly_fields = list_display + ('created_at', 'payload', 'error')
+
+    def has_add_permission(self, request):
+        return False
+
+
+class BackgroundJobAdmin(admin.ModelAdmin):
+    """ Shows background jobs started from admin actions, and their progress """
+    list_display = (
+        'created',
+        'action',
+        'status',
+        'total',
+        'succeeded',
+        'failed',
+        'finished',
+    )
+    list_filter = ('status', 'action')
+    readonly_fields = list_display + ('errors',)
+    exclude = ('object_ids',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        info = (self.model._meta.app_label, self.model._meta.model_name)
+        return [
+            url(r'^(\d+)/progress/$', self.admin_site.admin_view(self.progress_view),
+                name='{0}_{1}_progress'.format(*info)),
+            url(r'^(\d+)/status/$', self.admin_site.admin_view(self.status_view),
+                name='{0}_{1}_status'.format(*info)),
+        ] + super(BackgroundJobAdmin, self).get_urls()
+
+    def progress_view(self, request, job_id):
+        job = get_object_or_404(BackgroundJob, pk=job_id)
+        return TemplateResponse(request, 'pinpayments/admin/job_progress.html', dict(
+            self.admin_site.each_context(request),
+            title=_('Background job progress'),
+            opts=self.model._meta,
+            job=job,
+            status_url=reverse('admin:pinpayments_backgroundjob_status', args=[job.pk]),
+        ))
+
+    def status_view(self, request, job_id):
+        job = get_object_or_404(BackgroundJob, pk=job_id)
+        return JsonResponse({
+            'status': job.status,
+            'total': job.total,
+            'processed': job.processed,
+            'succeeded': job.succeeded,
+            'failed': job.failed,
+            'errors': job.errors.splitlines(),
+        })
+
+
 admin.site.register(PinRecipient, PinRecipientAdmin)
 admin.site.register(PinTransaction, PinTransactionAdmin)
 admin.site.register(CustomerToken, CustomerTokenAdmin)
-admin.site.register(CardToken)
+admin.site.register(CardToken, CardTokenAdmin)
 admin.site.register(PinTransfer, PinTransferAdmin)
+admin.site.register(Plan, PlanAdmin)
+admin.site.register(Subscription, SubscriptionAdmin)
+admin.site.register(BalanceSnapshot, BalanceSnapshotAdmin)
+admin.site.register(PinEvent, PinEventAdmin)
+admin.site.register(BackgroundJob, BackgroundJobAdmin)
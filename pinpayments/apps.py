@@ -0,0 +1,29 @@
+"""
+Application configuration
+"""
+from __future__ import unicode_literals
+
+import os
+
+from django.apps import AppConfig
+from django.conf import settings
+from django.utils.translation import ugettext_lazy as _
+
+
+class PinPaymentsConfig(AppConfig):
+    """
+    Registers the checks of the Pin settings, see pinpayments.checks, and
+    with PIN_HTTP_WARMUP opens connections to Pin in the background when
+    the app starts and whenever the process forks, eg a gunicorn worker
+    """
+    name = 'pinpayments'
+    verbose_name = _('Pin Payments')
+
+    def ready(self):
+        from pinpayments import checks  # noqa: registers the checks
+
+        if getattr(settings, 'PIN_HTTP_WARMUP', False):
+            from pinpayments.objects import warmup_in_background
+            warmup_in_background()
+            if hasattr(os, 'register_at_fork'):  # Python 3.7+
+                os.register_at_fork(after_in_child=warmup_in_background)
@@ -0,0 +1,235 @@
+"""
+Recurring billing of Subscriptions
+"""
+from __future__ import unicode_literals
+
+import os
+import socket
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from pinpayments import logger
+from pinpayments.models import PinTransaction, Subscription
+from pinpayments.utils import concurrent_map
+
+DEFAULT_DUNNING_SCHEDULE = (1, 3, 5, 7)
+
+
+class BillingScheduler(object):
+    """
+    Charges due subscriptions.
+
+    Several schedulers can run at once, on one or many hosts. Each claims a
+    batch of due subscriptions by taking a lease on them with a single
+    conditional UPDATE, so no subscription is billed by two schedulers.
+    A lease that is not released (say the process was killed) expires after
+    lease_seconds, and the subscription is picked up by another scheduler.
+
+    Each attempt at billing a period gets one PinTransaction, keyed by the
+    subscription, billing_period and billing_attempt, so a scheduler picking
+    up an expired lease finds the attempt made before it. An unprocessed
+    transaction is charged, a processed one is settled without charging
+    again, and one that was sent to Pin without an answer (so may or may
+    not have been charged) is left leased until someone resyncs or fixes it.
+    """
+    def __init__(self, batch_size=100, max_workers=4, lease_seconds=600,
+                 dunning_schedule=None, worker_id=None):
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.lease_seconds = lease_seconds
+        if dunning_schedule is None:
+            dunning_schedule = getattr(settings, 'PIN_DUNNING_SCHEDULE', DEFAULT_DUNNING_SCHEDULE)
+        self.dunning_schedule = tuple(dunning_schedule)
+        self.worker_id = worker_id or "{0}:{1}:{2}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+        )
+
+    def run(self, now=None):
+        """
+        Bills every subscription that is due, a batch at a time.
+        Returns a tuple of the number of succeeded and failed charges.
+        """
+        succeeded = failed = 0
+        while True:
+            subscriptions = self.claim(now)
+            if not subscriptions:
+                return (succeeded, failed)
+            for subscription, transaction in self.bill(subscriptions):
+                if transaction.succeeded:
+                    succeeded += 1
+                else:
+                    failed += 1
+
+    def claim(self, now=None):
+        """
+        Leases up to batch_size due subscriptions to this scheduler and
+        returns them.
+        """
+        if now is None:
+            now = timezone.now()
+        available = Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)
+        candidates = list(
+            Subscription.objects.due(now).filter(available).order_by(
+                'next_billing_date'
+            ).values_list('pk', flat=True)[:self.batch_size]
+        )
+        if not candidates:
+            return []
+
+        expires = now + timedelta(seconds=self.lease_seconds)
+        Subscription.objects.due(now).filter(pk__in=candidates).filter(available).update(
+            lease_owner=self.worker_id, lease_expires=expires,
+        )
+        return list(Subscription.objects.filter(
+            pk__in=candidates, lease_owner=self.worker_id, lease_expires=expires,
+        ).select_related('plan', 'customer_token'))
+
+    def bill(self, subscriptions):
+        """
+        Charges the given (claimed) subscriptions concurrently, and yields
+        (subscription, transaction) pairs as the charges complete.
+        """
+        transactions = self.create_transactions(subscriptions)
+        pending = []
+        for transaction in transactions:
+            if not transaction.processed:
+                pending.append(transaction)
+            elif self.is_uncertain(transaction):
+                self.hold(transaction)
+            else:
+                # charged by an earlier run that didn't get to settle it
+                self.settle(transaction.subscription, transaction)
+                yield (transaction.subscription, transaction)
+
+        for transaction, charged, error in concurrent_map(
+            self.charge, pending, self.max_workers
+        ):
+            if error is not None:
+                logger.error("Billing transaction {0} failed: {1}".format(transaction.pk, error))
+            elif not charged:
+                logger.warning("Billing transaction {0} was charged by another scheduler".format(transaction.pk))
+                continue
+            if self.is_uncertain(transaction):
+                self.hold(transaction)
+                continue
+            subscription = transaction.subscription
+            self.settle(subscription, transaction)
+            yield (subscription, transaction)
+
+    def create_transactions(self, subscriptions):
+        """
+        Returns the PinTransaction of the current billing attempt of each
+        subscription, processed or not, creating them in bulk where an
+        earlier run has not already done so.
+        """
+        transactions = self.current_transactions(subscriptions)
+        now = timezone.now()
+        PinTransaction.objects.bulk_create([
+            PinTransaction(
+                subscription=subscription,
+                billing_period=subscription.next_billing_date,
+                billing_attempt=subscription.failed_attempts + 1,
+                customer_token=subscription.customer_token,
+                environment=subscription.customer_token.environment,
+                date=now,
+                amount=subscription.plan.amount,
+                currency=subscription.plan.currency,
+                description=subscription.plan.description or subscription.plan.name,
+                email_address=subscription.email_address,
+                ip_address=subscription.ip_address,
+            )
+            for subscription in subscriptions if subscription.pk not in transactions
+        ], batch_size=self.batch_size)
+        return list(self.current_transactions(subscriptions).values())
+
+    def current_transactions(self, subscriptions):
+        """
+        Returns a dict of the PinTransaction of the current billing attempt
+        of each subscription that has one, by subscription pk.
+        """
+        by_pk = dict((subscription.pk, subscription) for subscription in subscriptions)
+        transactions = {}
+        for transaction in PinTransaction.objects.filter(
+            subscription__in=subscriptions,
+            billing_period__in=set(subscription.next_billing_date for subscription in subscriptions),
+        ).select_related('customer_token'):
+            subscription = by_pk[transaction.subscription_id]
+            if (transaction.billing_period == subscription.next_billing_date and
+                    transaction.billing_attempt == subscription.failed_attempts + 1):
+                transaction.subscription = subscription
+                transactions[subscription.pk] = transaction
+        return transactions
+
+    def is_uncertain(self, transaction):
+        """
+        Whether the transaction was sent to Pin but no answer was recorded,
+        so it may or may not have been charged.
+        """
+        return transaction.processed and not transaction.succeeded and not transaction.pin_response
+
+    def hold(self, transaction):
+        """
+        Leaves the subscription of an uncertain transaction leased, rather
+        than charging it again. It is looked at again once the lease expires.
+        """
+        logger.error(
+            "Billing transaction {0} of subscription {1} was sent to Pin but its outcome "
+            "is unknown, not charging again. Resync or fix it to settle the subscription.".format(
+                transaction.pk, transaction.subscription_id
+            )
+        )
+
+    def charge(self, transaction):
+        """
+        Sends the transaction to Pin, unless another scheduler has claimed
+        it first. Returns whether it was sent.
+        """
+        # the conditional UPDATE keeps overlapping runs from both charging it
+        unprocessed = PinTransaction.objects.filter(pk=transaction.pk, processed=False)
+        if not unprocessed.update(processed=True):
+            return False
+        try:
+            transaction.process_transaction()
+        except Exception:
+            if not transaction.processed:
+                # stopped by a pre_charge receiver before it was sent
+                PinTransaction.objects.filter(pk=transaction.pk).update(processed=False)
+            raise
+        return True
+
+    def settle(self, subscription, transaction):
+        """
+        Moves the subscription on to its next billing period after a
+        successful charge, or schedules a retry after a failed one, and
+        releases the lease.
+        """
+        now = timezone.now()
+        if transaction.succeeded:
+            subscription.status = 'active'
+            next_billing_date = subscription.plan.next_billing_date(subscription.next_billing_date)
+            while next_billing_date <= now:
+                # Never charge for several missed periods in one go
+                logger.warning("Subscription {0} skipped the billing period starting {1}".format(
+                    subscription.pk, next_billing_date
+                ))
+                next_billing_date = subscription.plan.next_billing_date(next_billing_date)
+            subscription.next_billing_date = next_billing_date
+            subscription.failed_attempts = 0
+            subscription.retry_at = None
+        else:
+            subscription.failed_attempts += 1
+            if subscription.failed_attempts > len(self.dunning_schedule):
+                subscription.status = 'unpaid'
+                subscription.retry_at = None
+            else:
+                subscription.status = 'past_due'
+                subscription.retry_at = now + timedelta(
+                    days=self.dunning_schedule[subscription.failed_attempts - 1]
+                )
+        subscription.lease_owner = ''
+        subscription.lease_expires = None
+        subscription.save()
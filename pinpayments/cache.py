@@ -0,0 +1,121 @@
+"""
+Read-through cache resolving Pin tokens to model instances
+
+Instances are looked up in a small in-process LRU first, then in the Django
+cache named by PIN_TOKEN_CACHE_ALIAS, and finally in the database.
+Saving or deleting an instance through the models or their managers
+invalidates both tiers in the current process, once the change is
+committed. Other processes only drop
+their local copy once PIN_TOKEN_CACHE_LOCAL_TIMEOUT has passed, so keep that
+short (or 0 to disable the local tier) if instances must never be stale.
+
+PinEnvironment.get_balances() keeps balances in the same Django cache, for
+PIN_BALANCE_CACHE_TIMEOUT seconds (default 10).
+
+Settings:
+    PIN_TOKEN_CACHE_ALIAS - Django cache to use, default 'default'
+    PIN_TOKEN_CACHE_TIMEOUT - seconds entries stay in the Django cache, default 300
+    PIN_TOKEN_CACHE_LOCAL_TIMEOUT - seconds entries stay in the local tier, default 5
+    PIN_TOKEN_CACHE_LOCAL_SIZE - number of entries kept in the local tier, default 1000
+"""
+from __future__ import unicode_literals
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+class LocalCache(object):
+    """ A thread-safe LRU of pickled values that expire after a timeout """
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, timeout, size):
+        if timeout <= 0 or size <= 0:
+            return
+        entry = (time.time() + timeout, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_cache = LocalCache()
+
+
+def get_shared_cache():
+    return caches[getattr(settings, 'PIN_TOKEN_CACHE_ALIAS', 'default')]
+
+
+def cache_key(model, token):
+    return 'pinpayments:{0}.{1}:{2}'.format(model._meta.app_label, model._meta.model_name, token)
+
+
+def get_cached(manager, token):
+    """
+    Returns the instance of manager's model with the given token, raising
+    DoesNotExist like manager.get() would when there isn't one
+    """
+    key = cache_key(manager.model, token)
+    instance = local_cache.get(key)
+    if instance is not None:
+        return instance
+
+    shared_cache = get_shared_cache()
+    instance = shared_cache.get(key)
+    if instance is None:
+        instance = manager.get(token=token)
+        shared_cache.set(key, instance, getattr(settings, 'PIN_TOKEN_CACHE_TIMEOUT', 300))
+
+    local_cache.set(
+        key, instance,
+        getattr(settings, 'PIN_TOKEN_CACHE_LOCAL_TIMEOUT', 5),
+        getattr(settings, 'PIN_TOKEN_CACHE_LOCAL_SIZE', 1000),
+    )
+    return instance
+
+
+def invalidate(model, *tokens):
+    """ Removes the instances of model with the given tokens from the cache """
+    keys = [cache_key(model, token) for token in tokens if token]
+    if keys:
+        local_cache.delete_many(keys)
+        get_shared_cache().delete_many(keys)
+
+
+def invalidate_on_commit(model, *tokens, using=None):
+    """
+    Removes the instances of model with the given tokens from the cache
+    once the current transaction on database using commits, straight away
+    outside of one. Invalidating earlier would let a concurrent reader
+    cache the rows as they were before the commit.
+    """
+    if any(tokens):
+        transaction.on_commit(lambda: invalidate(model, *tokens), using=using)
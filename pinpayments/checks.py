@@ -0,0 +1,60 @@
+"""
+System checks of the Pin settings, run by manage.py check and before
+commands like runserver and migrate
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.checks import Error, register
+
+from pinpayments.signals import DISPATCH_MODES
+
+REQUIRED_KEYS = ('key', 'secret', 'host')
+
+
+@register()
+def check_settings(app_configs, **kwargs):
+    """ Checks PIN_ENVIRONMENTS, PIN_DEFAULT_ENVIRONMENT and PIN_SIGNAL_DISPATCH """
+    errors = []
+    environments = getattr(settings, 'PIN_ENVIRONMENTS', {})
+    if not environments:
+        errors.append(Error(
+            "PIN_ENVIRONMENTS is not defined.",
+            hint="Define at least one environment, with its 'key', 'secret' and 'host'.",
+            id='pinpayments.E001',
+        ))
+        return errors
+
+    for name, environment in sorted(environments.items()):
+        if not isinstance(environment, dict):
+            errors.append(Error(
+                "PIN_ENVIRONMENTS['{0}'] is not a dictionary.".format(name),
+                id='pinpayments.E002',
+            ))
+            continue
+        missing = [key for key in REQUIRED_KEYS if not environment.get(key)]
+        if missing:
+            errors.append(Error(
+                "PIN_ENVIRONMENTS['{0}'] is missing {1}.".format(name, ", ".join(missing)),
+                hint="Each environment needs a 'key', 'secret' and 'host'.",
+                id='pinpayments.E003',
+            ))
+
+    default = getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
+    if default not in environments:
+        errors.append(Error(
+            "PIN_DEFAULT_ENVIRONMENT '{0}' is not one of PIN_ENVIRONMENTS.".format(default),
+            hint="Set PIN_DEFAULT_ENVIRONMENT, which defaults to 'test', to one of {0}.".format(
+                ", ".join(sorted(environments))
+            ),
+            id='pinpayments.E004',
+        ))
+
+    dispatch = getattr(settings, 'PIN_SIGNAL_DISPATCH', 'sync')
+    if dispatch not in DISPATCH_MODES:
+        errors.append(Error(
+            "PIN_SIGNAL_DISPATCH '{0}' is not a dispatch mode.".format(dispatch),
+            hint="Use one of {0}.".format(", ".join(DISPATCH_MODES)),
+            id='pinpayments.E005',
+        ))
+    return errors
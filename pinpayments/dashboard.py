@@ -0,0 +1,196 @@
+"""
+Payment KPIs for the admin dashboard, cached per widget
+
+Each widget is computed by a function over a recent window of data, and
+cached in the Django cache named by PIN_TOKEN_CACHE_ALIAS. Once a widget
+is older than its TTL it is still shown, while a background thread
+computes it again, so only the very first load of a widget (or one after
+the cache was cleared) waits for its queries. The refresh_dashboard
+management command computes every widget, eg from cron, so even that
+doesn't happen.
+
+Settings:
+    PIN_DASHBOARD_DAYS - number of days the widgets cover, default 30
+    PIN_DASHBOARD_TTLS - dict of seconds before each widget is refreshed,
+        by widget name, overriding the defaults in WIDGETS
+"""
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, Count, IntegerField, Sum, When
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+from pinpayments import logger
+from pinpayments.cache import get_shared_cache
+from pinpayments.models import PinTransaction, PinTransfer
+from pinpayments.objects import PinEnvironment
+from pinpayments.utils import currency_value_expression
+
+# Seconds a computed widget stays in the cache, stale or not
+MAX_AGE = 7 * 24 * 60 * 60
+
+
+def _since():
+    return timezone.now() - timedelta(days=getattr(settings, 'PIN_DASHBOARD_DAYS', 30))
+
+
+def _processed_transactions():
+    return PinTransaction.objects.filter(date__gte=_since(), processed=True)
+
+
+def transaction_volumes():
+    """ Number and total of successful charges, per environment and currency """
+    return list(
+        _processed_transactions().filter(succeeded=True)
+        .values('environment', 'currency')
+        .annotate(count=Count('pk'), total=Sum('amount'), fees=Sum('fees'))
+        .order_by('environment', 'currency')
+    )
+
+
+def success_rates():
+    """ Share of charges that succeeded, per environment """
+    rows = (
+        _processed_transactions().values('environment')
+        .annotate(
+            count=Count('pk'),
+            succeeded=Sum(Case(When(succeeded=True, then=1), default=0, output_field=IntegerField())),
+        )
+        .order_by('environment')
+    )
+    return [
+        dict(row, rate=100.0 * row['succeeded'] / row['count'] if row['count'] else None)
+        for row in rows
+    ]
+
+
+def fees_by_scheme():
+    """ Fees paid for successful charges, per card scheme and currency """
+    return list(
+        _processed_transactions().filter(succeeded=True)
+        .values('card_type', 'currency')
+        .annotate(count=Count('pk'), fees=Sum('fees'))
+        .order_by('-fees')
+    )
+
+
+def decline_reasons():
+    """ The ten most common responses to failed charges """
+    return list(
+        _processed_transactions().filter(succeeded=False)
+        .values('pin_response')
+        .annotate(count=Count('pk'))
+        .order_by('-count')[:10]
+    )
+
+
+def transfer_totals():
+    """ Number and value of transfers, per status and currency """
+    return list(
+        PinTransfer.objects.filter(created__gte=_since())
+        .values('status', 'currency')
+        .annotate(count=Count('pk'), total=Sum(currency_value_expression()))
+        .order_by('status', 'currency')
+    )
+
+
+def balances():
+    """ Available and pending balances, per environment and currency """
+    rows = []
+    for name in sorted(getattr(settings, 'PIN_ENVIRONMENTS', {})):
+        try:
+            environment_balances = PinEnvironment.get(name).get_balances()
+        except Exception as error:
+            rows.append({'environment': name, 'error': "{0}".format(error)})
+            continue
+        for currency, (available, pending) in sorted(environment_balances.items()):
+            rows.append({
+                'environment': name, 'currency': currency, 'available': available, 'pending': pending,
+            })
+    return rows
+
+
+# name: (title, function, default TTL in seconds)
+WIDGETS = OrderedDict((
+    ('transaction_volumes', (_('Charges'), transaction_volumes, 300)),
+    ('success_rates', (_('Success rates'), success_rates, 300)),
+    ('fees_by_scheme', (_('Fees by card scheme'), fees_by_scheme, 3600)),
+    ('decline_reasons', (_('Top decline reasons'), decline_reasons, 900)),
+    ('transfer_totals', (_('Transfers'), transfer_totals, 300)),
+    ('balances', (_('Balances'), balances, 60)),
+))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(1)
+        return _executor
+
+
+def _cache_key(name):
+    return 'pinpayments:dashboard:{0}'.format(name)
+
+
+def get_ttl(name):
+    return getattr(settings, 'PIN_DASHBOARD_TTLS', {}).get(name, WIDGETS[name][2])
+
+
+def get_cached(name):
+    """ Returns the cache entry of a widget, or None if it isn't cached """
+    return get_shared_cache().get(_cache_key(name))
+
+
+def is_stale(entry, name):
+    """ Whether a widget's cache entry is missing or older than its TTL """
+    return entry is None or time.time() - entry['computed'] > get_ttl(name)
+
+
+def refresh_widget(name):
+    """ Computes a widget and caches it, returns the cache entry """
+    entry = {'value': WIDGETS[name][1](), 'computed': time.time()}
+    get_shared_cache().set(_cache_key(name), entry, MAX_AGE)
+    return entry
+
+
+def _refresh_in_background(name):
+    try:
+        refresh_widget(name)
+    except Exception:
+        logger.exception("Unable to refresh dashboard widget {0}".format(name))
+    finally:
+        get_shared_cache().delete(_cache_key(name) + ':refreshing')
+        connections.close_all()
+
+
+def get_widget(name):
+    """
+    Returns the cache entry of a widget, a dict with its value and the
+    time it was computed. Computes it if it isn't cached, and queues a
+    refresh if it is older than its TTL.
+    """
+    entry = get_cached(name)
+    if entry is None:
+        return refresh_widget(name)
+    if is_stale(entry, name):
+        # add() only succeeds for one process, the others keep serving the stale entry
+        if get_shared_cache().add(_cache_key(name) + ':refreshing', True, 300):
+            _get_executor().submit(_refresh_in_background, name)
+    return entry
+
+
+def get_dashboard():
+    """ Returns (name, title, entry) for every widget """
+    return [(name, title, get_widget(name)) for name, (title, _function, _ttl) in WIDGETS.items()]
@@ -10,3 +10,7 @@ class ConfigError(Exception):
 
 class PinError(Exception):
     """ Errors related to Pin """
+
+
+class PinResponseError(PinError):
+    """ Errors returned by the Pin API in a JSON response """
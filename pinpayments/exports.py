@@ -0,0 +1,91 @@
+"""
+Streaming exports of transactions and transfers, as CSV or JSON lines
+
+Rows are read with values_list() and iterator(), so only the exported
+columns are loaded and memory use does not grow with the number of rows.
+"""
+from __future__ import unicode_literals
+
+import csv
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+
+from pinpayments.utils import iterate_queryset
+
+FORMATS = ('csv', 'jsonl')
+
+# Columns too large to export unless asked for
+HEAVY_FIELDS = ('pin_response_text',)
+
+
+def get_field_names(model):
+    """ Returns the names of the columns of model that can be exported """
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def get_default_fields(model):
+    """ Returns the columns exported when none are selected """
+    return [name for name in get_field_names(model) if name not in HEAVY_FIELDS]
+
+
+def validate_fields(model, fields):
+    """
+    Checks fields against the columns of model, allowing lookups through
+    relations like customer_token__token, and raises ValueError for the
+    first that isn't one
+    """
+    for name in fields:
+        if name in get_field_names(model):
+            continue
+        current = model
+        for part in name.split('__'):
+            try:
+                field = current._meta.get_field(part)
+            except (FieldDoesNotExist, AttributeError):
+                raise ValueError("Unknown field {0}".format(name))
+            current = field.related_model
+        if current is not None:
+            raise ValueError("Field {0} is a relation, export one of its columns".format(name))
+
+
+def export_rows(queryset, fields, chunk_size=2000):
+    """ Yields a tuple of the values of fields for each row of queryset """
+    return iterate_queryset(queryset.values_list(*fields), chunk_size)
+
+
+class Echo(object):
+    """ File-like object that returns what is written, for csv.writer """
+    def write(self, value):
+        return value
+
+
+def iter_csv(queryset, fields, chunk_size=2000):
+    """ Yields a CSV header line, then a line per row of queryset """
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in export_rows(queryset, fields, chunk_size):
+        yield writer.writerow(row)
+
+
+def iter_jsonl(queryset, fields, chunk_size=2000):
+    """ Yields a JSON object per row of queryset, one per line """
+    encoder = DjangoJSONEncoder()
+    for row in export_rows(queryset, fields, chunk_size):
+        yield encoder.encode(dict(zip(fields, row))) + '\n'
+
+
+def iter_export(queryset, fields, export_format='csv', chunk_size=2000):
+    """ Yields the lines of an export of queryset in export_format """
+    if export_format == 'jsonl':
+        return iter_jsonl(queryset, fields, chunk_size)
+    return iter_csv(queryset, fields, chunk_size)
+
+
+def write_export(queryset, fields, stream, export_format='csv', chunk_size=2000):
+    """ Writes an export of queryset to the text stream, returns the number of rows """
+    rows = -1 if export_format == 'csv' else 0  # the CSV header isn't a row
+    for line in iter_export(queryset, fields, export_format, chunk_size):
+        stream.write(line)
+        rows += 1
+    return rows
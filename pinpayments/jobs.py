@@ -0,0 +1,176 @@
+"""
+Runs actions on sets of objects in the background, recording progress
+
+A BackgroundJob is created with start_job() and run on a thread pool of
+PIN_JOB_THREADS threads (default 2) once the transaction creating it has
+committed. Each job calls Pin for PIN_JOB_WORKERS objects at a time
+(default 4). Jobs only run in the process that started them: a job
+interrupted by a restart stops saving its progress, and once it hasn't
+for PIN_JOB_STALE_SECONDS (default 600) resume_stale_jobs(), eg from the
+resume_jobs management command, runs it again. A job that raises is
+marked 'failed'.
+"""
+from __future__ import unicode_literals
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+from pinpayments import logger
+from pinpayments.models import (
+    JOB_FAILED, JOB_FINISHED, JOB_PENDING, JOB_RUNNING, BackgroundJob, CustomerToken, PinTransaction,
+    PinTransfer
+)
+from pinpayments.utils import concurrent_map, iterate_queryset
+
+# Number of error messages kept on a job
+MAX_ERRORS = 100
+
+
+def reprocess_transaction(pin_transaction):
+    # the conditional UPDATE keeps two jobs (or a job and a request) from both charging it
+    unprocessed = PinTransaction.objects.filter(pk=pin_transaction.pk, processed=False)
+    if pin_transaction.processed or not unprocessed.update(processed=True):
+        raise ValueError("Already sent to Pin")
+    try:
+        pin_transaction.process_transaction()
+    except Exception:
+        if not pin_transaction.processed:
+            # stopped by a pre_charge receiver before it was sent
+            PinTransaction.objects.filter(pk=pin_transaction.pk).update(processed=False)
+        raise
+    if not pin_transaction.succeeded:
+        raise ValueError(pin_transaction.pin_response)
+
+
+# name: (description, model, function called with each object)
+JOB_ACTIONS = OrderedDict((
+    ('resync_transactions', (_('Resync with Pin'), PinTransaction, lambda obj: obj.resync())),
+    ('reprocess_transactions', (_('Send unprocessed to Pin'), PinTransaction, reprocess_transaction)),
+    ('refresh_customers', (_('Refresh cards from Pin'), CustomerToken, lambda obj: obj.refresh_cards())),
+    ('refresh_transfers', (_('Refresh status from Pin'), PinTransfer, lambda obj: obj.refresh_status())),
+))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(getattr(settings, 'PIN_JOB_THREADS', 2))
+        return _executor
+
+
+def start_job(action, object_ids):
+    """
+    Creates a BackgroundJob running action on the objects with the given
+    primary keys, and queues it once the current transaction commits
+    """
+    if action not in JOB_ACTIONS:
+        raise ValueError("Unknown action {0}".format(action))
+    object_ids = list(object_ids)
+    job = BackgroundJob.objects.create(
+        action=action, object_ids=json.dumps(object_ids), total=len(object_ids)
+    )
+    transaction.on_commit(lambda: get_executor().submit(run_job_in_thread, job.pk))
+    return job
+
+
+def run_job_in_thread(job_id):
+    try:
+        run_job_or_fail(job_id)
+    finally:
+        connections.close_all()
+
+
+def run_job_or_fail(job_id, **kwargs):
+    """
+    Runs the job, marking it failed with the error if it raises
+    """
+    try:
+        run_job(job_id, **kwargs)
+    except Exception as error:
+        logger.exception("Background job {0} failed".format(job_id))
+        job = BackgroundJob.objects.filter(pk=job_id)
+        errors = job.values_list('errors', flat=True).first() or ''
+        now = timezone.now()
+        job.update(
+            status=JOB_FAILED, finished=now, updated=now,
+            errors="\n".join(line for line in (errors, "Job failed: {0}".format(error)) if line),
+        )
+
+
+def resume_stale_jobs(stale_seconds=None, max_workers=None):
+    """
+    Runs again the jobs left pending or running by a process that stopped,
+    those that haven't saved progress for stale_seconds (by default
+    PIN_JOB_STALE_SECONDS, 600), in this thread. Returns their ids.
+    """
+    if stale_seconds is None:
+        stale_seconds = getattr(settings, 'PIN_JOB_STALE_SECONDS', 600)
+    stale = timezone.now() - timedelta(seconds=stale_seconds)
+    resumed = []
+    for job_id in BackgroundJob.objects.filter(
+        status__in=(JOB_PENDING, JOB_RUNNING), updated__lt=stale
+    ).order_by('pk').values_list('pk', flat=True):
+        # the conditional UPDATE keeps two processes from resuming the same job
+        if BackgroundJob.objects.filter(
+            pk=job_id, status__in=(JOB_PENDING, JOB_RUNNING), updated__lt=stale
+        ).update(updated=timezone.now()):
+            logger.warning("Resuming stale background job {0}".format(job_id))
+            run_job_or_fail(job_id, max_workers=max_workers)
+            resumed.append(job_id)
+    return resumed
+
+
+def run_job(job_id, max_workers=None, flush_every=1.0):
+    """
+    Runs the job, saving its progress at most every flush_every seconds
+    """
+    if max_workers is None:
+        max_workers = getattr(settings, 'PIN_JOB_WORKERS', 4)
+    job = BackgroundJob.objects.get(pk=job_id)
+    _description, model, func = JOB_ACTIONS[job.action]
+    BackgroundJob.objects.filter(pk=job.pk).update(
+        status=JOB_RUNNING, succeeded=0, failed=0, errors='', updated=timezone.now()
+    )
+
+    objects = iterate_queryset(model.objects.filter(pk__in=json.loads(job.object_ids)).order_by('pk'))
+    succeeded = failed = 0
+    errors = []
+    flushed = time.time()
+    for obj, _result, error in concurrent_map(func, objects, max_workers):
+        if error is None:
+            succeeded += 1
+        else:
+            failed += 1
+            if len(errors) < MAX_ERRORS:
+                errors.append("{0}: {1}".format(obj, error))
+        if time.time() - flushed >= flush_every:
+            _save_progress(job, succeeded, failed, errors)
+            succeeded = failed = 0
+            flushed = time.time()
+
+    _save_progress(job, succeeded, failed, errors)
+    now = timezone.now()
+    BackgroundJob.objects.filter(pk=job.pk).update(status=JOB_FINISHED, finished=now, updated=now)
+
+
+def _save_progress(job, succeeded, failed, errors):
+    BackgroundJob.objects.filter(pk=job.pk).update(
+        succeeded=F('succeeded') + succeeded,
+        failed=F('failed') + failed,
+        errors="\n".join(errors),
+        updated=timezone.now(),
+    )
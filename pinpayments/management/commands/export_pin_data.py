@@ -0,0 +1,91 @@
+"""
+Exports transactions or transfers as CSV or JSON lines
+"""
+from __future__ import unicode_literals
+
+import io
+from datetime import datetime, time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from pinpayments.exceptions import ConfigError
+from pinpayments.exports import FORMATS, get_default_fields, validate_fields, write_export
+from pinpayments.models import PinTransaction, PinTransfer
+
+MODELS = {
+    'transactions': (PinTransaction, 'date'),
+    'transfers': (PinTransfer, 'created'),
+}
+
+
+class Command(BaseCommand):
+    """
+    Streams the rows to a file, or stdout, a chunk at a time, reading only
+    the columns exported. Memory use doesn't depend on the number of rows.
+    """
+    help = "Exports transactions or transfers as CSV or JSON lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(MODELS), help="What to export")
+        parser.add_argument('--format', choices=FORMATS, default='csv', help="Export format (default csv)")
+        parser.add_argument(
+            '--fields',
+            help="Comma separated columns to export, eg transaction_token,amount,customer_token__token "
+                 "(default: all but the full Pin response)"
+        )
+        parser.add_argument('--since', help="Only rows from this date or time on")
+        parser.add_argument('--until', help="Only rows before this date or time")
+        parser.add_argument('--environment', help="Only rows from this Pin environment")
+        parser.add_argument('--output', help="File to write to (default stdout)")
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help="Number of rows fetched from the database at a time (default 2000)"
+        )
+
+    def handle(self, *args, **options):
+        model, date_field = MODELS[options['model']]
+        if options['fields']:
+            fields = [name.strip() for name in options['fields'].split(',') if name.strip()]
+        else:
+            fields = get_default_fields(model)
+        try:
+            validate_fields(model, fields)
+        except ValueError as error:
+            raise CommandError("{0}".format(error))
+
+        queryset = model.objects.order_by(date_field, 'pk')
+        for option, lookup in (('since', 'gte'), ('until', 'lt')):
+            if options[option]:
+                queryset = queryset.filter(**{
+                    '{0}__{1}'.format(date_field, lookup): self.parse_when(options[option])
+                })
+        if options['environment']:
+            if model is PinTransfer:
+                # transfers sent before their environment was recorded are from the default one
+                try:
+                    queryset = queryset.for_environment(options['environment'])
+                except ConfigError as error:
+                    raise CommandError("{0}".format(error))
+            else:
+                queryset = queryset.filter(environment=options['environment'])
+
+        if options['output']:
+            with io.open(options['output'], 'w', newline='') as output:
+                rows = write_export(queryset, fields, output, options['format'], options['chunk_size'])
+            self.stderr.write("Exported {0} rows to {1}".format(rows, options['output']))
+        else:
+            write_export(queryset, fields, self.stdout, options['format'], options['chunk_size'])
+
+    def parse_when(self, value):
+        when = parse_datetime(value)
+        if when is None:
+            day = parse_date(value)
+            if day is None:
+                raise CommandError("Invalid date or time {0}".format(value))
+            when = datetime.combine(day, time())
+        if settings.USE_TZ and timezone.is_naive(when):
+            when = timezone.make_aware(when)
+        return when
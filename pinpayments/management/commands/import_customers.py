@@ -0,0 +1,122 @@
+"""
+Creates CustomerTokens in bulk from a file of users and card tokens
+"""
+from __future__ import unicode_literals
+
+import csv
+import io
+import json
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pinpayments.models import CustomerToken
+from pinpayments.utils import get_user_model
+
+
+class Command(BaseCommand):
+    """
+    Reads `user` and `card_token` values from a CSV file with a header row,
+    or from a JSON lines file, and creates a CustomerToken for each with
+    CustomerToken.objects.bulk_create_from_card_tokens().
+
+    Rows that could not be imported are written, with the error, to the
+    failures file, which can be fed back to this command once fixed.
+    """
+    help = "Creates CustomerTokens in bulk from a CSV or JSON lines file of users and card tokens"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV or JSON lines file with user and card_token values")
+        parser.add_argument(
+            '--format', choices=('csv', 'jsonl'),
+            help="Format of the file, guessed from its extension by default"
+        )
+        parser.add_argument(
+            '--user-field', default='pk',
+            help="User model field the user values refer to, eg email (default pk)"
+        )
+        parser.add_argument('--environment', help="Pin environment to create the customers in")
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help="Number of concurrent calls to Pin (default 8)"
+        )
+        parser.add_argument(
+            '--rate', type=float,
+            help="Maximum number of calls to Pin per second (default unlimited)"
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help="Number of rows inserted at a time (default 500)"
+        )
+        parser.add_argument(
+            '--failures',
+            help="File to write rows that failed to (default: path with .failures.csv appended)"
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        self.user_field = options['user_field']
+        failures_path = options['failures'] or path + '.failures.csv'
+
+        try:
+            source = io.open(path, newline='' if file_format == 'csv' else None)
+        except IOError as error:
+            raise CommandError("Unable to read {0}: {1}".format(path, error))
+
+        imported = 0
+        self.failed = 0
+        with source, io.open(failures_path, 'w', newline='') as failures_file:
+            self.failures = csv.DictWriter(failures_file, ['user', 'card_token', 'error'])
+            self.failures.writeheader()
+
+            rows = csv.DictReader(source) if file_format == 'csv' else (
+                json.loads(line) for line in source if line.strip()
+            )
+            pairs = self.resolve_users(rows, options['batch_size'])
+            results = CustomerToken.objects.bulk_create_from_card_tokens(
+                pairs,
+                environment=options['environment'],
+                max_workers=options['workers'],
+                rate_limit=options['rate'],
+                batch_size=options['batch_size'],
+            )
+            for user, card_token, customer, error in results:
+                if error is None:
+                    imported += 1
+                else:
+                    self.fail(getattr(user, self.user_field), card_token, error)
+
+        self.stdout.write("Imported {0} customers, {1} failed.".format(imported, self.failed))
+        if self.failed:
+            self.stdout.write("Failed rows were written to {0}".format(failures_path))
+
+    def fail(self, user, card_token, error):
+        self.failed += 1
+        self.failures.writerow({'user': user, 'card_token': card_token, 'error': error})
+
+    def resolve_users(self, rows, batch_size):
+        """
+        Yields (user, card_token) for each row, looking the users up a batch
+        at a time. Rows with unknown users or missing values are failed.
+        """
+        User = get_user_model()
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return
+            users = dict(
+                ('{0}'.format(getattr(user, self.user_field)), user)
+                for user in User._default_manager.filter(**{
+                    '{0}__in'.format(self.user_field): [row.get('user') for row in batch if row.get('user')]
+                })
+            )
+            for row in batch:
+                user = users.get('{0}'.format(row.get('user')))
+                if user is None:
+                    self.fail(row.get('user'), row.get('card_token'), "Unknown user")
+                elif not row.get('card_token'):
+                    self.fail(row.get('user'), row.get('card_token'), "Missing card_token")
+                else:
+                    yield (user, row['card_token'])
@@ -0,0 +1,58 @@
+"""
+Imports the line items of transfers from Pin
+"""
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pinpayments.exceptions import PinError
+from pinpayments.models import PinTransfer
+
+
+class Command(BaseCommand):
+    """
+    Runs PinTransfer.import_line_items() for the given transfers, or for
+    the paid transfers that have no line items yet.
+    """
+    help = "Imports the line items of transfers from Pin"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'tokens', nargs='*',
+            help="Tokens of the transfers to import (default: paid transfers without line items)"
+        )
+        parser.add_argument(
+            '--environment',
+            help="Pin environment to fetch from (default: the one each transfer was sent from)"
+        )
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help="Number of pages fetched from Pin concurrently (default 4)"
+        )
+
+    def handle(self, *args, **options):
+        if options['tokens']:
+            transfers = PinTransfer.objects.filter(transfer_token__in=options['tokens'])
+            missing = set(options['tokens']) - set(transfers.values_list('transfer_token', flat=True))
+            if missing:
+                raise CommandError("Unknown transfers: {0}".format(", ".join(sorted(missing))))
+        else:
+            transfers = PinTransfer.objects.filter(status='paid', line_items__isnull=True)
+            if options['environment']:
+                transfers = transfers.for_environment(options['environment'])
+
+        failed = 0
+        for transfer in transfers:
+            try:
+                imported = transfer.import_line_items(
+                    environment=options['environment'], max_workers=options['workers']
+                )
+            except PinError as error:
+                failed += 1
+                self.stderr.write("Transfer {0}: {1}".format(transfer.transfer_token, error))
+            else:
+                self.stdout.write("Transfer {0}: imported {1} line items.".format(
+                    transfer.transfer_token, imported
+                ))
+        if failed:
+            raise CommandError("Unable to import the line items of {0} transfers".format(failed))
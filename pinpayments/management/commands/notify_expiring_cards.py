@@ -0,0 +1,159 @@
+"""
+Notifies users whose stored cards are about to expire
+"""
+from __future__ import unicode_literals
+
+from collections import deque
+from itertools import groupby
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from pinpayments import logger
+from pinpayments.models import CardToken, Checkpoint
+from pinpayments.utils import concurrent_map, get_user_model, iterate_queryset
+
+COMPLETE = 'complete'
+
+
+class Command(BaseCommand):
+    """
+    Streams the cards of active CustomerTokens that expire within the given
+    number of months, groups them per user and hands each group to the
+    notifier, a callable(user, cards) named by --notifier or the
+    PIN_CARD_EXPIRY_NOTIFIER setting.
+
+    Progress is checkpointed per calendar month, so a crashed run picks up
+    after the last user that was notified and a finished run is not
+    repeated until next month (or until --restart is given). Users whose
+    notification failed are retried by the next run, and the month is only
+    finished once they have all been notified.
+    """
+    help = "Notifies users whose stored cards are about to expire"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months', type=int, default=1,
+            help="Notify about cards expiring within this many months (default 1)"
+        )
+        parser.add_argument(
+            '--notifier',
+            help="Dotted path to a callable(user, cards), overrides PIN_CARD_EXPIRY_NOTIFIER"
+        )
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help="Number of notifier calls to run concurrently (default 4)"
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help="Number of cards fetched from the database at a time (default 2000)"
+        )
+        parser.add_argument(
+            '--checkpoint-every', type=int, default=100,
+            help="Save progress after this many users (default 100)"
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help="Ignore progress saved by a previous run this month"
+        )
+
+    def handle(self, *args, **options):
+        path = options['notifier'] or getattr(settings, 'PIN_CARD_EXPIRY_NOTIFIER', None)
+        if not path:
+            raise CommandError(
+                "No notifier configured. Set PIN_CARD_EXPIRY_NOTIFIER or pass --notifier."
+            )
+        try:
+            self.notifier = import_string(path)
+        except ImportError as error:
+            raise CommandError("Unable to load notifier {0}: {1}".format(path, error))
+
+        months = options['months']
+        checkpoint, _created = Checkpoint.objects.get_or_create(
+            name='notify_expiring_cards:{0:%Y-%m}:{1}'.format(timezone.now(), months)
+        )
+        # users whose notification failed each get a checkpoint, retried by the next run
+        failed = Checkpoint.objects.filter(name__startswith=checkpoint.name + ':failed:')
+        if options['restart']:
+            checkpoint.value = ''
+            failed.delete()
+        if checkpoint.value == COMPLETE:
+            self.stdout.write("Notifications for this month have already been sent.")
+            return
+
+        retry = set(failed.values_list('value', flat=True))
+        query = Q(customer__user__in=list(retry))
+        if checkpoint.value:
+            # compared as stored, so user primary keys needn't be integers
+            query |= Q(customer__user__gt=checkpoint.value)
+        else:
+            query |= Q(customer__user__isnull=False)
+        cards = CardToken.objects.expiring_within(months).filter(
+            query, customer__active=True,
+        ).annotate(
+            notify_user_id=F('customer__user')
+        ).order_by('notify_user_id', 'pk')
+
+        # user ids in the order they were handed to the pool; the checkpoint
+        # only moves past a user once everyone before them has been notified.
+        submitted = deque()
+        finished = set()
+        users = failures = since_save = 0
+        last_user_id = None
+
+        groups = self.group_by_user(
+            iterate_queryset(cards, options['chunk_size']), submitted
+        )
+        for (user_id, _cards), _result, error in concurrent_map(
+            self.notify, groups, options['workers']
+        ):
+            users += 1
+            name = '{0}:failed:{1}'.format(checkpoint.name, user_id)
+            if error is not None:
+                failures += 1
+                logger.error("Card expiry notification for user {0} failed: {1}".format(user_id, error))
+                Checkpoint.objects.update_or_create(name=name, defaults={'value': str(user_id)})
+            elif str(user_id) in retry:
+                Checkpoint.objects.filter(name=name).delete()
+            finished.add(user_id)
+
+            while submitted and submitted[0] in finished:
+                user_id = submitted.popleft()
+                finished.remove(user_id)
+                if str(user_id) not in retry:
+                    # retried users come before the checkpoint, don't move it back
+                    last_user_id = user_id
+            since_save += 1
+            if last_user_id is not None and since_save >= options['checkpoint_every']:
+                self.save_checkpoint(checkpoint, last_user_id)
+                since_save = 0
+
+        if failures:
+            if last_user_id is not None:
+                self.save_checkpoint(checkpoint, last_user_id)
+            self.stdout.write("Notified {0} users, {1} failed and will be retried by the next run.".format(
+                users - failures, failures
+            ))
+            return
+        # users that failed before but have nothing to be notified about any more
+        failed.delete()
+        self.save_checkpoint(checkpoint, COMPLETE)
+        self.stdout.write("Notified {0} users, 0 failed.".format(users))
+
+    def group_by_user(self, cards, submitted):
+        """ Yields (user_id, cards) for consecutive cards of the same user """
+        for user_id, user_cards in groupby(cards, lambda card: card.notify_user_id):
+            submitted.append(user_id)
+            yield (user_id, list(user_cards))
+
+    def notify(self, group):
+        user_id, cards = group
+        user = get_user_model()._default_manager.get(pk=user_id)
+        return self.notifier(user, cards)
+
+    def save_checkpoint(self, checkpoint, value):
+        checkpoint.value = str(value)
+        checkpoint.save()
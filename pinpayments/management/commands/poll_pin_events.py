@@ -0,0 +1,58 @@
+"""
+Fetches the events Pin recorded since the last poll
+"""
+from __future__ import unicode_literals
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from pinpayments import logger
+from pinpayments.objects import PinEnvironment
+
+
+class Command(BaseCommand):
+    """
+    Runs PinEnvironment.poll_events() for each environment, once (eg from
+    cron) or with --loop every --interval seconds. Each poll requests a
+    single page of /events unless more than a page of events happened
+    since the last one.
+    """
+    help = "Fetches the events Pin recorded since the last poll, and applies them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--environment', action='append', dest='environments',
+            help="Pin environment to poll, can be repeated (default: all of PIN_ENVIRONMENTS)"
+        )
+        parser.add_argument(
+            '--max-pages', type=int,
+            help="Pages of events fetched at most per poll, eg to limit how far back the first goes"
+        )
+        parser.add_argument(
+            '--no-process', action='store_false', dest='process',
+            help="Only store the events, eg when process_pin_events runs separately"
+        )
+        parser.add_argument('--loop', action='store_true', help="Keep running, polling every --interval seconds")
+        parser.add_argument(
+            '--interval', type=float, default=60,
+            help="With --loop, seconds between polls (default 60)"
+        )
+
+    def handle(self, *args, **options):
+        environments = options['environments'] or sorted(getattr(settings, 'PIN_ENVIRONMENTS', {}))
+        while True:
+            for name in environments:
+                try:
+                    stored = PinEnvironment.get(name).poll_events(options['max_pages'], options['process'])
+                except Exception as error:
+                    if not options['loop']:
+                        raise
+                    logger.error("Unable to poll the events of environment {0}: {1}".format(name, error))
+                    continue
+                if stored or options['verbosity'] > 1:
+                    self.stdout.write("Stored {0} events from {1}.".format(stored, name))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,44 @@
+"""
+Applies the events received from Pin
+"""
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from pinpayments.models import PinEvent
+
+
+class Command(BaseCommand):
+    """
+    Runs PinEvent.objects.process_pending(), once (eg from cron, every
+    minute) or with --loop continuously, waiting --interval seconds
+    whenever no events are pending. Several can run at once on databases
+    supporting SELECT ... FOR UPDATE SKIP LOCKED.
+    """
+    help = "Applies the events received from Pin"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--environment', help="Only apply events from this Pin environment")
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help="Number of events applied at a time (default 500)"
+        )
+        parser.add_argument('--loop', action='store_true', help="Keep running, applying events as they arrive")
+        parser.add_argument(
+            '--interval', type=float, default=2,
+            help="With --loop, seconds to wait when no events are pending (default 2)"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = PinEvent.objects.process_pending(
+                batch_size=options['batch_size'], environment=options['environment']
+            )
+            if processed or options['verbosity'] > 1:
+                self.stdout.write("Processed {0} events.".format(processed))
+            if not options['loop']:
+                return
+            if not processed:
+                time.sleep(options['interval'])
@@ -0,0 +1,45 @@
+"""
+Records the balances of every Pin environment
+"""
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from pinpayments.models import BalanceSnapshot
+
+
+class Command(BaseCommand):
+    """
+    Runs BalanceSnapshot.objects.record(), and with --downsample
+    BalanceSnapshot.objects.downsample() to thin out old snapshots.
+    Run it from cron as often as charts need points, eg every 5 minutes.
+    """
+    help = "Records the balances of every Pin environment"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--environment', action='append', dest='environments',
+            help="Pin environment to record, can be repeated (default: all of PIN_ENVIRONMENTS)"
+        )
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help="Number of environments fetched concurrently (default 4)"
+        )
+        parser.add_argument(
+            '--downsample', action='store_true',
+            help="Also thin out old snapshots, see the PIN_BALANCE_*_DAYS settings"
+        )
+        parser.add_argument(
+            '--no-record', action='store_false', dest='record',
+            help="Don't record balances, eg to only --downsample"
+        )
+
+    def handle(self, *args, **options):
+        if options['record']:
+            snapshots = BalanceSnapshot.objects.record(
+                environments=options['environments'], max_workers=options['workers']
+            )
+            self.stdout.write("Recorded {0} balances.".format(len(snapshots)))
+        if options['downsample']:
+            deleted = BalanceSnapshot.objects.downsample()
+            self.stdout.write("Deleted {0} old snapshots.".format(deleted))
@@ -0,0 +1,38 @@
+"""
+Computes the widgets of the admin dashboard
+"""
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pinpayments.dashboard import WIDGETS, get_cached, is_stale, refresh_widget
+
+
+class Command(BaseCommand):
+    """
+    Keeps the dashboard cache warm, so admin pages never wait for its
+    queries. Run it from cron more often than the shortest TTL, eg every
+    minute; with --stale-only it only computes widgets older than theirs.
+    """
+    help = "Computes the widgets of the admin dashboard"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--widget', action='append', dest='widgets',
+            help="Widget to compute, can be repeated (default: all of {0})".format(", ".join(WIDGETS))
+        )
+        parser.add_argument(
+            '--stale-only', action='store_true',
+            help="Only compute widgets that are missing or older than their TTL"
+        )
+
+    def handle(self, *args, **options):
+        names = options['widgets'] or list(WIDGETS)
+        for name in names:
+            if name not in WIDGETS:
+                raise CommandError("Unknown widget {0}".format(name))
+        for name in names:
+            if options['stale_only'] and not is_stale(get_cached(name), name):
+                continue
+            refresh_widget(name)
+            self.stdout.write("Computed {0}.".format(name))
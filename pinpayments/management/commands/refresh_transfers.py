@@ -0,0 +1,34 @@
+"""
+Updates the status of transfers that are in flight
+"""
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from pinpayments.models import PinTransfer
+
+
+class Command(BaseCommand):
+    """
+    Runs PinTransfer.objects.refresh_statuses() for the transfers in flight.
+    """
+    help = "Updates the status of transfers that are in flight"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--environment', help="Only refresh the transfers sent from this Pin environment (default: all of them)")
+        parser.add_argument(
+            '--by-token', action='store_true',
+            help="Fetch each transfer separately, rather than paging through all transfers"
+        )
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help="Number of concurrent calls to Pin with --by-token (default 8)"
+        )
+
+    def handle(self, *args, **options):
+        changes = PinTransfer.objects.refresh_statuses(
+            environment=options['environment'],
+            by_token=options['by_token'],
+            max_workers=options['workers'],
+        )
+        self.stdout.write("Updated the status of {0} transfers.".format(len(changes)))
@@ -0,0 +1,31 @@
+"""
+Runs again the background jobs interrupted by a restart
+"""
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from pinpayments.jobs import resume_stale_jobs
+
+
+class Command(BaseCommand):
+    """
+    Runs pinpayments.jobs.resume_stale_jobs(), in this process. Run it from
+    cron, eg every 10 minutes, so jobs whose web process was restarted
+    are finished.
+    """
+    help = "Runs again the background jobs interrupted by a restart"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stale-seconds', type=int,
+            help="Resume jobs that haven't saved progress for this long (default PIN_JOB_STALE_SECONDS, 600)"
+        )
+        parser.add_argument(
+            '--workers', type=int,
+            help="Number of objects processed concurrently (default PIN_JOB_WORKERS, 4)"
+        )
+
+    def handle(self, *args, **options):
+        resumed = resume_stale_jobs(options['stale_seconds'], max_workers=options['workers'])
+        self.stdout.write("Resumed {0} jobs.".format(len(resumed)))
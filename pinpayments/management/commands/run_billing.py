@@ -0,0 +1,53 @@
+"""
+Charges subscriptions that are due
+"""
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from pinpayments.billing import BillingScheduler
+
+
+class Command(BaseCommand):
+    """
+    Runs a BillingScheduler once, from cron, or continuously with --loop.
+    Any number of these can run at the same time.
+    """
+    help = "Charges subscriptions that are due"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help="Number of subscriptions claimed at a time (default 100)"
+        )
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help="Number of charges to process concurrently (default 4)"
+        )
+        parser.add_argument(
+            '--lease', type=int, default=600,
+            help="Seconds before subscriptions claimed by a crashed scheduler are released (default 600)"
+        )
+        parser.add_argument(
+            '--loop', action='store_true',
+            help="Keep running, checking for due subscriptions every --interval seconds"
+        )
+        parser.add_argument(
+            '--interval', type=int, default=60,
+            help="Seconds to wait between runs with --loop (default 60)"
+        )
+
+    def handle(self, *args, **options):
+        scheduler = BillingScheduler(
+            batch_size=options['batch_size'],
+            max_workers=options['workers'],
+            lease_seconds=options['lease'],
+        )
+        while True:
+            succeeded, failed = scheduler.run()
+            self.stdout.write("Billed {0} subscriptions, {1} failed.".format(succeeded, failed))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
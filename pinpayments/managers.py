@@ -1,34 +1,134 @@
 from __future__ import absolute_import, unicode_literals
 
-from pinpayments.exceptions import PinError
-from pinpayments.objects import PinEnvironment
-
-from django.db import models
-try:
-    from django.apps import apps
-    get_model = apps.get_model
-except ImportError:  # django < 1.7
-    from django.db.models.loading import get_model
+import json
+from datetime import timedelta
+from itertools import chain, islice
+
+from pinpayments import cache, logger, signals
+from pinpayments.exceptions import ConfigError, PinError
+from pinpayments.objects import PinEnvironment, RateLimiter
+from pinpayments.utils import (
+    add_months, concurrent_map, currency_base_amount_expression, currency_value_expression, get_value,
+    update_by_pk
+)
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import Case, CharField, Max, Q, Value, When
+from django.db.models.functions import TruncDay, TruncHour
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import ugettext_lazy as _
 
 
-class CardTokenManager(models.Manager):
+def _expiry_before(year, month):
+    """
+        Q object matching cards whose expiry month falls before the given year and month.
+    """
+    return Q(expiry_year__lt=year) | Q(expiry_year=year, expiry_month__lt=month)
+
+
+class CardTokenQuerySet(QuerySet):
+    """
+        Card expiry filters computed in the database from expiry_year and expiry_month,
+        so they can use the (expiry_year, expiry_month) index instead of loading every
+        CardToken to evaluate CardTokenAbstract.has_expired.
+
+        A card is valid up to and including the last day of its expiry month. Cards with
+        no expiry details are neither expired nor valid.
+    """
+
+    def _today(self):
+        today = timezone.now().date()
+        return (today.year, today.month)
+
+    def expired(self):
+        """
+            Cards whose expiry month has already passed.
+        """
+        return self.filter(_expiry_before(*self._today()))
+
+    def valid(self):
+        """
+            Cards that can still be charged this month.
+        """
+        year, month = self._today()
+        return self.filter(expiry_year__isnull=False, expiry_month__isnull=False).exclude(
+            _expiry_before(year, month)
+        )
+
+    def expiring_within(self, months=1):
+        """
+            Valid cards that will expire within the given number of months. months=1
+            matches cards expiring at the end of the current month, months=2 also
+            includes those expiring at the end of next month, and so on.
+        """
+        year, month = self._today()
+        return self.valid().filter(_expiry_before(*add_months(year, month, months)))
+
+
+class CachedTokenManagerMixin(object):
+    """
+        Adds get_cached() to managers of models with a Pin `token` field.
+    """
+
+    def get_cached(self, token):
+        """
+            Returns the instance with the given token, from the cache where possible.
+            See pinpayments.cache.
+        """
+        return cache.get_cached(self, token)
+
+
+class CardTokenManager(CachedTokenManagerMixin, models.Manager):
     """
         Manager class for CardToken, separates API calls and model logic away from the
         Model's class impl for sanity and separation of concern reasons.
     """
 
-    def create_from_data(self, data):
+    def get_queryset(self):
+        return CardTokenQuerySet(self.model, using=self._db)
+
+    def expired(self):
+        return self.get_queryset().expired()
+
+    def valid(self):
+        return self.get_queryset().valid()
+
+    def expiring_within(self, months=1):
+        return self.get_queryset().expiring_within(months)
+
+    def create_from_data(self, data, customer=None):
         """
-            Creates a new CardToken instance from a PIN response
+            Creates a new CardToken instance from a PIN response, optionally stored
+            against a CustomerToken
         """
         CardToken = self.model
 
         card = CardToken()
+        if customer is not None and self.links_customers(type(customer)):
+            card.customer = customer
+            customer = None
         self.update_card_from_data(card, data)
+        if customer is not None:
+            customer.cards.add(card)
 
         return card
 
+    def links_customers(self, customer_model):
+        """
+            Whether the cards of customer_model are linked with the CardToken.customer foreign key.
+            Other CustomerTokenAbstract implementations declare their own cards relation.
+        """
+        try:
+            related_model = self.model._meta.get_field('customer').related_model
+        except FieldDoesNotExist:
+            return False
+        return issubclass(customer_model, related_model)
+
     def update_card_from_data(self, card, data, commit=True):
         """
             Updates the CardToken fields from a json data response
@@ -53,7 +153,7 @@ class CardTokenManager(models.Manager):
             card.save()
 
 
-class CustomerTokenManager(models.Manager):
+class CustomerTokenManager(CachedTokenManagerMixin, models.Manager):
     """
         Manager class for CustomerToken, separates API calls and model logic away from the
         Model's class impl for sanity and separation of concern reasons.
@@ -70,10 +170,14 @@ class CustomerTokenManager(models.Manager):
         """
         Handles keeping the primary CardTokens of cards on CustomerTokens in sync.
         """
-        CardToken = get_model('pinpayments', 'CardToken')
+        CardToken = apps.get_model('pinpayments', 'CardToken')
 
         # set all other cards.primary=False.
-        customer.cards.exclude(pk=primary_card.pk).filter(primary=True).update(primary=False)
+        other_cards = customer.cards.exclude(pk=primary_card.pk).filter(primary=True)
+        other_tokens = list(other_cards.values_list('token', flat=True))
+        if other_tokens:
+            other_cards.update(primary=False)
+            cache.invalidate_on_commit(CardToken, *other_tokens, using=other_cards.db)
 
         # update the card field values if an updated data dict has been provided.
         if data:
@@ -95,7 +199,7 @@ class CustomerTokenManager(models.Manager):
             'primary_card_token': card.token,
         })
 
-        pin_env = PinEnvironment(customer.environment)
+        pin_env = PinEnvironment.get(customer.environment)
         url_tail = "/customers/{0}".format(customer.token)
         data = pin_env.pin_put(url_tail, payload)[1]['response']
 
@@ -105,8 +209,8 @@ class CustomerTokenManager(models.Manager):
         """
             Creates a new CardToken instance from a card_token and attaches it to a customer's cards.
         """
-        CardToken = get_model('pinpayments', 'CardToken')
-        pin_env = PinEnvironment(customer.environment)
+        CardToken = apps.get_model('pinpayments', 'CardToken')
+        pin_env = PinEnvironment.get(customer.environment)
         payload = {'card_token': card_token}
 
         url_tail = "/customers/{0}/cards".format(customer.token)
@@ -119,11 +223,11 @@ class CustomerTokenManager(models.Manager):
             # update the card fields
             CardToken.objects.update_card_from_data(card, data)
         else:
-            card = CardToken.objects.create_from_data(data)
-            customer.cards.add(card)
+            card = CardToken.objects.create_from_data(data, customer=customer)
 
         if card.primary:
             self.set_primary_card_models(customer, card)
+        signals.dispatch(signals.card_added, customer.__class__, customer=customer, card=card)
         return card
 
     def create_from_card_token(self, card_token, user, environment=None):
@@ -131,10 +235,10 @@ class CustomerTokenManager(models.Manager):
             Create a new CustomerToken from a card_token and attaches a
             CardToken to the CustomerToken instance.
         """
-        CardToken = get_model('pinpayments', 'CardToken')
+        CardToken = apps.get_model('pinpayments', 'CardToken')
         CustomerToken = self.model
 
-        pin_env = PinEnvironment(environment)
+        pin_env = PinEnvironment.get(environment)
         payload = {'email': user.email, 'card_token': card_token}
         data = pin_env.pin_post("/customers", payload)[1]['response']
 
@@ -145,27 +249,845 @@ class CustomerTokenManager(models.Manager):
         )
 
         # attach the card object
-        card = CardToken.objects.create_from_data(data.get('card'))
-        customer.cards.add(card)
+        card = CardToken.objects.create_from_data(data.get('card'), customer=customer)
 
         if card.primary:
             self.set_primary_card_models(customer, card)
 
+        signals.dispatch(signals.customer_created, CustomerToken, customer=customer)
+        signals.dispatch(signals.card_added, CustomerToken, customer=customer, card=card)
         return customer
 
+    def bulk_create_from_card_tokens(self, pairs, environment=None, max_workers=8, rate_limit=None,
+                                     batch_size=500):
+        """
+            Creates a CustomerToken, with its CardToken, for each (user, card_token) pair.
+
+            Pairs are handled batch_size at a time: the /customers calls for a batch are made
+            concurrently on max_workers threads, at most rate_limit per second if given, then
+            the batch's CustomerTokens and CardTokens are inserted with bulk_create.
+
+            Yields a (user, card_token, customer, error) tuple for each pair, as batches
+            complete. Either customer is the new CustomerToken, or error the exception raised
+            while creating it.
+        """
+        pin_env = PinEnvironment.get(environment)
+        limiter = RateLimiter(rate_limit) if rate_limit else None
+
+        def create_customer(pair):
+            user, card_token = pair
+            if limiter is not None:
+                limiter.wait()
+            payload = {'email': user.email, 'card_token': card_token}
+            return pin_env.pin_post("/customers", payload)[1]['response']
+
+        pairs = iter(pairs)
+        while True:
+            batch = list(islice(pairs, batch_size))
+            if not batch:
+                return
+            created = []
+            for pair, data, error in concurrent_map(create_customer, batch, max_workers):
+                if error is not None:
+                    yield (pair[0], pair[1], None, error)
+                else:
+                    created.append((pair, data))
+
+            customers = self._bulk_insert_customers(created, pin_env.name)
+            for (user, card_token), data in created:
+                yield (user, card_token, customers[data['token']], None)
+
+    def _bulk_insert_customers(self, created, environment):
+        """
+            Inserts CustomerTokens and CardTokens for a list of ((user, card_token), data)
+            and returns the new CustomerTokens by token.
+        """
+        CardToken = apps.get_model('pinpayments', 'CardToken')
+        if not created:
+            return {}
+
+        self.bulk_create([
+            self.model(user=user, token=data['token'], environment=environment)
+            for (user, card_token), data in created
+        ])
+        # bulk_create doesn't set primary keys on every database, fetch them back.
+        customers = dict(
+            (customer.token, customer) for customer in
+            self.filter(environment=environment, token__in=[data['token'] for pair, data in created])
+        )
+
+        if not CardToken.objects.links_customers(self.model):
+            for pair, data in created:
+                CardToken.objects.create_from_data(
+                    dict(data.get('card'), environment=environment), customer=customers[data['token']]
+                )
+        else:
+            cards = []
+            for pair, data in created:
+                card = CardToken(customer=customers[data['token']], environment=environment)
+                CardToken.objects.update_card_from_data(card, data.get('card'), commit=False)
+                cards.append(card)
+            CardToken.objects.bulk_create(cards)
+
+        for customer in customers.values():
+            signals.dispatch(signals.customer_created, self.model, customer=customer)
+        if signals.card_added.has_listeners(self.model):
+            card_tokens = dict((data['card']['token'], data['token']) for pair, data in created)
+            for card in CardToken.objects.filter(environment=environment, token__in=list(card_tokens)):
+                customer = customers[card_tokens[card.token]]
+                signals.dispatch(signals.card_added, self.model, customer=customer, card=card)
+        return customers
+
+    def refresh_cards_for_customer(self, customer):
+        """
+            Brings a CustomerToken's CardTokens in line with the cards Pin has for the
+            customer: updates known cards, adds new ones and deletes those Pin no longer has.
+        """
+        CardToken = apps.get_model('pinpayments', 'CardToken')
+        pin_env = PinEnvironment.get(customer.environment)
+
+        remote = []
+        page = 1
+        while page:
+            response_json = pin_env.pin_get("/customers/{0}/cards?page={1}".format(customer.token, page))[1]
+            remote.extend(response_json['response'])
+            page = (response_json.get('pagination') or {}).get('next')
+
+        local = dict((card.token, card) for card in customer.cards.all())
+        for data in remote:
+            card = local.pop(data['token'], None)
+            if card is None:
+                CardToken.objects.create_from_data(dict(data, environment=customer.environment), customer)
+            else:
+                CardToken.objects.update_card_from_data(card, data)
+
+        if local:
+            customer.cards.filter(token__in=list(local)).delete()
+            cache.invalidate_on_commit(CardToken, *local, using=customer.cards.db)
+        return True
+
     def delete_card_from_customer(self, customer, card):
         """
             Deletes a CardToken from a CustomerToken instance.
         """
-        pin_env = PinEnvironment(customer.environment)
+        pin_env = PinEnvironment.get(customer.environment)
 
-        if card not in customer.cards.all():
+        # indexed lookup on CardToken.customer rather than loading all of the customer's cards
+        cards = customer.cards.filter(pk=card.pk)
+        if not cards.exists():
             raise PinError("The CardToken does not belong to the CustomerToken and cannot be deleted.")
 
         url_tail = "/customers/{0}/cards/{1}".format(customer.token, card.token)
         data = pin_env.pin_delete(url_tail, {}, process_response_body=False)
 
-        # success
-        customer.cards.remove(card)
-        card.delete()
+        # success, a single DELETE that also guards against the card having moved meanwhile
+        cards.delete()
+        cache.invalidate_on_commit(card.__class__, card.token, using=cards.db)
+        signals.dispatch(signals.card_deleted, customer.__class__, customer=customer, card=card)
         return True
+
+
+class PinTransactionQuerySet(QuerySet):
+    """
+        Filters for PinTransactions.
+    """
+
+    def with_base_amount(self):
+        """
+            Annotates base_amount, the amount in the base unit of the currency (eg cents),
+            as sent to Pin and used by transfers, computed by the database.
+        """
+        return self.annotate(base_amount=currency_base_amount_expression())
+
+
+class PinTransactionManager(models.Manager):
+    """
+        Manager class for PinTransaction.
+    """
+
+    def get_queryset(self):
+        return PinTransactionQuerySet(self.model, using=self._db)
+
+    def with_base_amount(self):
+        return self.get_queryset().with_base_amount()
+
+
+class PinRecipientManager(CachedTokenManagerMixin, models.Manager):
+    """
+        Manager class for PinRecipient.
+    """
+
+    def create_with_bank_account(self, email, account_name, bsb, number, name="", environment=None):
+        """
+            Creates a new recipient from a provided bank account's details.
+        """
+        pin_env = PinEnvironment.get(environment)
+        payload = {
+            'email': email,
+            'name': name,
+            'bank_account[name]': account_name,
+            'bank_account[bsb]': bsb,
+            'bank_account[number]': number
+        }
+        data = pin_env.pin_post('/recipients', payload)[1]['response']
+        bank_account = self._bank_account_from_data(data['bank_account'], pin_env.name)
+        bank_account.save()
+        recipient = self.create(
+            token=data['token'],
+            email=data['email'],
+            name=data['name'],
+            bank_account=bank_account,
+            environment=pin_env.name,
+        )
+        signals.dispatch(signals.recipient_created, self.model, recipient=recipient)
+        return recipient
+
+    def bulk_create_with_bank_accounts(self, accounts, environment=None, max_workers=8,
+                                       rate_limit=None, batch_size=500):
+        """
+            Creates a PinRecipient for each of accounts, a dict with the email, account_name,
+            bsb and number keys, and optionally name.
+
+            Accounts are handled batch_size at a time. Pin is sent the details of each bank
+            account once: recipients sharing a BSB and account number with an earlier one
+            are created from its bank account token, and share its BankAccount row. The
+            /recipients calls are made concurrently on max_workers threads, at most
+            rate_limit per second if given, then the batch's BankAccounts and PinRecipients
+            are inserted with bulk_create.
+
+            Yields an (account, recipient, error) tuple for each account, as batches
+            complete. Either recipient is the new PinRecipient, or error the exception raised
+            while creating it.
+        """
+        pin_env = PinEnvironment.get(environment)
+        limiter = RateLimiter(rate_limit) if rate_limit else None
+        # BankAccounts by (bsb, number), or the error Pin gave for their details
+        bank_accounts = {}
+
+        def account_key(account):
+            return ("{0}".format(account['bsb']), "{0}".format(account['number']))
+
+        def create_recipient(account):
+            if limiter is not None:
+                limiter.wait()
+            payload = {'email': account['email'], 'name': account.get('name', "")}
+            bank_account = bank_accounts.get(account_key(account))
+            if bank_account is None:
+                payload.update({
+                    'bank_account[name]': account['account_name'],
+                    'bank_account[bsb]': account['bsb'],
+                    'bank_account[number]': account['number'],
+                })
+            else:
+                payload['bank_account_token'] = bank_account.token
+            return pin_env.pin_post('/recipients', payload)[1]['response']
+
+        accounts = iter(accounts)
+        while True:
+            batch = list(islice(accounts, batch_size))
+            if not batch:
+                return
+
+            first, repeated, seen = [], [], set()
+            for account in batch:
+                key = account_key(account)
+                if key in bank_accounts or key in seen:
+                    repeated.append(account)
+                else:
+                    seen.add(key)
+                    first.append(account)
+
+            created = []
+            new_bank_accounts = []
+            for account, data, error in concurrent_map(create_recipient, first, max_workers):
+                if error is not None:
+                    bank_accounts[account_key(account)] = error
+                    yield (account, None, error)
+                else:
+                    bank_account = self._bank_account_from_data(data['bank_account'], pin_env.name)
+                    bank_accounts[account_key(account)] = bank_account
+                    new_bank_accounts.append(bank_account)
+                    created.append((account, data))
+            self._bulk_insert_bank_accounts(new_bank_accounts, pin_env.name)
+
+            for account in list(repeated):
+                error = bank_accounts[account_key(account)]
+                if isinstance(error, Exception):
+                    repeated.remove(account)
+                    yield (account, None, error)
+            for account, data, error in concurrent_map(create_recipient, repeated, max_workers):
+                if error is not None:
+                    yield (account, None, error)
+                else:
+                    created.append((account, data))
+
+            if not created:
+                continue
+            self.bulk_create([
+                self.model(
+                    token=data['token'],
+                    email=data['email'],
+                    name=data['name'],
+                    bank_account=bank_accounts[account_key(account)],
+                    environment=pin_env.name,
+                )
+                for account, data in created
+            ])
+            # bulk_create doesn't set primary keys on every database, fetch them back.
+            recipients = dict(
+                (recipient.token, recipient) for recipient in
+                self.filter(environment=pin_env.name, token__in=[data['token'] for account, data in created])
+            )
+            for account, data in created:
+                signals.dispatch(signals.recipient_created, self.model, recipient=recipients[data['token']])
+                yield (account, recipients[data['token']], None)
+
+    def _bank_account_from_data(self, data, environment):
+        BankAccount = apps.get_model('pinpayments', 'BankAccount')
+        return BankAccount(
+            bank_name=data['bank_name'],
+            branch=data['branch'],
+            bsb=data['bsb'],
+            name=data['name'],
+            number=data['number'],
+            token=data['token'],
+            environment=environment,
+        )
+
+    def _bulk_insert_bank_accounts(self, bank_accounts, environment):
+        """
+            Inserts unsaved BankAccounts and sets their primary keys.
+        """
+        BankAccount = apps.get_model('pinpayments', 'BankAccount')
+        if not bank_accounts:
+            return
+        BankAccount.objects.bulk_create(bank_accounts)
+        pks = dict(BankAccount.objects.filter(
+            environment=environment, token__in=[bank_account.token for bank_account in bank_accounts]
+        ).values_list('token', 'pk'))
+        for bank_account in bank_accounts:
+            bank_account.pk = pks[bank_account.token]
+
+
+class PinTransferQuerySet(QuerySet):
+    """
+        Filters for PinTransfers.
+    """
+
+    def in_flight(self):
+        """
+            Transfers accepted by Pin that have not reached a final status, as listed in
+            the PIN_TRANSFER_FINAL_STATUSES setting.
+        """
+        final_statuses = getattr(settings, 'PIN_TRANSFER_FINAL_STATUSES', ('paid', 'failed'))
+        return self.filter(transfer_token__isnull=False).exclude(status__in=final_statuses)
+
+    def for_environment(self, environment=None):
+        """
+            Transfers sent from the named Pin environment, by default PIN_DEFAULT_ENVIRONMENT.
+            Transfers without an environment were sent before it was recorded, from the default.
+        """
+        name = PinEnvironment.get(environment).name
+        query = Q(environment=name)
+        if name == PinEnvironment.get().name:
+            query |= Q(environment='')
+        return self.filter(query)
+
+    def with_display_value(self):
+        """
+            Annotates display_value, the amount converted to the representation of the
+            currency (PinTransfer.value), computed by the database so it can be sorted on.
+        """
+        return self.annotate(display_value=currency_value_expression())
+
+
+class PinTransferManager(models.Manager):
+    """
+        Manager class for PinTransfer, keeps transfer statuses in sync with Pin.
+    """
+
+    def get_queryset(self):
+        return PinTransferQuerySet(self.model, using=self._db)
+
+    def in_flight(self):
+        return self.get_queryset().in_flight()
+
+    def for_environment(self, environment=None):
+        return self.get_queryset().for_environment(environment)
+
+    def with_display_value(self):
+        return self.get_queryset().with_display_value()
+
+    def refresh_statuses(self, transfers=None, environment=None, by_token=False, max_workers=8):
+        """
+            Fetches the current status of the given transfers (by default, those in flight)
+            from Pin and saves those that changed, with a single UPDATE.
+
+            Each transfer is looked up in the environment it was sent from; with environment,
+            only the transfers sent from that environment are refreshed.
+
+            By default pages through /transfers, newest first, until every transfer has been
+            seen. With by_token=True each transfer is fetched from /transfers/{token} instead,
+            on max_workers threads, which is quicker for a few old transfers.
+
+            Returns a dict of the new status by primary key, for the transfers that changed.
+        """
+        if transfers is None:
+            transfers = self.in_flight()
+        if environment is not None:
+            transfers = transfers.for_environment(environment)
+        by_environment = {}
+        for pk, token, status, name in transfers.values_list('pk', 'transfer_token', 'status', 'environment'):
+            by_environment.setdefault(name, {})[token] = (pk, status)
+
+        changes = {}
+        for name, local in sorted(by_environment.items()):
+            try:
+                pin_env = PinEnvironment.get(name)
+            except ConfigError as error:
+                logger.warning("Unable to refresh the transfers of environment {0}: {1}".format(name, error))
+                continue
+            if by_token:
+                remote = self._fetch_statuses_by_token(pin_env, local, max_workers)
+            else:
+                remote = self._fetch_statuses_by_page(pin_env, local)
+            changes.update(
+                (local[token][0], status) for token, status in remote.items()
+                if token in local and local[token][1] != status
+            )
+        self.apply_statuses(changes)
+        return changes
+
+    def apply_statuses(self, changes):
+        """
+            Sets the status of many transfers at once, given a dict of status by primary key,
+            and sends transfer_status_changed for each.
+        """
+        if not changes:
+            return
+        by_status = {}
+        for pk, status in changes.items():
+            by_status.setdefault(status, []).append(pk)
+        self.filter(pk__in=list(changes)).update(status=Case(
+            *[When(pk__in=pks, then=Value(status)) for status, pks in by_status.items()],
+            output_field=CharField()
+        ))
+        if signals.transfer_status_changed.has_listeners(self.model):
+            for transfer in self.filter(pk__in=list(changes)).select_related('recipient'):
+                signals.dispatch(signals.transfer_status_changed, self.model, transfer=transfer)
+
+    def _fetch_statuses_by_page(self, pin_env, wanted):
+        statuses = {}
+        page = 1
+        while page:
+            response_json = pin_env.pin_get("/transfers?page={0}".format(page))[1]
+            for data in response_json['response']:
+                statuses[data['token']] = data['status']
+            if all(token in statuses for token in wanted):
+                break
+            page = response_json.get('pagination', {}).get('next')
+        return statuses
+
+    def _fetch_statuses_by_token(self, pin_env, wanted, max_workers):
+        def fetch(token):
+            return pin_env.pin_get("/transfers/{0}".format(token))[1]['response']['status']
+
+        statuses = {}
+        for token, status, error in concurrent_map(fetch, wanted, max_workers):
+            if error is not None:
+                logger.warning("Unable to fetch the status of transfer {0}: {1}".format(token, error))
+            else:
+                statuses[token] = status
+        return statuses
+
+
+class PinTransferLineItemManager(models.Manager):
+    """
+        Manager class for PinTransferLineItem, imports the line items of transfers from Pin.
+    """
+
+    def import_for_transfer(self, transfer, environment=None, max_workers=4, batch_size=1000):
+        """
+            Replaces the line items of transfer with those listed by Pin, fetched by default
+            from the environment it was sent from.
+
+            The first page of /transfers/{token}/line_items tells how many pages there are,
+            the rest are fetched on max_workers threads, at most two per worker ahead of the
+            inserts. Line items are inserted batch_size at a time, each batch linked to the
+            PinTransactions of its charges with one query, so memory stays bounded however
+            many line items the transfer has. Everything happens in one database transaction:
+            a page that cannot be fetched leaves the previous import in place.
+
+            Returns the number of line items imported.
+        """
+        pin_env = PinEnvironment.get(environment or transfer.environment)
+        url = "/transfers/{0}/line_items?page={{0}}".format(transfer.transfer_token)
+
+        def fetch(page):
+            return pin_env.pin_get(url.format(page))[1]
+
+        first = fetch(1)
+        pagination = first.get('pagination') or {}
+        per_page = pagination.get('per_page') or len(first['response'])
+
+        pages = chain(
+            [(1, first, None)],
+            concurrent_map(fetch, range(2, (pagination.get('pages') or 1) + 1), max_workers)
+        )
+
+        imported = 0
+        batch = []
+        with transaction.atomic(using=self.db):
+            self.filter(transfer=transfer).delete()
+            for page, response_json, error in pages:
+                if error is not None:
+                    raise PinError("Unable to fetch page {0} of the line items of transfer {1}: {2}".format(
+                        page, transfer.transfer_token, error
+                    ))
+                for index, data in enumerate(response_json['response']):
+                    batch.append(self.model(
+                        transfer=transfer,
+                        position=(page - 1) * per_page + index,
+                        line_item_type=data.get('type') or '',
+                        amount=data['amount'],
+                        currency=data.get('currency') or '',
+                        created_at=parse_datetime(data['created_at']) if data.get('created_at') else None,
+                        record_object=data.get('object') or '',
+                        record_token=data.get('token') or '',
+                    ))
+                if len(batch) >= batch_size:
+                    imported += self._insert_line_items(batch)
+                    batch = []
+            imported += self._insert_line_items(batch)
+        return imported
+
+    def _insert_line_items(self, line_items):
+        if not line_items:
+            return 0
+        PinTransaction = apps.get_model('pinpayments', 'PinTransaction')
+        transactions = dict(PinTransaction.objects.filter(
+            transaction_token__in=set(item.record_token for item in line_items if item.record_object == 'charge')
+        ).values_list('transaction_token', 'pk'))
+        for item in line_items:
+            if item.record_object == 'charge':
+                item.transaction_id = transactions.get(item.record_token)
+        self.bulk_create(line_items)
+        return len(line_items)
+
+
+class SubscriptionManager(models.Manager):
+    """
+        Manager class for Subscription, to find the subscriptions that need billing.
+    """
+
+    def due(self, now=None):
+        """
+            Subscriptions with a billing period or a retry that is due.
+        """
+        if now is None:
+            now = timezone.now()
+        return self.filter(
+            Q(status='active', next_billing_date__lte=now) |
+            Q(status='past_due', retry_at__lte=now)
+        )
+
+
+class BalanceSnapshotManager(models.Manager):
+    """
+        Manager class for BalanceSnapshot, records and downsamples account balances.
+    """
+
+    def record(self, environments=None, max_workers=4, now=None):
+        """
+            Fetches the balances of the given environments (by default every one in
+            PIN_ENVIRONMENTS) concurrently, and inserts a snapshot per environment and
+            currency, all recorded at the same time.
+
+            Returns the new snapshots. Environments whose balances could not be fetched are
+            logged and skipped.
+        """
+        if environments is None:
+            environments = sorted(getattr(settings, 'PIN_ENVIRONMENTS', {}))
+        if now is None:
+            now = timezone.now()
+
+        def fetch(name):
+            return PinEnvironment.get(name).get_balances(use_cache=False)
+
+        snapshots = []
+        for name, balances, error in concurrent_map(fetch, environments, max_workers):
+            if error is not None:
+                logger.error("Unable to record the balances of environment {0}: {1}".format(name, error))
+                continue
+            for currency, (available, pending) in sorted(balances.items()):
+                snapshots.append(self.model(
+                    environment=name,
+                    currency=currency,
+                    available=None if available is None else int(available),
+                    pending=None if pending is None else int(pending),
+                    recorded=now,
+                ))
+        self.bulk_create(snapshots)
+        return snapshots
+
+    def downsample(self, now=None, raw_days=None, hourly_days=None, retention_days=None):
+        """
+            Thins out old snapshots: after raw_days only the last snapshot of each hour is
+            kept, after hourly_days the last of each day, and after retention_days none.
+            The defaults come from the PIN_BALANCE_RAW_DAYS (2), PIN_BALANCE_HOURLY_DAYS
+            (35) and PIN_BALANCE_RETENTION_DAYS (400) settings.
+
+            Returns the number of snapshots deleted.
+        """
+        if now is None:
+            now = timezone.now()
+        if raw_days is None:
+            raw_days = getattr(settings, 'PIN_BALANCE_RAW_DAYS', 2)
+        if hourly_days is None:
+            hourly_days = getattr(settings, 'PIN_BALANCE_HOURLY_DAYS', 35)
+        if retention_days is None:
+            retention_days = getattr(settings, 'PIN_BALANCE_RETENTION_DAYS', 400)
+
+        deleted = self.filter(recorded__lt=now - timedelta(days=retention_days)).delete()[0]
+        # (bucket, start, end, window): windows keep the lists of snapshots to keep short
+        periods = (
+            (TruncHour, now - timedelta(days=hourly_days), now - timedelta(days=raw_days), timedelta(days=1)),
+            (TruncDay, now - timedelta(days=retention_days), now - timedelta(days=hourly_days),
+             timedelta(days=30)),
+        )
+        for trunc, start, end, window in periods:
+            # start at midnight, so buckets don't straddle windows
+            if timezone.is_aware(start):
+                start = timezone.localtime(start)
+            start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+            while start < end:
+                snapshots = self.filter(recorded__gte=start, recorded__lt=min(start + window, end))
+                keep = list(
+                    snapshots.annotate(bucket=trunc('recorded'))
+                    .values('environment', 'currency', 'bucket')
+                    .annotate(last=Max('pk'))
+                    .order_by()
+                    .values_list('last', flat=True)
+                )
+                if keep:
+                    deleted += snapshots.exclude(pk__in=keep).delete()[0]
+                start += window
+        return deleted
+
+
+# Whether each type of charge event means the charge succeeded
+CHARGE_EVENTS = {
+    'charge.authorised': True,
+    'charge.captured': True,
+    'charge.failed': False,
+}
+
+
+class PinEventManager(models.Manager):
+    """
+        Manager class for PinEvent, stores events from Pin and applies them in batches.
+    """
+
+    def from_data(self, environment, data, payload=None):
+        """
+            Returns an unsaved event from its JSON data, an event object from Pin.
+            payload is the JSON text stored, by default data serialized.
+        """
+        if not data.get('token'):
+            raise ValueError("Event has no token")
+        created_at = data.get('created_at')
+        return self.model(
+            token=data['token'],
+            environment=environment,
+            event_type=data.get('type') or '',
+            created_at=parse_datetime(created_at) if created_at else None,
+            payload=json.dumps(data) if payload is None else payload,
+        )
+
+    def record(self, environment, body):
+        """
+            Stores an event from the JSON text Pin sent, with a single insert.
+            Returns (event, created): created is False for an event already stored, eg
+            one Pin delivered again. Raises ValueError if body isn't an event.
+        """
+        data = json.loads(body)
+        if not isinstance(data, dict):
+            raise ValueError("Event is not a JSON object")
+        event = self.from_data(environment, data, body)
+        try:
+            with transaction.atomic(using=self.db):
+                event.save(force_insert=True, using=self.db)
+        except IntegrityError:
+            return event, False
+        return event, True
+
+    def poll(self, environment=None, max_pages=None, process=True):
+        """
+            Fetches the events Pin recorded since the last poll of the environment from
+            /events, newest first, stopping at the first page reaching the cursor kept in
+            the 'pinpayments:events:{environment}' Checkpoint. max_pages limits how far
+            back a first poll goes.
+
+            Stores the events not already stored, eg by the webhook, with a query to find
+            them and a bulk insert, then moves the cursor, and with process applies the
+            pending events. Returns the number of events stored.
+        """
+        Checkpoint = apps.get_model('pinpayments', 'Checkpoint')
+        pin_env = environment if isinstance(environment, PinEnvironment) else PinEnvironment.get(environment)
+        checkpoint, _created = Checkpoint.objects.get_or_create(
+            name='pinpayments:events:{0}'.format(pin_env.name)
+        )
+        cursor = json.loads(checkpoint.value) if checkpoint.value else {}
+
+        fetched = []
+        page = 1
+        while page and (max_pages is None or page <= max_pages):
+            response_json = pin_env.pin_get("/events?page={0}".format(page))[1]
+            reached = False
+            for data in response_json['response']:
+                if data.get('token') == cursor.get('token') or (
+                        cursor.get('created_at') and (data.get('created_at') or '') < cursor['created_at']):
+                    reached = True
+                    break
+                fetched.append(data)
+            if reached:
+                break
+            page = response_json.get('pagination', {}).get('next')
+
+        stored = 0
+        if fetched:
+            # oldest first, so events are applied in the order they happened
+            fetched.reverse()
+            with transaction.atomic(using=self.db):
+                existing = set(self.filter(token__in=[data.get('token') for data in fetched]).values_list(
+                    'token', flat=True
+                ))
+                events = []
+                for data in fetched:
+                    if data.get('token') and data['token'] not in existing:
+                        existing.add(data['token'])
+                        events.append(self.from_data(pin_env.name, data))
+                try:
+                    with transaction.atomic(using=self.db):
+                        self.bulk_create(events)
+                    stored = len(events)
+                except IntegrityError:
+                    # the webhook stored some of them meanwhile
+                    for event in events:
+                        try:
+                            with transaction.atomic(using=self.db):
+                                event.save(force_insert=True, using=self.db)
+                            stored += 1
+                        except IntegrityError:
+                            pass
+                newest = fetched[-1]
+                checkpoint.value = json.dumps({'token': newest['token'], 'created_at': newest.get('created_at')})
+                checkpoint.save()
+
+        if process:
+            self.process_pending(environment=pin_env.name)
+        return stored
+
+    def process_pending(self, batch_size=500, environment=None):
+        """
+            Applies the events not processed yet, oldest first, batch_size at a time.
+            Batches are locked, skipping those locked by other processors where the
+            database supports it, so several processors can run at once.
+
+            Returns the number of events processed.
+        """
+        connection = connections[router.db_for_write(self.model)]
+        processed = 0
+        while True:
+            with transaction.atomic(using=connection.alias):
+                queryset = self.using(connection.alias).filter(processed__isnull=True).order_by('pk')
+                if environment is not None:
+                    queryset = queryset.filter(environment=environment)
+                # a feature of Django 1.11 backends, assume third party ones lack it
+                if getattr(connection.features, 'has_select_for_update_skip_locked', False):
+                    queryset = queryset.select_for_update(skip_locked=True)
+                events = list(queryset[:batch_size])
+                if not events:
+                    return processed
+                self.apply_events(events)
+            processed += len(events)
+
+    def apply_events(self, events):
+        """
+            Applies a batch of events, in order, and marks them processed. Charge events
+            update PinTransaction, transfer events PinTransfer and customer or card events
+            CardToken, a query or so per model rather than per event. Other events, eg
+            disputes, are only stored. Events that can't be applied record the error.
+        """
+        charges = {}
+        transfers = {}
+        cards = {}
+        errors = {}
+        for event in events:
+            try:
+                data = json.loads(event.payload).get('data') or {}
+                if event.event_type in CHARGE_EVENTS:
+                    charges[data['token']] = (CHARGE_EVENTS[event.event_type], data)
+                elif event.event_type.startswith('transfer.'):
+                    transfers[data['token']] = data['status']
+                elif event.event_type.startswith('customer.') and data.get('card'):
+                    cards[data['card']['token']] = data['card']
+                elif event.event_type.startswith('card.'):
+                    cards[data['token']] = data
+            except (AttributeError, KeyError, TypeError, ValueError) as error:
+                errors[event.pk] = "Invalid event data: {0!r}".format(error)
+
+        self._apply_charges(charges)
+        self._apply_transfers(transfers)
+        self._apply_cards(cards)
+
+        now = timezone.now()
+        self.filter(pk__in=[event.pk for event in events if event.pk not in errors]).update(processed=now)
+        for pk, error in errors.items():
+            logger.warning("Unable to apply Pin event {0}: {1}".format(pk, error))
+            self.filter(pk=pk).update(processed=now, error=error)
+
+    def _apply_charges(self, charges):
+        PinTransaction = apps.get_model('pinpayments', 'PinTransaction')
+        transactions = PinTransaction.objects.filter(transaction_token__in=list(charges))
+        changes = {}
+        # the transactions whose outcome the events change, for charge_succeeded and charge_failed
+        outcomes = {}
+        for pk, token, currency, was_processed, was_succeeded, was_response in transactions.values_list(
+            'pk', 'transaction_token', 'currency', 'processed', 'succeeded', 'pin_response'
+        ):
+            succeeded, data = charges[token]
+            changes[pk] = {
+                'processed': True,
+                'succeeded': bool(data.get('success', succeeded)),
+                'pin_response': (data.get('status_message') or data.get('error_message') or '')[:255],
+            }
+            if data.get('total_fees') is not None:
+                changes[pk]['fees'] = get_value(data['total_fees'], data.get('currency') or currency)
+            # a processed transaction without a response was sent but its outcome is unknown
+            if not (was_processed and (was_succeeded or was_response)) or \
+                    was_succeeded != changes[pk]['succeeded']:
+                outcomes[pk] = changes[pk]['succeeded']
+        update_by_pk(PinTransaction.objects.all(), changes)
+
+        if outcomes and (signals.charge_succeeded.has_listeners(PinTransaction) or
+                         signals.charge_failed.has_listeners(PinTransaction)):
+            for transaction in PinTransaction.objects.filter(pk__in=list(outcomes)):
+                signals.dispatch(
+                    signals.charge_succeeded if transaction.succeeded else signals.charge_failed,
+                    PinTransaction, transaction=transaction
+                )
+
+    def _apply_transfers(self, transfers):
+        PinTransfer = apps.get_model('pinpayments', 'PinTransfer')
+        PinTransfer.objects.apply_statuses(dict(
+            (pk, transfers[token])
+            for pk, token in PinTransfer.objects.filter(
+                transfer_token__in=list(transfers)
+            ).values_list('pk', 'transfer_token')
+        ))
+
+    def _apply_cards(self, cards):
+        CardToken = apps.get_model('pinpayments', 'CardToken')
+        for card in CardToken.objects.filter(token__in=list(cards)):
+            CardToken.objects.update_card_from_data(card, cards[card.token])
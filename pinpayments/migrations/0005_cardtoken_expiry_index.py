@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0004_auto_20150519_0525'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='cardtoken',
+            index_together=set([('expiry_year', 'expiry_month')]),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0005_cardtoken_expiry_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Identifies the job and run this checkpoint belongs to', max_length=100, unique=True, verbose_name='Name')),
+                ('value', models.CharField(blank=True, help_text='Position reached by the job, in a format of its choosing', max_length=255, verbose_name='Value')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Updated')),
+            ],
+        ),
+    ]
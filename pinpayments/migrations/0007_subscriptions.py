@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0006_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Plan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='Name')),
+                ('description', models.CharField(blank=True, help_text='Description sent to Pin with each charge. Defaults to the name.', max_length=255, verbose_name='Description')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Amount (Dollars)')),
+                ('currency', models.CharField(default='AUD', help_text='Currency charges are processed in', max_length=100, verbose_name='Currency')),
+                ('interval', models.CharField(choices=[('day', 'Day'), ('week', 'Week'), ('month', 'Month'), ('year', 'Year')], default='month', max_length=10, verbose_name='Interval')),
+                ('interval_count', models.PositiveIntegerField(default=1, help_text='Number of intervals between charges', verbose_name='Interval count')),
+                ('active', models.BooleanField(default=True, verbose_name='Active')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Subscription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('active', 'Active'), ('past_due', 'Past due'), ('unpaid', 'Unpaid'), ('cancelled', 'Cancelled')], default='active', max_length=20, verbose_name='Status')),
+                ('email_address', models.EmailField(help_text='As passed to Pin.', max_length=100, verbose_name='E-Mail Address')),
+                ('ip_address', models.GenericIPAddressField(help_text='IP Address the customer subscribed from')),
+                ('next_billing_date', models.DateTimeField(help_text='Start of the next billing period, when it will be charged', verbose_name='Next billing date')),
+                ('retry_at', models.DateTimeField(blank=True, help_text='When a failed charge for the current period will be retried', null=True, verbose_name='Retry at')),
+                ('failed_attempts', models.PositiveIntegerField(default=0, help_text='Failed charges for the current billing period', verbose_name='Failed attempts')),
+                ('lease_owner', models.CharField(blank=True, help_text='The scheduler process currently billing this subscription', max_length=100)),
+                ('lease_expires', models.DateTimeField(blank=True, help_text='Other schedulers may take over the subscription after this time', null=True)),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('customer_token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pinpayments.CustomerToken')),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pinpayments.Plan')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='pintransaction',
+            name='subscription',
+            field=models.ForeignKey(blank=True, help_text='The subscription this transaction bills, if any', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transactions', to='pinpayments.Subscription'),
+        ),
+        migrations.AlterIndexTogether(
+            name='subscription',
+            index_together=set([('status', 'retry_at'), ('status', 'next_billing_date')]),
+        ),
+    ]
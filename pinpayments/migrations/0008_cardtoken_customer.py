@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0007_subscriptions'),
+    ]
+
+    operations = [
+        # The reverse accessor is named 'cards' once CustomerToken.cards is
+        # removed in 0010_remove_customertoken_cards.
+        migrations.AddField(
+            model_name='cardtoken',
+            name='customer',
+            field=models.ForeignKey(blank=True, help_text='The customer this card is stored against', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pinpayments.CustomerToken'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from itertools import groupby
+
+from django.db import migrations
+
+CHUNK_SIZE = 2000
+
+
+def move_cards_to_customer_fk(apps, schema_editor):
+    """
+    Copies the CustomerToken.cards links to CardToken.customer, a chunk of
+    links at a time, with one UPDATE per customer in each chunk.
+    A card linked to several customers ends up with the last of them.
+    """
+    CustomerToken = apps.get_model("pinpayments", "CustomerToken")
+    CardToken = apps.get_model("pinpayments", "CardToken")
+    links = CustomerToken.cards.through.objects.order_by('pk').values_list(
+        'pk', 'customertoken_id', 'cardtoken_id'
+    )
+    last_pk = 0
+    while True:
+        chunk = sorted(links.filter(pk__gt=last_pk)[:CHUNK_SIZE], key=lambda link: link[1])
+        if not chunk:
+            return
+        for customer_id, customer_links in groupby(chunk, lambda link: link[1]):
+            CardToken.objects.filter(
+                pk__in=[link[2] for link in customer_links]
+            ).update(customer=customer_id)
+        last_pk = max(link[0] for link in chunk)
+
+
+def move_cards_to_customer_m2m(apps, schema_editor):
+    """ Recreates the CustomerToken.cards links, a chunk of cards at a time """
+    CustomerToken = apps.get_model("pinpayments", "CustomerToken")
+    CardToken = apps.get_model("pinpayments", "CardToken")
+    Link = CustomerToken.cards.through
+    cards = CardToken.objects.filter(customer__isnull=False).order_by('pk').values_list(
+        'pk', 'customer_id'
+    )
+    last_pk = 0
+    while True:
+        chunk = list(cards.filter(pk__gt=last_pk)[:CHUNK_SIZE])
+        if not chunk:
+            return
+        Link.objects.bulk_create([
+            Link(customertoken_id=customer_id, cardtoken_id=card_id)
+            for card_id, customer_id in chunk
+        ])
+        last_pk = chunk[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0008_cardtoken_customer'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_cards_to_customer_fk, move_cards_to_customer_m2m),
+    ]
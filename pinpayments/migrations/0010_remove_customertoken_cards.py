@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0009_move_customertoken_cards_to_cardtoken_customer'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='customertoken',
+            name='cards',
+        ),
+        migrations.AlterField(
+            model_name='cardtoken',
+            name='customer',
+            field=models.ForeignKey(blank=True, help_text='The customer this card is stored against', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='cards', to='pinpayments.CustomerToken'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0010_remove_customertoken_cards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pintransfer',
+            name='batch_reference',
+            field=models.CharField(blank=True, db_index=True, help_text='The payout batch this transfer was sent in, if any', max_length=100, null=True, verbose_name='Batch reference'),
+        ),
+    ]
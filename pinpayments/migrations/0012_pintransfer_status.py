@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0011_pintransfer_batch_reference'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pintransfer',
+            name='status',
+            field=models.CharField(blank=True, help_text='Status of transfer when last sent or refreshed from Pin', max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0012_pintransfer_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PinTransferLineItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField(help_text='Order of this line item in the transfer', verbose_name='Position')),
+                ('line_item_type', models.CharField(blank=True, help_text='Kind of line item, eg charge, refund or adjustment', max_length=50, verbose_name='Type')),
+                ('amount', models.IntegerField(help_text='Line item amount, in the base unit of the currency (e.g.: cents for AUD, yen for JPY)')),
+                ('currency', models.CharField(blank=True, max_length=10, verbose_name='Currency')),
+                ('created_at', models.DateTimeField(blank=True, help_text='Time Pin created the line item', null=True, verbose_name='Created at')),
+                ('record_object', models.CharField(blank=True, help_text='Type of the Pin object the line item is for, eg charge', max_length=50, verbose_name='Record type')),
+                ('record_token', models.CharField(blank=True, db_index=True, help_text='Token of the Pin object the line item is for', max_length=100, verbose_name='Record token')),
+                ('transaction', models.ForeignKey(blank=True, help_text='The charge this line item is for, if it is in the database', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transfer_line_items', to='pinpayments.PinTransaction')),
+                ('transfer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='line_items', to='pinpayments.PinTransfer')),
+            ],
+            options={
+                'ordering': ['transfer', 'position'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='pintransferlineitem',
+            unique_together=set([('transfer', 'position')]),
+        ),
+    ]
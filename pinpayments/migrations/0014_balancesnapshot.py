@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0013_pintransferlineitem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('environment', models.CharField(help_text='The name of the Pin environment, eg test or live.', max_length=25)),
+                ('currency', models.CharField(max_length=10, verbose_name='Currency')),
+                ('available', models.BigIntegerField(blank=True, help_text='Available balance, in the base unit of the currency', null=True, verbose_name='Available')),
+                ('pending', models.BigIntegerField(blank=True, help_text='Pending balance, in the base unit of the currency', null=True, verbose_name='Pending')),
+                ('recorded', models.DateTimeField(db_index=True, verbose_name='Recorded')),
+            ],
+            options={
+                'ordering': ['-recorded'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='balancesnapshot',
+            index_together=set([('environment', 'currency', 'recorded')]),
+        ),
+    ]
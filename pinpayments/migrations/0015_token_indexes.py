@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0014_balancesnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cardtoken',
+            name='token',
+            field=models.CharField(db_index=True, help_text='Generated by Card API or Customers API', max_length=100, verbose_name='Token'),
+        ),
+        migrations.AlterField(
+            model_name='customertoken',
+            name='token',
+            field=models.CharField(db_index=True, help_text='Generated by Card API or Customers API', max_length=100, verbose_name='Token'),
+        ),
+        migrations.AlterField(
+            model_name='pintransaction',
+            name='card_token',
+            field=models.CharField(blank=True, db_index=True, help_text='Card token used for this transaction (Card API and Web Forms)', max_length=40, null=True, verbose_name='Pin API Card Token'),
+        ),
+    ]
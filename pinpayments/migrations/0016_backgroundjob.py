@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0015_token_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackgroundJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(help_text='Name of the action, see pinpayments.jobs.JOB_ACTIONS', max_length=50, verbose_name='Action')),
+                ('object_ids', models.TextField(help_text='JSON list of the primary keys to process', verbose_name='Object ids')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('finished', 'Finished')], default='pending', max_length=20, verbose_name='Status')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Total')),
+                ('succeeded', models.PositiveIntegerField(default=0, verbose_name='Succeeded')),
+                ('failed', models.PositiveIntegerField(default=0, verbose_name='Failed')),
+                ('errors', models.TextField(blank=True, help_text='The first errors, one per line', verbose_name='Errors')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='Finished')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
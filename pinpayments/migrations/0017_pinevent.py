@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0016_backgroundjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PinEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(help_text='Unique ID from Pin for this event', max_length=100, unique=True, verbose_name='Pin API Event Token')),
+                ('environment', models.CharField(help_text='The name of the Pin environment, eg test or live.', max_length=25)),
+                ('event_type', models.CharField(help_text='eg charge.captured', max_length=100, verbose_name='Type')),
+                ('created_at', models.DateTimeField(blank=True, help_text='Time Pin created the event', null=True, verbose_name='Created at')),
+                ('received', models.DateTimeField(auto_now_add=True, verbose_name='Received')),
+                ('payload', models.TextField(help_text='The event as received, in JSON', verbose_name='Payload')),
+                ('processed', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Processed')),
+                ('error', models.TextField(blank=True, help_text='Why the event could not be applied, if it could not', verbose_name='Error')),
+            ],
+            options={
+                'ordering': ['-received'],
+            },
+        ),
+    ]
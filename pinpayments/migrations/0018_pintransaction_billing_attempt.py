@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0017_pinevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pintransaction',
+            name='billing_attempt',
+            field=models.PositiveIntegerField(blank=True, help_text='Which attempt at billing the period this transaction is', null=True),
+        ),
+        migrations.AddField(
+            model_name='pintransaction',
+            name='billing_period',
+            field=models.DateTimeField(blank=True, help_text='The next billing date of the subscription this transaction bills', null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pintransaction',
+            unique_together=set([('subscription', 'billing_period', 'billing_attempt')]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0018_pintransaction_billing_attempt'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='pintransfer',
+            unique_together=set([('batch_reference', 'recipient', 'currency')]),
+        ),
+    ]
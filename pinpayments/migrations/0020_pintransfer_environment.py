@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0019_pintransfer_batch_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pintransfer',
+            name='environment',
+            field=models.CharField(blank=True, db_index=True, help_text='The name of the Pin environment the transfer was sent from, eg test or live.', max_length=25),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0020_pintransfer_environment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, help_text='Last time the job saved its progress', verbose_name='Updated'),
+        ),
+        migrations.AlterField(
+            model_name='backgroundjob',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], default='pending', max_length=20, verbose_name='Status'),
+        ),
+    ]
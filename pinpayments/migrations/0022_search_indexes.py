@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinpayments', '0021_backgroundjob_updated'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pinrecipient',
+            name='email',
+            field=models.EmailField(db_index=True, help_text='As passed to Pin.', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='pinrecipient',
+            name='name',
+            field=models.CharField(blank=True, db_index=True, help_text='Optional. The name by which the recipient is referenced', max_length=100, null=True),
+        ),
+        migrations.AlterField(
+            model_name='pintransaction',
+            name='email_address',
+            field=models.EmailField(db_index=True, help_text='As passed to Pin.', max_length=100, verbose_name='E-Mail Address'),
+        ),
+    ]
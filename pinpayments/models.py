@@ -3,26 +3,27 @@ Models for interacting with Pin, and storing results
 """
 from __future__ import unicode_literals
 
-from datetime import datetime
+from calendar import monthrange
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 from decimal import Decimal
-from pinpayments import logger
+from pinpayments import cache, logger, signals
 import warnings
 
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.timezone import get_default_timezone
 from django.utils.translation import ugettext_lazy as _
 
-from pinpayments.exceptions import ConfigError, PinError
-from pinpayments.managers import CardTokenManager, CustomerTokenManager
+from pinpayments.exceptions import ConfigError, PinError, PinResponseError
+from pinpayments.managers import (
+    BalanceSnapshotManager, CardTokenManager, CustomerTokenManager, PinEventManager, PinRecipientManager,
+    PinTransactionManager, PinTransferLineItemManager, PinTransferManager, SubscriptionManager
+)
 from pinpayments.objects import PinEnvironment
-from pinpayments.utils import get_value
-
-
-if getattr(settings, 'PIN_ENVIRONMENTS', {}) == {}:
-    raise ConfigError("PIN_ENVIRONMENTS not defined.")
+from pinpayments.utils import add_months, concurrent_map, get_base_amount, get_value
 
 property_deprecation_warning_message = \
     """This property accessor method will be removed in a future version. """ \
@@ -38,6 +39,37 @@ CARD_TYPES = (
     ('visa', 'Visa'),
 )
 
+# Statuses of PinTransfers in a batch that have not (yet) been accepted by Pin
+TRANSFER_NEW = 'new'
+TRANSFER_SENDING = 'sending'
+TRANSFER_ERROR = 'error'
+
+PLAN_INTERVAL_CHOICES = (
+    ('day', _('Day')),
+    ('week', _('Week')),
+    ('month', _('Month')),
+    ('year', _('Year')),
+)
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_FINISHED = 'finished'
+JOB_FAILED = 'failed'
+
+JOB_STATUS_CHOICES = (
+    (JOB_PENDING, _('Pending')),
+    (JOB_RUNNING, _('Running')),
+    (JOB_FINISHED, _('Finished')),
+    (JOB_FAILED, _('Failed')),
+)
+
+SUBSCRIPTION_STATUS_CHOICES = (
+    ('active', _('Active')),
+    ('past_due', _('Past due')),
+    ('unpaid', _('Unpaid')),
+    ('cancelled', _('Cancelled')),
+)
+
 
 @python_2_unicode_compatible
 class CardTokenAbstract(models.Model):
@@ -51,7 +83,7 @@ class CardTokenAbstract(models.Model):
     )
 
     token = models.CharField(
-        _('Token'), max_length=100,
+        _('Token'), max_length=100, db_index=True,
         help_text=_('Generated by Card API or Customers API')
     )
     scheme = models.CharField(
@@ -102,10 +134,21 @@ class CardTokenAbstract(models.Model):
     class Meta:
         abstract = True
         ordering = ['created']
+        index_together = [('expiry_year', 'expiry_month')]
 
     def __str__(self):
         return "{0}".format(self.token)
 
+    def save(self, *args, **kwargs):
+        super(CardTokenAbstract, self).save(*args, **kwargs)
+        cache.invalidate_on_commit(self.__class__, self.token, using=self._state.db)
+
+    def delete(self, *args, **kwargs):
+        using = self._state.db
+        result = super(CardTokenAbstract, self).delete(*args, **kwargs)
+        cache.invalidate_on_commit(self.__class__, self.token, using=using)
+        return result
+
     @property
     def expiry_str(self):
         if None in (self.expiry_month, self.expiry_year):
@@ -114,21 +157,39 @@ class CardTokenAbstract(models.Model):
 
     @property
     def has_expired(self):
+        """
+            Python equivalent of CardToken.objects.expired(), for a single instance.
+        """
+        if None in (self.expiry_month, self.expiry_year):
+            return False
         today = timezone.now().date()
 
         # constructed dates below are the first day upon which the credit card has expired.
         if self.expiry_month < 12:
             # Months 1-11
-            return today >= datetime.date(self.expiry_year, self.expiry_month + 1, 1)
+            return today >= date(self.expiry_year, self.expiry_month + 1, 1)
         # Month 12
-        return today >= datetime.date(self.expiry_year + 1, 1, 1)
+        return today >= date(self.expiry_year + 1, 1, 1)
 
 
 class CardToken(CardTokenAbstract):
     """
         Implements the CardToken model as non abstract.
     """
-    pass
+    customer = models.ForeignKey(
+        'CustomerToken', blank=True, null=True, related_name='cards',
+        on_delete=models.SET_NULL,
+        help_text=_('The customer this card is stored against')
+    )
+
+    @property
+    def customertoken_set(self):
+        """
+            Cards used to be linked to customers with a many to many field on CustomerToken.
+            This is a backwards compatibility accessor, use .customer instead.
+        """
+        warnings.warn(property_deprecation_warning_message, DeprecationWarning)
+        return CustomerToken.objects.filter(pk=self.customer_id)
 
 
 @python_2_unicode_compatible
@@ -142,20 +203,22 @@ class CustomerTokenAbstract(models.Model):
     You can use this class to implement you own CustomToken to model type other than
     the user auth model, or you can use the CustomerToken implementation below this
     class which is already FK-ed to the User auth model specified in your settings.py
+
+    Subclasses must provide a `cards` relation to CardToken. CustomerToken gets
+    one from the CardToken.customer foreign key; other implementations can declare
+    `cards = models.ManyToManyField(CardToken, blank=True)`.
     """
     environment = models.CharField(
         max_length=25, db_index=True, blank=True,
         help_text=_('The name of the Pin environment to use, eg test or live.')
     )
     token = models.CharField(
-        _('Token'), max_length=100,
+        _('Token'), max_length=100, db_index=True,
         help_text=_('Generated by Card API or Customers API')
     )
     created = models.DateTimeField(_('Created'), auto_now_add=True)
     active = models.BooleanField(_('Active'), default=True)
 
-    cards = models.ManyToManyField(CardToken, blank=True)
-
     objects = CustomerTokenManager()
 
     class Meta:
@@ -171,7 +234,7 @@ class CustomerTokenAbstract(models.Model):
         except CardToken.MultipleObjectsReturned:
             logger.warning("CustomerToken: {0} has more than one CardToken ".format(self.token) +
                            "with primary=True, you should synchronize this customer's card tokens.")
-            return self.cards.filter(primary=True)[:1][0]  # equivalent to .first() but supports Django 1.5
+            return self.cards.filter(primary=True).first()
         except CardToken.DoesNotExist:
             pass
         return None
@@ -208,6 +271,17 @@ class CustomerTokenAbstract(models.Model):
         if not self.environment:
             self.environment = getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
         super(CustomerTokenAbstract, self).save(*args, **kwargs)
+        cache.invalidate_on_commit(self.__class__, self.token, using=self._state.db)
+
+    def delete(self, *args, **kwargs):
+        # deleting the customer detaches its cards without saving them
+        cards = self.cards.all()
+        card_tokens = list(cards.values_list('token', flat=True))
+        using = self._state.db
+        result = super(CustomerTokenAbstract, self).delete(*args, **kwargs)
+        cache.invalidate_on_commit(self.__class__, self.token, using=using)
+        cache.invalidate_on_commit(cards.model, *card_tokens, using=using)
+        return result
 
     def new_card_token(self, card_token):
         """ Placeholder to retain name and functionality of old method """
@@ -216,7 +290,7 @@ class CustomerTokenAbstract(models.Model):
 
     def update_card(self, card_token):
         """ Provide a card token to update the details for this customer """
-        pin_env = PinEnvironment(self.environment)
+        pin_env = PinEnvironment.get(self.environment)
         payload = {'card_token': card_token}
         url_tail = "/customers/{1}".format(self.token)
         data = pin_env.pin_put(url_tail, payload)[1]['response']
@@ -234,6 +308,9 @@ class CustomerTokenAbstract(models.Model):
     def set_primary_card(self, card):
         return self._meta.default_manager.set_primary_card_for_customer(self, card)
 
+    def refresh_cards(self):
+        return self._meta.default_manager.refresh_cards_for_customer(self)
+
     @classmethod
     def create_from_card_token(cls, card_token, user, environment=''):
         # TODO: Remove when dropping Django 1.6 support
@@ -307,7 +384,7 @@ class PinTransaction(models.Model):
     )
     card_token = models.CharField(
         _('Pin API Card Token'), max_length=40, blank=True, null=True,
-        help_text=_(
+        db_index=True, help_text=_(
             'Card token used for this transaction (Card API and Web Forms)'
         )
     )
@@ -315,6 +392,19 @@ class PinTransaction(models.Model):
         CustomerToken, blank=True, null=True,
         help_text=_('Provided by Customer API')
     )
+    subscription = models.ForeignKey(
+        'Subscription', blank=True, null=True, related_name='transactions',
+        on_delete=models.SET_NULL,
+        help_text=_('The subscription this transaction bills, if any')
+    )
+    billing_period = models.DateTimeField(
+        blank=True, null=True,
+        help_text=_('The next billing date of the subscription this transaction bills')
+    )
+    billing_attempt = models.PositiveIntegerField(
+        blank=True, null=True,
+        help_text=_('Which attempt at billing the period this transaction is')
+    )
     pin_response = models.CharField(
         _('API Response'), max_length=255, blank=True, null=True,
         help_text=_('Response text, usually Success!')
@@ -323,7 +413,7 @@ class PinTransaction(models.Model):
         help_text=_('IP Address used for payment')
     )
     email_address = models.EmailField(
-        _('E-Mail Address'), max_length=100, help_text=_('As passed to Pin.')
+        _('E-Mail Address'), max_length=100, db_index=True, help_text=_('As passed to Pin.')
     )
     card_address1 = models.CharField(
         _('Cardholder Street Address'), max_length=100, blank=True, null=True,
@@ -359,6 +449,8 @@ class PinTransaction(models.Model):
         help_text=_('The full JSON response from the Pin API')
     )
 
+    objects = PinTransactionManager()
+
     def save(self, *args, **kwargs):
         if not (self.card_token or self.customer_token):
             raise PinError("Must provide card_token or customer_token")
@@ -369,7 +461,11 @@ class PinTransaction(models.Model):
         if not self.environment:
             self.environment = getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
 
-        if self.environment not in getattr(settings, 'PIN_ENVIRONMENTS', {}):
+        try:
+            PinEnvironment.get(self.environment)
+        except ConfigError:
+            if self.environment in getattr(settings, 'PIN_ENVIRONMENTS', {}):
+                raise  # defined, but incorrectly
             raise PinError("Pin Environment '{0}' does not exist".format(self.environment))
 
         if not self.date:
@@ -387,19 +483,22 @@ class PinTransaction(models.Model):
         verbose_name = 'PIN.net.au Transaction'
         verbose_name_plural = 'PIN.net.au Transactions'
         ordering = ['-date']
+        unique_together = [('subscription', 'billing_period', 'billing_attempt')]
 
     def process_transaction(self):
         """ Send the data to Pin for processing """
         if self.processed:
             return None  # can only attempt to process once.
+        # sent straight away, so a receiver can stop the charge by raising
+        signals.pre_charge.send(sender=self.__class__, transaction=self)
         self.processed = True
         self.save()
 
-        pin_env = PinEnvironment(self.environment)
+        pin_env = PinEnvironment.get(self.environment)
         payload = {
             'email': self.email_address,
             'description': self.description,
-            'amount': int(self.amount * 100),
+            'amount': get_base_amount(self.amount, self.currency),
             'currency': self.currency,
             'ip_address': self.ip_address,
         }
@@ -428,7 +527,7 @@ class PinTransaction(models.Model):
             data = response_json['response']
             self.succeeded = True
             self.transaction_token = data['token']
-            self.fees = data['total_fees'] / Decimal("100.00")
+            self.fees = get_value(data['total_fees'], self.currency)
             self.pin_response = data['status_message']
             self.card_address1 = data['card']['address_line1']
             self.card_address2 = data['card']['address_line2']
@@ -439,6 +538,26 @@ class PinTransaction(models.Model):
             self.card_number = data['card']['display_number']
             self.card_type = data['card']['scheme']
 
+        self.save()
+        signals.dispatch(
+            signals.charge_succeeded if self.succeeded else signals.charge_failed,
+            self.__class__, transaction=self
+        )
+        return self.pin_response
+
+    def resync(self):
+        """ Updates the outcome of a processed transaction from Pin's record of the charge """
+        if not self.transaction_token:
+            raise PinError("Transaction {0} has no charge token to resync".format(self.pk))
+        pin_env = PinEnvironment.get(self.environment)
+        response, response_json = pin_env.pin_get("/charges/{0}".format(self.transaction_token))
+        data = response_json['response']
+        self.processed = True
+        self.succeeded = bool(data.get('success'))
+        self.pin_response = data.get('status_message')
+        if data.get('total_fees') is not None:
+            self.fees = get_value(data['total_fees'], self.currency)
+        self.pin_response_text = response.text
         self.save()
         return self.pin_response
 
@@ -488,9 +607,9 @@ class PinRecipient(models.Model):
         max_length=40, db_index=True,
         help_text=_("A recipient token provided by Pin")
     )
-    email = models.EmailField(max_length=100, help_text=_('As passed to Pin.'))
+    email = models.EmailField(max_length=100, db_index=True, help_text=_('As passed to Pin.'))
     name = models.CharField(
-        max_length=100, blank=True, null=True,
+        max_length=100, blank=True, null=True, db_index=True,
         help_text=_("Optional. The name by which the recipient is referenced")
     )
     created = models.DateTimeField(_("Time created"), auto_now_add=True)
@@ -502,38 +621,27 @@ class PinRecipient(models.Model):
         help_text=_('The name of the Pin environment to use, eg test or live.')
     )
 
+    objects = PinRecipientManager()
+
     def __str__(self):
         return "{0}".format(self.token)
 
+    def save(self, *args, **kwargs):
+        super(PinRecipient, self).save(*args, **kwargs)
+        cache.invalidate_on_commit(self.__class__, self.token, using=self._state.db)
+
+    def delete(self, *args, **kwargs):
+        using = self._state.db
+        result = super(PinRecipient, self).delete(*args, **kwargs)
+        cache.invalidate_on_commit(self.__class__, self.token, using=using)
+        return result
+
     @classmethod
-    def create_with_bank_account(cls, email, account_name, bsb, number, name=""):
+    def create_with_bank_account(cls, email, account_name, bsb, number, name="", environment=None):
         """ Creates a new recipient from a provided bank account's details """
-        pin_env = PinEnvironment()
-        payload = {
-            'email': email,
-            'name': name,
-            'bank_account[name]': account_name,
-            'bank_account[bsb]': bsb,
-            'bank_account[number]': number
-        }
-        data = pin_env.pin_post('/recipients', payload)[1]['response']
-        bank_account = BankAccount.objects.create(
-            bank_name=data['bank_account']['bank_name'],
-            branch=data['bank_account']['branch'],
-            bsb=data['bank_account']['bsb'],
-            name=data['bank_account']['name'],
-            number=data['bank_account']['number'],
-            token=data['bank_account']['token'],
-            environment=pin_env.name,
-        )
-        new_recipient = cls.objects.create(
-            token=data['token'],
-            email=data['email'],
-            name=data['name'],
-            bank_account=bank_account,
-            environment=pin_env.name,
+        return cls.objects.create_with_bank_account(
+            email, account_name, bsb, number, name=name, environment=environment
         )
-        return new_recipient
 
 
 @python_2_unicode_compatible
@@ -547,7 +655,7 @@ class PinTransfer(models.Model):
     )
     status = models.CharField(
         max_length=100, blank=True, null=True,
-        help_text=_("Status of transfer at time of saving")
+        help_text=_("Status of transfer when last sent or refreshed from Pin")
     )
     currency = models.CharField(
         max_length=10, help_text=_("currency of transfer")
@@ -566,6 +674,19 @@ class PinTransfer(models.Model):
         _('Complete API Response'), blank=True, null=True,
         help_text=_('The full JSON response from the Pin API')
     )
+    batch_reference = models.CharField(
+        _('Batch reference'), max_length=100, blank=True, null=True,
+        db_index=True, help_text=_('The payout batch this transfer was sent in, if any')
+    )
+    environment = models.CharField(
+        max_length=25, db_index=True, blank=True,
+        help_text=_('The name of the Pin environment the transfer was sent from, eg test or live.')
+    )
+
+    objects = PinTransferManager()
+
+    class Meta:
+        unique_together = [('batch_reference', 'recipient', 'currency')]
 
     def __str__(self):
         return "{0}".format(self.transfer_token)
@@ -580,24 +701,412 @@ class PinTransfer(models.Model):
         return get_value(self.amount, self.currency)
 
     @classmethod
-    def send_new(cls, amount, description, recipient, currency="AUD"):
+    def send_new(cls, amount, description, recipient, currency="AUD", environment=None):
         """ Creates a transfer by sending it to Pin """
-        pin_env = PinEnvironment()
+        new_transfer = cls(
+            amount=amount,
+            description=description,
+            recipient=recipient,
+            currency=currency,
+        )
+        new_transfer.send(PinEnvironment.get(environment))
+        new_transfer.save()
+        signals.dispatch(signals.transfer_sent, cls, transfer=new_transfer)
+        return new_transfer
+
+    def send(self, pin_env):
+        """ Sends this (unsaved) transfer to Pin and updates it from the response """
         payload = {
-            'amount': amount,
-            'description': description,
-            'recipient': recipient.token,
-            'currency': currency,
+            'amount': self.amount,
+            'description': self.description,
+            'recipient': self.recipient.token,
+            'currency': self.currency,
         }
+        self.environment = pin_env.name
         response, response_json = pin_env.pin_post('/transfers', payload)
         data = response_json['response']
-        new_transfer = PinTransfer.objects.create(
-            transfer_token=data['token'],
-            status=data['status'],
-            currency=data['currency'],
-            description=data['description'],
-            amount=data['amount'],
-            recipient=recipient,
-            pin_response_text=response.text,
+        self.transfer_token = data['token']
+        self.status = data['status']
+        self.currency = data['currency']
+        self.description = data['description']
+        self.amount = data['amount']
+        self.pin_response_text = response.text
+
+    def refresh_status(self, environment=None):
+        """
+        Updates the status of this transfer from Pin, by default from the
+        environment it was sent from
+        """
+        pin_env = PinEnvironment.get(environment or self.environment)
+        data = pin_env.pin_get("/transfers/{0}".format(self.transfer_token))[1]['response']
+        if data['status'] != self.status:
+            self.status = data['status']
+            PinTransfer.objects.apply_statuses({self.pk: self.status})
+        return self.status
+
+    @classmethod
+    def send_batch(cls, payouts, description, batch_reference, environment=None, max_workers=8):
+        """
+        Pays each recipient the total of the amounts owed to them, with one
+        transfer per recipient and currency.
+
+        payouts is an iterable of (recipient, amount, currency) tuples, with
+        amounts in the base unit of the currency.
+
+        The transfers are first inserted with bulk_create under
+        batch_reference with the status 'new', then sent concurrently from
+        one PinEnvironment. Each is marked 'sending' just before it is sent,
+        and updated from Pin's response, or marked 'error' if Pin rejected it.
+        A transfer without a response from Pin (a timeout, or a gateway
+        error page) stays 'sending', as Pin may have made it.
+
+        Calling send_batch again with the same batch_reference (and payouts)
+        only sends the transfers still 'new' or in 'error', so a partially
+        failed batch can be re-run without paying anyone twice. Transfers
+        left 'sending' by an interrupted run are not retried, as Pin may have
+        made them: check them in the Pin dashboard.
+
+        Returns the batch's PinTransfers.
+        """
+        pin_env = PinEnvironment.get(environment)
+
+        totals = OrderedDict()
+        for recipient, amount, currency in payouts:
+            key = (recipient.pk, currency)
+            if key not in totals:
+                totals[key] = (recipient, 0)
+            totals[key] = (recipient, totals[key][1] + amount)
+
+        batch = cls.objects.filter(batch_reference=batch_reference)
+        existing = set(batch.values_list('recipient_id', 'currency'))
+        new_transfers = [
+            cls(
+                batch_reference=batch_reference,
+                environment=pin_env.name,
+                recipient=recipient,
+                amount=amount,
+                currency=currency,
+                description=description,
+                status=TRANSFER_NEW,
+            )
+            for (recipient_id, currency), (recipient, amount) in totals.items()
+            if amount > 0 and (recipient_id, currency) not in existing
+        ]
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create(new_transfers)
+        except IntegrityError:
+            # a concurrent run of the batch inserted some of them first
+            for new_transfer in new_transfers:
+                try:
+                    with transaction.atomic():
+                        new_transfer.save()
+                except IntegrityError:
+                    pass
+
+        def send(transfer):
+            # the status check makes concurrent runs of a batch skip each other's transfers
+            claimed = cls.objects.filter(
+                pk=transfer.pk, status__in=(TRANSFER_NEW, TRANSFER_ERROR)
+            ).update(status=TRANSFER_SENDING)
+            if not claimed:
+                return
+            try:
+                transfer.send(pin_env)
+            except PinResponseError as error:
+                transfer.status = TRANSFER_ERROR
+                transfer.pin_response_text = "{0}".format(error)
+                transfer.save()
+                return
+            transfer.save()
+            signals.dispatch(signals.transfer_sent, cls, transfer=transfer)
+
+        pending = batch.filter(status__in=(TRANSFER_NEW, TRANSFER_ERROR)).select_related('recipient')
+        for transfer, _result, error in concurrent_map(send, pending, max_workers):
+            if error is not None:
+                logger.error(
+                    "Transfer {0} in batch {1} may not have been sent, "
+                    "check it in the Pin dashboard: {2}".format(transfer.pk, batch_reference, error)
+                )
+        return list(batch)
+
+    def import_line_items(self, environment=None, max_workers=4):
+        """
+        Replaces this transfer's line items with those listed by Pin,
+        see PinTransferLineItemManager.import_for_transfer()
+        """
+        return PinTransferLineItem.objects.import_for_transfer(
+            self, environment=environment, max_workers=max_workers
         )
-        return new_transfer
+
+
+@python_2_unicode_compatible
+class PinTransferLineItem(models.Model):
+    """
+    An entry in the settlement of a PinTransfer: a charge, refund,
+    adjustment etc. whose amount the transfer includes, as listed by Pin
+    """
+    transfer = models.ForeignKey(
+        PinTransfer, related_name='line_items', on_delete=models.CASCADE
+    )
+    position = models.PositiveIntegerField(
+        _('Position'), help_text=_('Order of this line item in the transfer')
+    )
+    line_item_type = models.CharField(
+        _('Type'), max_length=50, blank=True,
+        help_text=_('Kind of line item, eg charge, refund or adjustment')
+    )
+    amount = models.IntegerField(help_text=_(
+        "Line item amount, in the base unit of the "
+        "currency (e.g.: cents for AUD, yen for JPY)"
+    ))
+    currency = models.CharField(_('Currency'), max_length=10, blank=True)
+    created_at = models.DateTimeField(
+        _('Created at'), blank=True, null=True,
+        help_text=_('Time Pin created the line item')
+    )
+    record_object = models.CharField(
+        _('Record type'), max_length=50, blank=True,
+        help_text=_('Type of the Pin object the line item is for, eg charge')
+    )
+    record_token = models.CharField(
+        _('Record token'), max_length=100, blank=True, db_index=True,
+        help_text=_('Token of the Pin object the line item is for')
+    )
+    transaction = models.ForeignKey(
+        PinTransaction, blank=True, null=True, related_name='transfer_line_items',
+        on_delete=models.SET_NULL,
+        help_text=_('The charge this line item is for, if it is in the database')
+    )
+
+    objects = PinTransferLineItemManager()
+
+    class Meta:
+        ordering = ['transfer', 'position']
+        unique_together = [('transfer', 'position')]
+
+    def __str__(self):
+        return "{0} {1}".format(self.line_item_type, self.record_token)
+
+    @property
+    def value(self):
+        """
+        Returns the value of the line item in the representation of the
+        currency it is in, without symbols
+        """
+        return get_value(self.amount, self.currency)
+
+
+@python_2_unicode_compatible
+class Plan(models.Model):
+    """
+    A recurring billing plan: charge `amount` every `interval_count`
+    `interval`s. Customers are signed up to a plan with a Subscription.
+    """
+    name = models.CharField(_('Name'), max_length=100)
+    description = models.CharField(
+        _('Description'), max_length=255, blank=True,
+        help_text=_('Description sent to Pin with each charge. Defaults to the name.')
+    )
+    amount = models.DecimalField(
+        _('Amount (Dollars)'), max_digits=10, decimal_places=2
+    )
+    currency = models.CharField(
+        _('Currency'), max_length=100, default='AUD',
+        help_text=_('Currency charges are processed in')
+    )
+    interval = models.CharField(
+        _('Interval'), max_length=10, choices=PLAN_INTERVAL_CHOICES,
+        default='month'
+    )
+    interval_count = models.PositiveIntegerField(
+        _('Interval count'), default=1,
+        help_text=_('Number of intervals between charges')
+    )
+    active = models.BooleanField(_('Active'), default=True)
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+
+    def __str__(self):
+        return "{0}".format(self.name)
+
+    def next_billing_date(self, start):
+        """
+        Returns the date one billing period after start. Monthly and yearly
+        plans keep the day of the month, or use the last day of shorter months.
+        """
+        if self.interval == 'day':
+            return start + timedelta(days=self.interval_count)
+        if self.interval == 'week':
+            return start + timedelta(weeks=self.interval_count)
+        months = self.interval_count * (12 if self.interval == 'year' else 1)
+        year, month = add_months(start.year, start.month, months)
+        return start.replace(
+            year=year, month=month, day=min(start.day, monthrange(year, month)[1])
+        )
+
+
+@python_2_unicode_compatible
+class Subscription(models.Model):
+    """
+    Bills a CustomerToken for a Plan every billing period.
+    Due subscriptions are charged by pinpayments.billing.BillingScheduler.
+    Failed charges are retried after the days given in the
+    PIN_DUNNING_SCHEDULE setting, after which the subscription is unpaid.
+    """
+    customer_token = models.ForeignKey(CustomerToken)
+    plan = models.ForeignKey(Plan)
+    status = models.CharField(
+        _('Status'), max_length=20, choices=SUBSCRIPTION_STATUS_CHOICES,
+        default='active'
+    )
+    email_address = models.EmailField(
+        _('E-Mail Address'), max_length=100, help_text=_('As passed to Pin.')
+    )
+    ip_address = models.GenericIPAddressField(
+        help_text=_('IP Address the customer subscribed from')
+    )
+    next_billing_date = models.DateTimeField(
+        _('Next billing date'),
+        help_text=_('Start of the next billing period, when it will be charged')
+    )
+    retry_at = models.DateTimeField(
+        _('Retry at'), blank=True, null=True,
+        help_text=_('When a failed charge for the current period will be retried')
+    )
+    failed_attempts = models.PositiveIntegerField(
+        _('Failed attempts'), default=0,
+        help_text=_('Failed charges for the current billing period')
+    )
+    lease_owner = models.CharField(
+        max_length=100, blank=True,
+        help_text=_('The scheduler process currently billing this subscription')
+    )
+    lease_expires = models.DateTimeField(
+        blank=True, null=True,
+        help_text=_('Other schedulers may take over the subscription after this time')
+    )
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+
+    objects = SubscriptionManager()
+
+    class Meta:
+        index_together = [('status', 'next_billing_date'), ('status', 'retry_at')]
+
+    def __str__(self):
+        return "{0}: {1}".format(self.customer_token, self.plan)
+
+
+@python_2_unicode_compatible
+class Checkpoint(models.Model):
+    """
+    Records how far a long-running job has progressed, so an interrupted
+    run can resume where it stopped instead of starting over.
+    """
+    name = models.CharField(
+        _('Name'), max_length=100, unique=True,
+        help_text=_('Identifies the job and run this checkpoint belongs to')
+    )
+    value = models.CharField(
+        _('Value'), max_length=255, blank=True,
+        help_text=_('Position reached by the job, in a format of its choosing')
+    )
+    updated = models.DateTimeField(_('Updated'), auto_now=True)
+
+    def __str__(self):
+        return "{0}: {1}".format(self.name, self.value)
+
+
+@python_2_unicode_compatible
+class BalanceSnapshot(models.Model):
+    """
+    The balance of a Pin account in one currency at a point in time.
+    Recorded with BalanceSnapshot.objects.record(), and thinned out over
+    time with BalanceSnapshot.objects.downsample().
+    """
+    environment = models.CharField(
+        max_length=25, help_text=_('The name of the Pin environment, eg test or live.')
+    )
+    currency = models.CharField(_('Currency'), max_length=10)
+    available = models.BigIntegerField(
+        _('Available'), blank=True, null=True,
+        help_text=_('Available balance, in the base unit of the currency')
+    )
+    pending = models.BigIntegerField(
+        _('Pending'), blank=True, null=True,
+        help_text=_('Pending balance, in the base unit of the currency')
+    )
+    recorded = models.DateTimeField(_('Recorded'), db_index=True)
+
+    objects = BalanceSnapshotManager()
+
+    class Meta:
+        ordering = ['-recorded']
+        index_together = [('environment', 'currency', 'recorded')]
+
+    def __str__(self):
+        return "{0} {1} {2}".format(self.environment, self.currency, self.recorded)
+
+
+@python_2_unicode_compatible
+class BackgroundJob(models.Model):
+    """
+    An action run in the background on a set of objects, eg from an admin
+    action, with its progress. See pinpayments.jobs.
+    """
+    action = models.CharField(
+        _('Action'), max_length=50, help_text=_('Name of the action, see pinpayments.jobs.JOB_ACTIONS')
+    )
+    object_ids = models.TextField(_('Object ids'), help_text=_('JSON list of the primary keys to process'))
+    status = models.CharField(
+        _('Status'), max_length=20, choices=JOB_STATUS_CHOICES, default=JOB_PENDING
+    )
+    total = models.PositiveIntegerField(_('Total'), default=0)
+    succeeded = models.PositiveIntegerField(_('Succeeded'), default=0)
+    failed = models.PositiveIntegerField(_('Failed'), default=0)
+    errors = models.TextField(_('Errors'), blank=True, help_text=_('The first errors, one per line'))
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+    finished = models.DateTimeField(_('Finished'), blank=True, null=True)
+    updated = models.DateTimeField(
+        _('Updated'), auto_now=True, help_text=_('Last time the job saved its progress')
+    )
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return "{0} #{1}".format(self.action, self.pk)
+
+    @property
+    def processed(self):
+        return self.succeeded + self.failed
+
+
+@python_2_unicode_compatible
+class PinEvent(models.Model):
+    """
+    An event received from Pin, eg by webhook, stored as it arrived. Events
+    are only ever inserted; PinEvent.objects.process_pending() applies them
+    to transactions, transfers and cards and records when it did.
+    """
+    token = models.CharField(
+        _('Pin API Event Token'), max_length=100, unique=True, help_text=_('Unique ID from Pin for this event')
+    )
+    environment = models.CharField(
+        max_length=25, help_text=_('The name of the Pin environment, eg test or live.')
+    )
+    event_type = models.CharField(_('Type'), max_length=100, help_text=_('eg charge.captured'))
+    created_at = models.DateTimeField(
+        _('Created at'), blank=True, null=True, help_text=_('Time Pin created the event')
+    )
+    received = models.DateTimeField(_('Received'), auto_now_add=True)
+    payload = models.TextField(_('Payload'), help_text=_('The event as received, in JSON'))
+    processed = models.DateTimeField(_('Processed'), blank=True, null=True, db_index=True)
+    error = models.TextField(_('Error'), blank=True, help_text=_('Why the event could not be applied, if it could not'))
+
+    objects = PinEventManager()
+
+    class Meta:
+        ordering = ['-received']
+
+    def __str__(self):
+        return "{0} {1}".format(self.event_type, self.token)
@@ -4,18 +4,35 @@ Non-model related objects
 from __future__ import unicode_literals
 
 from decimal import Decimal
+import os
+import threading
+import time
 
 from django.conf import settings
-import requests
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
-from pinpayments.exceptions import ConfigError, PinError
+from pinpayments import logger
+from pinpayments.cache import get_shared_cache
+from pinpayments.exceptions import ConfigError, PinError, PinResponseError
+from pinpayments.utils import concurrent_map
+
+
+# PinEnvironments by the name they were requested with, see PinEnvironment.get()
+_environments = {}
+_environments_lock = threading.Lock()
 
 
 class PinEnvironment(object):
     """ Container for pin settings """
     def __init__(self, name="test", *args, **kwargs):
-        """ Populate contents from Settings """
-        if name in ('test', '', None):
+        """
+        Populate contents from Settings
+        Without a name, or unless exact=True with the name 'test', the
+        PIN_DEFAULT_ENVIRONMENT is used
+        """
+        exact = kwargs.pop('exact', False)
+        if name in ('', None) or (name == 'test' and not exact):
             name = getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
 
         env_dict = {}
@@ -35,8 +52,25 @@ class PinEnvironment(object):
         self.host = env_dict['host']
         self.key = env_dict['key']
         self.secret = env_dict['secret']
+        self.webhook_secret = env_dict.get('webhook_secret')
         super(PinEnvironment, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def get(cls, name=None):
+        """
+        Returns the PinEnvironment called exactly name, or without a name
+        PIN_DEFAULT_ENVIRONMENT, checking its settings the first time it
+        is requested; later requests share the instance until a PIN_
+        setting changes
+        """
+        try:
+            return _environments[name]
+        except KeyError:
+            pass
+        pin_env = cls(name, exact=True)
+        with _environments_lock:
+            return _environments.setdefault(name, pin_env)
+
     @property
     def auth(self):
         """ Returns auth as expected by requests for Pin """
@@ -51,7 +85,11 @@ class PinEnvironment(object):
             raise Exception(
                 "Method for request '{0}' was invalid".format(method)
             )
-        requests_method = getattr(requests, method)
+        if getattr(settings, 'PIN_HTTP_WARMUP', False):
+            requests_method = getattr(get_session(self.host), method)
+        else:
+            import requests  # only when Pin is called: it is slow to import
+            requests_method = getattr(requests, method)
         url = 'https://{0}/1{1}'.format(self.host, url_tail)
         if payload is not None:
             response = requests_method(
@@ -88,7 +126,7 @@ class PinEnvironment(object):
 
         if response_json and not always_return:
             if 'error' in response_json.keys():
-                raise PinError(
+                raise PinResponseError(
                     'Error returned from Pin API: {0}:{1}'.format(
                         response_json['error'],
                         response_json['error_description']
@@ -104,7 +142,7 @@ class PinEnvironment(object):
         Returns a tuple of the response and the decoded JSON
         Provide always_return=True to handle all errors yourself
         """
-        return self._pin_request('GET', url_tail, always_return, process_response_body)
+        return self._pin_request('GET', url_tail, None, always_return, process_response_body)
 
     def pin_put(self, url_tail, payload, always_return=False, process_response_body=True):
         """
@@ -133,11 +171,30 @@ class PinEnvironment(object):
         """
         return self._pin_request('DELETE', url_tail, payload, always_return, process_response_body)
 
-    def get_balance(self, currency="AUD"):
+    def poll_events(self, max_pages=None, process=True):
         """
-        Query Pin for the balance of a Pin account in the currency given
-        Returns a tuple containing Decimals of available and pending balance
+        Stores the events Pin recorded since the last poll, and with process
+        applies them, see PinEvent.objects.poll()
+        Returns the number of new events
+        """
+        from django.apps import apps
+        return apps.get_model('pinpayments', 'PinEvent').objects.poll(self, max_pages, process)
+
+    def get_balances(self, use_cache=True):
+        """
+        Query Pin for the balance of a Pin account in every currency
+        Returns a dict of (available, pending) tuples of Decimals by
+        currency, with None for a balance Pin did not report
+        The result is cached for PIN_BALANCE_CACHE_TIMEOUT seconds
+        (default 10), provide use_cache=False to always query Pin
         """
+        shared_cache = get_shared_cache()
+        key = 'pinpayments:balance:{0}'.format(self.name)
+        if use_cache:
+            balances = shared_cache.get(key)
+            if balances is not None:
+                return balances
+
         response, response_json = self.pin_get('/balance')
         response_json = response_json['response']
 
@@ -147,34 +204,38 @@ class PinEnvironment(object):
                 "details: {1}".format(self.name, response.text)
             )
 
-        available = set([
-            bal['amount'] if bal['currency'] == currency else None
-            for bal in response_json['available']
-        ])
-        if None in available:
-            available.remove(None)
-        if len(available) != 1:
-            raise PinError(
-                "Error retrieving available balance for currency {0} "
-                "in environment {1}. Available currencies and values are: \n"
-                "\t{2}".format(currency, self.name, response_json['available'])
-            )
-        available_balance = Decimal(list(available)[0])
-
-        pending = set([
-            bal['amount'] if bal['currency'] == currency else None
-            for bal in response_json['pending']
-        ])
-        if None in pending:
-            pending.remove(None)
-        if len(pending) != 1:
-            raise PinError(
-                "Error retrieving pending balance for currency {0}"
-                "in environment {1}. Available currencies and values are: \n"
-                "\t{2}".format(currency, self.name, response_json['pending'])
-            )
-        pending_balance = Decimal(list(pending)[0])
+        balances = {}
+        for index, kind in enumerate(('available', 'pending')):
+            for bal in response_json[kind]:
+                amounts = balances.setdefault(bal['currency'], [None, None])
+                if amounts[index] is not None and amounts[index] != Decimal(bal['amount']):
+                    raise PinError(
+                        "Error retrieving {0} balance for currency {1} "
+                        "in environment {2}. Available currencies and values are: \n"
+                        "\t{3}".format(kind, bal['currency'], self.name, response_json[kind])
+                    )
+                amounts[index] = Decimal(bal['amount'])
+        balances = dict((currency, tuple(amounts)) for currency, amounts in balances.items())
+
+        timeout = getattr(settings, 'PIN_BALANCE_CACHE_TIMEOUT', 10)
+        if timeout:
+            shared_cache.set(key, balances, timeout)
+        return balances
 
+    def get_balance(self, currency="AUD"):
+        """
+        Query Pin for the balance of a Pin account in the currency given
+        Returns a tuple containing Decimals of available and pending balance
+        """
+        balances = self.get_balances()
+        available_balance, pending_balance = balances.get(currency, (None, None))
+        for kind, balance in (('available', available_balance), ('pending', pending_balance)):
+            if balance is None:
+                raise PinError(
+                    "Error retrieving {0} balance for currency {1} "
+                    "in environment {2}. Available currencies and values are: \n"
+                    "\t{3}".format(kind, currency, self.name, balances)
+                )
         return (available_balance, pending_balance)
 
     def get_available_balance(self, currency="AUD"):
@@ -182,3 +243,113 @@ class PinEnvironment(object):
 
     def get_pending_balance(self, currency="AUD"):
         return self.get_balance(currency)[1]
+
+
+@receiver(setting_changed)
+def clear_environments(setting, **kwargs):
+    """ Forgets the environments shared by PinEnvironment.get() when the Pin settings change """
+    if setting.startswith('PIN_'):
+        with _environments_lock:
+            _environments.clear()
+
+
+# requests Sessions by host, and the process they were created in
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+# Seconds the last warmup of each host took, see warmup()
+warmup_times = {}
+
+
+def get_session(host):
+    """
+    Returns the requests Session this process uses to call host, keeping
+    up to PIN_HTTP_POOL_SIZE connections (default 10) open. A process
+    forked from one with sessions gets new ones, rather than sharing the
+    parent's connections.
+    """
+    global _sessions_pid
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        session = _sessions.get(host)
+        if session is None:
+            import requests
+            session = requests.Session()
+            session.mount('https://', requests.adapters.HTTPAdapter(
+                pool_maxsize=getattr(settings, 'PIN_HTTP_POOL_SIZE', 10)
+            ))
+            _sessions[host] = session
+        return session
+
+
+def _reset_sessions_after_fork():
+    # the lock may have been held by another thread of the parent
+    global _sessions_lock, _sessions_pid
+    _sessions_lock = threading.Lock()
+    _sessions.clear()
+    _sessions_pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):  # Python 3.7+
+    os.register_at_fork(after_in_child=_reset_sessions_after_fork)
+
+
+def warmup(connections=None, timeout=10):
+    """
+    Opens connections (default PIN_HTTP_WARMUP, or 1) to the host of each
+    of PIN_ENVIRONMENTS, so the first calls to Pin don't wait for DNS and
+    the TLS handshake. The connections stay in the hosts' pools.
+    Returns and records in warmup_times the seconds each host took.
+    """
+    if connections is None:
+        connections = max(int(getattr(settings, 'PIN_HTTP_WARMUP', 1)), 1)
+    hosts = sorted(set(
+        environment['host'] for environment in getattr(settings, 'PIN_ENVIRONMENTS', {}).values()
+        if environment.get('host')
+    ))
+
+    def open_connection(host):
+        # the response is read, so its connection goes back to the pool
+        get_session(host).head('https://{0}/'.format(host), timeout=timeout)
+
+    times = {}
+    for host in hosts:
+        started = time.time()
+        for _host, _result, error in concurrent_map(open_connection, [host] * connections, connections):
+            if error is not None:
+                logger.warning("Unable to open a connection to {0}: {1}".format(host, error))
+        times[host] = time.time() - started
+        logger.info("Opened {0} connections to {1} in {2:.3f}s".format(connections, host, times[host]))
+    warmup_times.update(times)
+    return times
+
+
+def warmup_in_background():
+    """ Runs warmup() in a daemon thread, so it doesn't delay starting up """
+    thread = threading.Thread(target=warmup, name='pinpayments-warmup')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls, made from any number of threads, to at most `rate`
+    per second. Call wait() before each call.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """ Blocks until the caller's turn """
+        with self.lock:
+            now = time.time()
+            call_at = max(self.next_call, now)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
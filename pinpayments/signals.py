@@ -0,0 +1,83 @@
+"""
+Signals sent as payments, transfers, customers and cards change
+
+pre_charge is sent before a transaction is sent to Pin, always straight
+away: a receiver raising an exception stops the charge. The others are
+sent once the change is saved, in the way set by PIN_SIGNAL_DISPATCH:
+
+    'sync' (default) - receivers run at once, in the calling thread
+    'on_commit' - receivers run in the calling thread once the current
+        transaction commits, or at once outside a transaction
+    'thread' - receivers run on a pool of PIN_SIGNAL_THREADS threads
+        (default 4) once the current transaction commits, so they don't
+        add to the time taken to charge
+
+Exceptions raised by their receivers are logged rather than raised, as
+the change they report has already been made.
+"""
+from __future__ import unicode_literals
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.dispatch import Signal
+
+from pinpayments import logger
+
+# sender is the PinTransaction class
+pre_charge = Signal(providing_args=['transaction'])
+charge_succeeded = Signal(providing_args=['transaction'])
+charge_failed = Signal(providing_args=['transaction'])
+
+# sender is the PinTransfer class
+transfer_sent = Signal(providing_args=['transfer'])
+transfer_status_changed = Signal(providing_args=['transfer'])
+
+# sender is the CustomerToken class
+customer_created = Signal(providing_args=['customer'])
+card_added = Signal(providing_args=['customer', 'card'])
+card_deleted = Signal(providing_args=['customer', 'card'])
+
+# sender is the PinRecipient class
+recipient_created = Signal(providing_args=['recipient'])
+
+DISPATCH_MODES = ('sync', 'on_commit', 'thread')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(getattr(settings, 'PIN_SIGNAL_THREADS', 4))
+        return _executor
+
+
+def _send(signal, sender, kwargs):
+    for receiver, response in signal.send_robust(sender, **kwargs):
+        if isinstance(response, Exception):
+            logger.error("Signal receiver {0} failed: {1!r}".format(receiver, response))
+
+
+def _send_in_thread(signal, sender, kwargs):
+    try:
+        _send(signal, sender, kwargs)
+    finally:
+        connections.close_all()
+
+
+def dispatch(signal, sender, **kwargs):
+    """ Sends signal in the way set by PIN_SIGNAL_DISPATCH """
+    if not signal.has_listeners(sender):
+        return
+    mode = getattr(settings, 'PIN_SIGNAL_DISPATCH', 'sync')
+    if mode == 'thread':
+        transaction.on_commit(lambda: _get_executor().submit(_send_in_thread, signal, sender, kwargs))
+    elif mode == 'on_commit':
+        transaction.on_commit(lambda: _send(signal, sender, kwargs))
+    else:
+        _send(signal, sender, kwargs)
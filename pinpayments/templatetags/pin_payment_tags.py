@@ -2,6 +2,9 @@
 from django import template
 from django.conf import settings
 
+from pinpayments.exceptions import ConfigError
+from pinpayments.objects import PinEnvironment
+
 register = template.Library()
 
 
@@ -15,33 +18,15 @@ def pin_header(context, environment=''):
     if environment == '':
         environment = getattr(settings, 'PIN_DEFAULT_ENVIRONMENT', 'test')
 
-    pin_config = getattr(settings, 'PIN_ENVIRONMENTS', {})
-
-    if pin_config == {}:
-        raise template.TemplateSyntaxError(
-            "PIN_ENVIRONMENTS setting does not exist."
-        )
-
-    if environment not in pin_config.keys():
-        raise template.TemplateSyntaxError(
-            "Environment '{0}' not in PIN_ENVIRONMENTS".format(environment)
-        )
-
-    pin_env = pin_config[environment]
-
-    (pin_key, pin_host) = (pin_env.get('key', None), pin_env.get('host', None))
-
-    if not (pin_key and pin_host):
-        raise template.TemplateSyntaxError(
-            "Environment '{0}' does not have key and host configured.".format(
-                environment
-            )
-        )
+    try:
+        pin_env = PinEnvironment.get(environment)
+    except ConfigError as error:
+        raise template.TemplateSyntaxError("{0}".format(error))
 
     return {
         'pin_environment': environment,
-        'pin_public_key': pin_key,
-        'pin_host': pin_host,
+        'pin_public_key': pin_env.key,
+        'pin_host': pin_env.host,
         'request': context,
     }
 
@@ -1,2 +1,10 @@
 from pinpayments.tests.models import *
 from pinpayments.tests.templatetags import *
+from pinpayments.tests.commands import *
+from pinpayments.tests.billing import *
+from pinpayments.tests.admin import *
+from pinpayments.tests.jobs import *
+from pinpayments.tests.dashboard import *
+from pinpayments.tests.events import *
+from pinpayments.tests.signals import *
+from pinpayments.tests.checks import *
@@ -0,0 +1,123 @@
+""" Admin test classes """
+
+from __future__ import absolute_import, unicode_literals
+
+from pinpayments.admin import (
+    EstimatedCountPaginator, PinRecipientAdmin, PinTransactionAdmin, PinTransactionInline, PinTransferAdmin
+)
+from pinpayments.models import CustomerToken, PinRecipient, PinTransaction, PinTransfer
+from pinpayments.utils import get_user_model
+
+from django.contrib.admin import site
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+
+
+class LargeTableAdminTests(TestCase):
+    """ Test the admins of tables that grow large """
+    def setUp(self):
+        super(LargeTableAdminTests, self).setUp()
+        self.request = RequestFactory().get('/')
+        for index in range(3):
+            PinTransaction.objects.create(
+                transaction_token='ch_{0}'.format(index), card_token='card_{0}'.format(index),
+                amount=1, ip_address='127.0.0.{0}'.format(index),
+                email_address='user{0}@example.com'.format(index), pin_response_text='{}'
+            )
+        self.model_admin = PinTransactionAdmin(PinTransaction, site)
+
+    def search(self, term, model_admin=None):
+        model_admin = model_admin or self.model_admin
+        queryset = model_admin.get_queryset(self.request)
+        return model_admin.get_search_results(self.request, queryset, term)[0]
+
+    def test_token_search(self):
+        """ Tokens only match exactly, other terms use search_fields """
+        self.assertEqual(list(self.search('ch_1').values_list('transaction_token', flat=True)), ['ch_1'])
+        self.assertEqual(self.search('card_2').get().transaction_token, 'ch_2')
+        self.assertFalse(self.search('ch_').exists())
+        self.assertEqual(self.search('User0@example.com').get().transaction_token, 'ch_0')
+        self.assertFalse(self.search('user0').exists())
+        self.assertEqual(self.search('127.0.0.2').get().transaction_token, 'ch_2')
+
+    def test_word_with_underscore(self):
+        """ Terms that only look like tokens are searched for in search_fields """
+        recipient = PinRecipient.objects.create(token='rp_1', email='payee@example.com', name='john_smith')
+        model_admin = PinRecipientAdmin(PinRecipient, site)
+        self.assertEqual(self.search('john_smith', model_admin).get(), recipient)
+
+    def test_transfer_search(self):
+        """ Transfers can be found by recipient """
+        recipient = PinRecipient.objects.create(token='rp_1', email='payee@example.com')
+        PinTransfer.objects.create(transfer_token='tfer_1', amount=1, currency='AUD', recipient=recipient)
+        model_admin = PinTransferAdmin(PinTransfer, site)
+        self.assertEqual(self.search('rp_1', model_admin).get().transfer_token, 'tfer_1')
+        self.assertEqual(self.search('payee@example.com', model_admin).get().transfer_token, 'tfer_1')
+
+    def test_heavy_columns_deferred(self):
+        """ The full Pin response isn't loaded for the changelist """
+        transaction = self.model_admin.get_queryset(self.request).first()
+        self.assertIn('pin_response_text', transaction.get_deferred_fields())
+
+    def test_paginator_counts(self):
+        """ Without an estimate, the paginator counts rows """
+        paginator = EstimatedCountPaginator(PinTransaction.objects.all(), 2)
+        self.assertEqual(paginator.count, 3)
+        self.assertEqual(paginator.num_pages, 2)
+
+    def test_paginated_inline(self):
+        """ Inlines show one page of related objects """
+        customer = CustomerToken.objects.create(user=get_user_model().objects.create(), token='cus_1')
+        PinTransaction.objects.filter(transaction_token__in=['ch_0', 'ch_1']).update(
+            card_token=None, customer_token=customer
+        )
+        inline = PinTransactionInline(CustomerToken, site)
+        inline.per_page = 1
+        request = RequestFactory().get('/', {'pintransaction_set-page': '2'})
+        formset = inline.get_formset(request, customer)(instance=customer)
+        self.assertEqual(len(formset.forms), 1)
+        self.assertEqual(formset.page.number, 2)
+        self.assertEqual(formset.page.paginator.count, 2)
+
+    def test_export(self):
+        """ The export action streams the chosen columns """
+        request = RequestFactory().post('/', {'export': 'yes', 'export_fields': ['transaction_token', 'amount']})
+        response = self.model_admin.export_csv(request, PinTransaction.objects.order_by('transaction_token'))
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(content.splitlines(), [
+            'transaction_token,amount', 'ch_0,1.00', 'ch_1,1.00', 'ch_2,1.00',
+        ])
+        self.assertIn('pintransaction.csv', response['Content-Disposition'])
+
+
+class ExportAdminTests(TestCase):
+    """ Test the export admin actions """
+    def setUp(self):
+        super(ExportAdminTests, self).setUp()
+        self.user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        customer = CustomerToken.objects.create(user=self.user, token='cus_1')
+        self.transaction = PinTransaction.objects.create(
+            transaction_token='ch_1', customer_token=customer, amount=1,
+            ip_address='127.0.0.1', email_address='test@example.com'
+        )
+        self.client.force_login(self.user)
+
+    def export(self, *fields):
+        return self.client.post(reverse('admin:pinpayments_pintransaction_changelist'), {
+            'action': 'export_csv', '_selected_action': [self.transaction.pk],
+            'export': '1', 'export_fields': list(fields),
+        })
+
+    def test_export(self):
+        """ The model's columns and the allowed related ones are exported """
+        response = self.export('transaction_token', 'customer_token__token')
+        self.assertEqual(
+            b''.join(response.streaming_content).decode('utf-8').splitlines(),
+            ['transaction_token,customer_token__token', 'ch_1,cus_1']
+        )
+
+    def test_related_fields_not_allowed(self):
+        """ Other columns of related models can't be exported """
+        response = self.export('transaction_token', 'customer_token__user__password')
+        self.assertFalse(getattr(response, 'streaming', False))
+        self.assertNotIn(self.user.password, response.content.decode('utf-8'))
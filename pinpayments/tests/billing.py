@@ -0,0 +1,164 @@
+""" Recurring billing test classes """
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+from datetime import timedelta
+from decimal import Decimal
+
+from pinpayments.billing import BillingScheduler
+from pinpayments.models import CustomerToken, PinTransaction, Plan, Subscription
+from pinpayments.tests.models import FakeResponse
+from pinpayments.utils import get_user_model
+
+from django.test import TestCase
+from django.utils import timezone
+from mock import patch
+
+
+User = get_user_model()
+
+CHARGE_SUCCESS = json.dumps({
+    'response': {
+        'token': 'ch_1234',
+        'success': True,
+        'total_fees': 50,
+        'status_message': 'Success!',
+        'card': {
+            'address_line1': '42 Sevenoaks St',
+            'address_line2': None,
+            'address_city': 'Lathlain',
+            'address_state': 'WA',
+            'address_postcode': '6454',
+            'address_country': 'Australia',
+            'display_number': 'XXXX-XXXX-XXXX-0000',
+            'scheme': 'master',
+        },
+    }
+})
+
+CHARGE_DECLINED = json.dumps({
+    'error': 'card_declined',
+    'error_description': 'The card was declined',
+    'charge_token': 'ch_5678',
+})
+
+
+class BillingSchedulerTests(TestCase):
+    """ Test charging due subscriptions """
+    def setUp(self):
+        """ A monthly plan with a subscription that is due """
+        super(BillingSchedulerTests, self).setUp()
+        self.now = timezone.now()
+        self.customer = CustomerToken.objects.create(
+            user=User.objects.create(), token='cus_1234', environment='test'
+        )
+        self.plan = Plan.objects.create(name='Monthly', amount=Decimal('10.00'))
+        self.subscription = Subscription.objects.create(
+            customer_token=self.customer,
+            plan=self.plan,
+            email_address='test@example.com',
+            ip_address='127.0.0.1',
+            next_billing_date=self.now - timedelta(hours=1),
+        )
+        self.scheduler = BillingScheduler(max_workers=1, dunning_schedule=(1, 3))
+
+    def refresh(self):
+        return Subscription.objects.get(pk=self.subscription.pk)
+
+    def test_next_billing_date(self):
+        """ Monthly plans keep the day of month where possible """
+        start = self.now.replace(year=2015, month=1, day=31)
+        self.assertEqual(self.plan.next_billing_date(start).date(), start.replace(month=2, day=28).date())
+        self.plan.interval = 'week'
+        self.assertEqual(self.plan.next_billing_date(start), start + timedelta(days=7))
+
+    @patch('requests.post')
+    def test_successful_charge(self, mock_request):
+        """ A successful charge moves the subscription to the next period """
+        mock_request.return_value = FakeResponse(200, CHARGE_SUCCESS)
+        self.assertEqual(self.scheduler.run(), (1, 0))
+
+        transaction = PinTransaction.objects.get(subscription=self.subscription)
+        self.assertTrue(transaction.succeeded)
+        self.assertEqual(transaction.customer_token, self.customer)
+        self.assertEqual(transaction.amount, Decimal('10.00'))
+
+        subscription = self.refresh()
+        self.assertEqual(subscription.status, 'active')
+        self.assertEqual(
+            subscription.next_billing_date,
+            self.plan.next_billing_date(self.subscription.next_billing_date)
+        )
+        self.assertEqual(subscription.lease_owner, '')
+
+    @patch('requests.post')
+    def test_dunning(self, mock_request):
+        """ Failed charges are retried on the dunning schedule, then given up """
+        mock_request.return_value = FakeResponse(200, CHARGE_DECLINED)
+        self.assertEqual(self.scheduler.run(), (0, 1))
+        subscription = self.refresh()
+        self.assertEqual(subscription.status, 'past_due')
+        self.assertEqual(subscription.failed_attempts, 1)
+        self.assertGreater(subscription.retry_at, self.now + timedelta(hours=23))
+
+        # not due again until the retry date
+        self.assertEqual(self.scheduler.run(), (0, 0))
+        self.scheduler.run(now=subscription.retry_at)
+        self.scheduler.run(now=self.refresh().retry_at)
+
+        subscription = self.refresh()
+        self.assertEqual(subscription.status, 'unpaid')
+        self.assertEqual(subscription.transactions.count(), 3)
+        self.assertEqual(self.scheduler.run(now=self.now + timedelta(days=30)), (0, 0))
+
+    @patch('requests.post')
+    def test_leased_subscriptions_are_skipped(self, mock_request):
+        """ Subscriptions claimed by another scheduler are left alone """
+        mock_request.return_value = FakeResponse(200, CHARGE_SUCCESS)
+        other = BillingScheduler(worker_id='other')
+        self.assertEqual(len(other.claim()), 1)
+        self.assertEqual(self.scheduler.run(), (0, 0))
+
+        # until that scheduler's lease has expired
+        self.assertEqual(self.scheduler.run(now=self.now + timedelta(hours=1)), (1, 0))
+        self.assertEqual(mock_request.call_count, 1)
+
+    def make_transaction(self, **kwargs):
+        return PinTransaction.objects.create(
+            subscription=self.subscription, billing_period=self.subscription.next_billing_date,
+            billing_attempt=1, customer_token=self.customer, environment='test',
+            date=self.now, amount=Decimal('10.00'), email_address='test@example.com',
+            ip_address='127.0.0.1', **kwargs
+        )
+
+    @patch('requests.post')
+    def test_charged_but_not_settled(self, mock_request):
+        """ A charge made by a run that died before settling is settled, not made again """
+        self.make_transaction(processed=True, succeeded=True, pin_response='Success!')
+        self.assertEqual(self.scheduler.run(), (1, 0))
+        self.assertFalse(mock_request.called)
+        self.assertEqual(self.subscription.transactions.count(), 1)
+        self.assertGreater(self.refresh().next_billing_date, self.now)
+
+    @patch('requests.post')
+    def test_uncertain_charge_is_not_repeated(self, mock_request):
+        """ A charge sent to Pin without an answer is never sent again """
+        self.make_transaction(processed=True)
+        self.assertEqual(self.scheduler.run(), (0, 0))
+        self.assertEqual(self.scheduler.run(now=self.now + timedelta(hours=1)), (0, 0))
+        self.assertFalse(mock_request.called)
+        self.assertEqual(self.subscription.transactions.count(), 1)
+        self.assertEqual(self.refresh().failed_attempts, 0)
+
+    @patch('requests.post')
+    def test_overlapping_schedulers(self, mock_request):
+        """ Two schedulers holding the same unprocessed transaction charge it once """
+        mock_request.return_value = FakeResponse(200, CHARGE_SUCCESS)
+        transaction = self.scheduler.create_transactions(self.scheduler.claim())[0]
+        stale = PinTransaction.objects.get(pk=transaction.pk)
+        other = BillingScheduler(max_workers=1, worker_id='other')
+        self.assertTrue(other.charge(transaction))
+        self.assertFalse(self.scheduler.charge(stale))
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertTrue(PinTransaction.objects.get(pk=transaction.pk).succeeded)
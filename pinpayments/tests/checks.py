@@ -0,0 +1,29 @@
+""" System check test classes """
+
+from __future__ import absolute_import, unicode_literals
+
+from pinpayments.checks import check_settings
+from pinpayments.tests.models import ENV_MISSING_SECRET
+
+from django.test import TestCase, override_settings
+
+
+class SettingsCheckTests(TestCase):
+    """ Test the checks of the Pin settings """
+    def error_ids(self):
+        return [error.id for error in check_settings(None)]
+
+    def test_valid(self):
+        self.assertEqual(self.error_ids(), [])
+
+    @override_settings(PIN_ENVIRONMENTS={})
+    def test_no_environments(self):
+        self.assertEqual(self.error_ids(), ['pinpayments.E001'])
+
+    @override_settings(PIN_ENVIRONMENTS=dict(ENV_MISSING_SECRET, other='live'), PIN_DEFAULT_ENVIRONMENT='live')
+    def test_invalid_environments(self):
+        self.assertEqual(self.error_ids(), ['pinpayments.E002', 'pinpayments.E003', 'pinpayments.E004'])
+
+    @override_settings(PIN_SIGNAL_DISPATCH='later')
+    def test_signal_dispatch(self):
+        self.assertEqual(self.error_ids(), ['pinpayments.E005'])
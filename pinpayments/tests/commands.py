@@ -0,0 +1,262 @@
+""" Management command test classes """
+
+from __future__ import absolute_import, unicode_literals
+
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+
+from pinpayments.models import BalanceSnapshot, CardToken, Checkpoint, CustomerToken, PinTransaction, PinTransfer
+from pinpayments.tests.models import FakeResponse
+from pinpayments.utils import get_user_model
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from mock import patch
+from six import StringIO
+
+
+User = get_user_model()
+
+NOTIFICATIONS = []
+
+
+# usernames collect_notification fails for
+FAILING_USERS = set()
+
+
+def collect_notification(user, cards):
+    """ Notifier used by the tests below """
+    if user.username in FAILING_USERS:
+        raise ValueError("Unable to notify {0}".format(user.username))
+    NOTIFICATIONS.append((user, sorted(card.token for card in cards)))
+
+
+@override_settings(PIN_CARD_EXPIRY_NOTIFIER='pinpayments.tests.commands.collect_notification')
+class NotifyExpiringCardsTests(TestCase):
+    """ Test the notify_expiring_cards command """
+    def setUp(self):
+        """ Two users with expiring cards, one with a card that is not """
+        super(NotifyExpiringCardsTests, self).setUp()
+        del NOTIFICATIONS[:]
+        FAILING_USERS.clear()
+        today = timezone.now().date()
+        self.users = []
+        for name, expiry_years in (('first', (0, 0)), ('second', (0, 5))):
+            user = User.objects.create(username=name)
+            customer = CustomerToken.objects.create(user=user, token=name)
+            for index, years in enumerate(expiry_years):
+                customer.cards.add(CardToken.objects.create(
+                    token='{0}_{1}'.format(name, index),
+                    expiry_year=today.year + years,
+                    expiry_month=today.month,
+                ))
+            self.users.append(user)
+
+    def call(self, *args):
+        call_command('notify_expiring_cards', '--workers=1', *args, stdout=StringIO())
+
+    def test_groups_cards_per_user(self):
+        """ Each user is notified once, about their expiring cards only """
+        self.call()
+        self.assertEqual(NOTIFICATIONS, [
+            (self.users[0], ['first_0', 'first_1']),
+            (self.users[1], ['second_0']),
+        ])
+
+    def test_resumes_from_checkpoint(self):
+        """ Users before the checkpoint are skipped, finished runs are not repeated """
+        Checkpoint.objects.create(
+            name='notify_expiring_cards:{0:%Y-%m}:1'.format(timezone.now()),
+            value=str(self.users[0].pk),
+        )
+        self.call()
+        self.assertEqual(NOTIFICATIONS, [(self.users[1], ['second_0'])])
+
+        self.call()
+        self.assertEqual(len(NOTIFICATIONS), 1)
+
+        self.call('--restart')
+        self.assertEqual(len(NOTIFICATIONS), 3)
+
+    def test_retries_failed_users(self):
+        """ Users whose notification failed are retried, without notifying the others again """
+        FAILING_USERS.add('first')
+        self.call()
+        self.assertEqual(NOTIFICATIONS, [(self.users[1], ['second_0'])])
+
+        FAILING_USERS.clear()
+        self.call()
+        self.assertEqual(NOTIFICATIONS, [
+            (self.users[1], ['second_0']),
+            (self.users[0], ['first_0', 'first_1']),
+        ])
+
+        self.call()
+        self.assertEqual(len(NOTIFICATIONS), 2)
+        self.assertEqual(Checkpoint.objects.count(), 1)
+
+    @override_settings(PIN_CARD_EXPIRY_NOTIFIER=None)
+    def test_notifier_required(self):
+        """ The command refuses to run without a notifier """
+        with self.assertRaises(CommandError):
+            self.call()
+
+
+def fake_create_customer(url, params=None, **kwargs):
+    """ Pin /customers responses, declining card tokens starting with 'bad' """
+    if params['card_token'].startswith('bad'):
+        return FakeResponse(200, json.dumps({
+            'error': 'invalid_resource', 'error_description': 'Card token is invalid',
+        }))
+    return FakeResponse(200, json.dumps({'response': {
+        'token': 'cus_{0}'.format(params['card_token']),
+        'email': params['email'],
+        'card': {
+            'token': 'card_{0}'.format(params['card_token']),
+            'display_number': 'XXXX-XXXX-XXXX-0000',
+            'scheme': 'visa',
+            'expiry_month': 6,
+            'expiry_year': 2030,
+            'primary': True,
+        },
+    }}))
+
+
+class ImportCustomersTests(TestCase):
+    """ Test the import_customers command """
+    def setUp(self):
+        super(ImportCustomersTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.users = [
+            User.objects.create(username='user{0}'.format(index), email='{0}@example.com'.format(index))
+            for index in range(3)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(ImportCustomersTests, self).tearDown()
+
+    @patch('requests.post', side_effect=fake_create_customer)
+    def test_import(self, mock_request):
+        """ Customers and cards are created, failed rows are written out """
+        path = os.path.join(self.directory, 'customers.csv')
+        with io.open(path, 'w', newline='') as source:
+            rows = csv.writer(source)
+            rows.writerow(['user', 'card_token'])
+            rows.writerow([self.users[0].email, 'one'])
+            rows.writerow([self.users[1].email, 'bad'])
+            rows.writerow(['nobody@example.com', 'two'])
+            rows.writerow([self.users[2].email, 'three'])
+        call_command(
+            'import_customers', path, '--user-field=email', '--workers=1', '--batch-size=2',
+            stdout=StringIO()
+        )
+
+        customer = CustomerToken.objects.get(user=self.users[0])
+        self.assertEqual(customer.token, 'cus_one')
+        self.assertEqual(customer.environment, 'test')
+        self.assertEqual(customer.primary_card.token, 'card_one')
+        self.assertEqual(CustomerToken.objects.get(user=self.users[2]).cards.count(), 1)
+        self.assertEqual(CustomerToken.objects.count(), 2)
+        self.assertEqual(mock_request.call_count, 3)
+
+        with io.open(path + '.failures.csv', newline='') as failures:
+            failed = list(csv.DictReader(failures))
+        self.assertEqual(
+            sorted((row['user'], row['card_token']) for row in failed),
+            [(self.users[1].email, 'bad'), ('nobody@example.com', 'two')]
+        )
+
+
+def fake_balance(url, **kwargs):
+    """ Pin /balance responses, an error from the 'broken' environment """
+    if 'broken' in url:
+        return FakeResponse(500, json.dumps({'error': 'server_error', 'error_description': 'Oops'}))
+    return FakeResponse(200, json.dumps({'response': {
+        'available': [{'amount': 1000, 'currency': 'AUD'}, {'amount': 5, 'currency': 'USD'}],
+        'pending': [{'amount': 200, 'currency': 'AUD'}, {'amount': 0, 'currency': 'USD'}],
+    }}))
+
+
+@override_settings(PIN_ENVIRONMENTS={
+    'test': {'key': 'key1', 'secret': 'secret1', 'host': 'test-api.pin.net.au'},
+    'live': {'key': 'key2', 'secret': 'secret2', 'host': 'api.pin.net.au'},
+    'other': {'key': 'key3', 'secret': 'secret3', 'host': 'broken.pin.net.au'},
+})
+class RecordBalancesTests(TestCase):
+    """ Test the record_balances command """
+    @patch('requests.get', side_effect=fake_balance)
+    def test_record(self, mock_request):
+        """ Every environment is fetched, once, environments that fail are skipped """
+        call_command('record_balances', '--workers=1', stdout=StringIO())
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(
+            sorted(BalanceSnapshot.objects.values_list('environment', 'currency', 'available', 'pending')),
+            [('live', 'AUD', 1000, 200), ('live', 'USD', 5, 0), ('test', 'AUD', 1000, 200), ('test', 'USD', 5, 0)]
+        )
+        self.assertEqual(len(set(BalanceSnapshot.objects.values_list('recorded', flat=True))), 1)
+
+
+class ExportPinDataTests(TestCase):
+    """ Test the export_pin_data command """
+    def setUp(self):
+        super(ExportPinDataTests, self).setUp()
+        self.customer = CustomerToken.objects.create(user=User.objects.create(), token='cus_1')
+        for index in range(3):
+            PinTransaction.objects.create(
+                transaction_token='ch_{0}'.format(index), customer_token=self.customer,
+                amount=Decimal('1.50'), ip_address='127.0.0.1', email_address='test@example.com',
+                pin_response_text='{"response": {}}'
+            )
+
+    def export(self, *args):
+        stdout = StringIO()
+        call_command('export_pin_data', *args, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def test_csv(self):
+        """ Every row is exported, without the full Pin response by default """
+        rows = list(csv.DictReader(StringIO(self.export('transactions', '--chunk-size=2'))))
+        self.assertEqual([row['transaction_token'] for row in rows], ['ch_0', 'ch_1', 'ch_2'])
+        self.assertEqual(rows[0]['amount'], '1.50')
+        self.assertNotIn('pin_response_text', rows[0])
+
+    def test_jsonl_fields(self):
+        """ Columns can be chosen, including columns of related rows """
+        lines = self.export(
+            'transactions', '--format=jsonl', '--fields=transaction_token,customer_token__token',
+            '--since=2000-01-01'
+        ).splitlines()
+        self.assertEqual(json.loads(lines[0]), {'transaction_token': 'ch_0', 'customer_token__token': 'cus_1'})
+        self.assertEqual(len(lines), 3)
+
+    def test_unknown_field(self):
+        """ Unknown columns are refused before anything is exported """
+        with self.assertRaises(CommandError):
+            self.export('transfers', '--fields=nothing')
+
+    @override_settings(PIN_DEFAULT_ENVIRONMENT='test', PIN_ENVIRONMENTS={
+        'test': {'key': 'key1', 'secret': 'secret1', 'host': 'test-api.pin.net.au'},
+        'live': {'key': 'key2', 'secret': 'secret2', 'host': 'api.pin.net.au'},
+    })
+    def test_transfers_environment(self):
+        """ Transfers without an environment are exported with the default environment """
+        for token, environment in (('tfer_1', ''), ('tfer_2', 'test'), ('tfer_3', 'live')):
+            PinTransfer.objects.create(
+                transfer_token=token, environment=environment, status='pending', currency='AUD', amount=100
+            )
+        fields = '--fields=transfer_token'
+        self.assertEqual(self.export('transfers', fields, '--environment=test').split(), [
+            'transfer_token', 'tfer_1', 'tfer_2'
+        ])
+        self.assertEqual(self.export('transfers', fields, '--environment=live').split(), ['transfer_token', 'tfer_3'])
+        with self.assertRaises(CommandError):
+            self.export('transfers', fields, '--environment=nowhere')
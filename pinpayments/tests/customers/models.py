@@ -0,0 +1,12 @@
+""" A CustomerTokenAbstract implementation for the tests """
+
+from __future__ import absolute_import, unicode_literals
+
+from django.db import models
+from pinpayments.models import CardToken, CustomerTokenAbstract
+
+
+class MemberToken(CustomerTokenAbstract):
+    """ A customer of a member rather than a user, with its own cards relation """
+    member_number = models.CharField(max_length=20)
+    cards = models.ManyToManyField(CardToken, blank=True, related_name='member_tokens')
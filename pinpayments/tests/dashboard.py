@@ -0,0 +1,84 @@
+""" Admin dashboard test classes """
+
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+
+from pinpayments import cache, dashboard
+from pinpayments.models import PinTransaction
+from pinpayments.utils import get_user_model
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from mock import patch
+
+
+class DashboardTests(TestCase):
+    """ Test the cached payment KPIs """
+    def setUp(self):
+        super(DashboardTests, self).setUp()
+        cache.get_shared_cache().clear()
+        for index, (succeeded, response) in enumerate((
+                (True, 'Success'), (True, 'Success'), (False, 'Card declined'),
+                (False, 'Card declined'), (False, 'Insufficient funds'))):
+            PinTransaction.objects.create(
+                transaction_token='ch_{0}'.format(index), card_token='card_1', amount=Decimal('10.00'),
+                fees=Decimal('0.50') if succeeded else None, card_type='visa',
+                ip_address='127.0.0.1', email_address='test@example.com',
+                processed=True, succeeded=succeeded, pin_response=response
+            )
+
+    def test_widgets(self):
+        """ Widgets aggregate processed charges """
+        volumes = dashboard.transaction_volumes()
+        self.assertEqual(len(volumes), 1)
+        self.assertEqual((volumes[0]['count'], volumes[0]['total'], volumes[0]['fees']),
+                         (2, Decimal('20.00'), Decimal('1.00')))
+        self.assertEqual(dashboard.success_rates()[0]['rate'], 40.0)
+        self.assertEqual(dashboard.fees_by_scheme()[0]['card_type'], 'visa')
+        self.assertEqual(
+            [(row['pin_response'], row['count']) for row in dashboard.decline_reasons()],
+            [('Card declined', 2), ('Insufficient funds', 1)]
+        )
+
+    def test_cached(self):
+        """ Widgets are computed once, then served from the cache """
+        dashboard.get_widget('success_rates')
+        with self.assertNumQueries(0):
+            entry = dashboard.get_widget('success_rates')
+        self.assertEqual(entry['value'][0]['count'], 5)
+
+    @patch('pinpayments.dashboard._get_executor')
+    def test_stale_refreshed_in_background(self, mock_executor):
+        """ Stale widgets are served while a single refresh is queued """
+        with self.settings(PIN_DASHBOARD_TTLS={'success_rates': -1}):
+            first = dashboard.get_widget('success_rates')
+            with self.assertNumQueries(0):
+                self.assertEqual(dashboard.get_widget('success_rates'), first)
+                dashboard.get_widget('success_rates')
+        self.assertEqual(mock_executor.return_value.submit.call_count, 1)
+
+    @override_settings(PIN_DEFAULT_ENVIRONMENT='live', PIN_ENVIRONMENTS={
+        'test': {'key': 'k', 'secret': 's', 'host': 'test-api.pin.net.au'},
+        'live': {'key': 'k', 'secret': 's', 'host': 'api.pin.net.au'},
+    })
+    @patch('pinpayments.objects.PinEnvironment.get_balances', autospec=True)
+    def test_balances_per_environment(self, mock_balances):
+        """ Each environment shows its own balances """
+        mock_balances.side_effect = lambda pin_env: {'AUD': (Decimal(len(pin_env.host)), Decimal('0'))}
+        self.assertEqual(
+            [(row['environment'], row['available']) for row in dashboard.balances()],
+            [('live', Decimal(len('api.pin.net.au'))), ('test', Decimal(len('test-api.pin.net.au')))]
+        )
+
+    @patch('pinpayments.objects.PinEnvironment.get_balances')
+    def test_view(self, mock_balances):
+        """ The dashboard page renders every widget """
+        mock_balances.return_value = {'AUD': (Decimal('12.34'), Decimal('5.00'))}
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        response = self.client.get(reverse('admin:pinpayments_pintransaction_dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Insufficient funds')
+        self.assertContains(response, '12.34')
+        self.assertContains(response, '40.0%')
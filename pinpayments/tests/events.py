@@ -0,0 +1,163 @@
+""" Pin event test classes """
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+from decimal import Decimal
+
+from pinpayments import signals
+from pinpayments.models import CardToken, Checkpoint, CustomerToken, PinEvent, PinTransaction, PinTransfer
+from pinpayments.objects import PinEnvironment
+from pinpayments.tests.models import FakeResponse
+from pinpayments.utils import get_user_model
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from mock import Mock, patch
+
+ENVIRONMENTS = {'test': {'key': 'k', 'secret': 's', 'host': 'test-api.pin.net.au', 'webhook_secret': 'hush'}}
+
+
+def event_data(token, event_type, data, created_at='2015-06-01T10:00:00Z'):
+    return {'token': token, 'type': event_type, 'data': data, 'created_at': created_at}
+
+
+def event_body(token, event_type, data):
+    return json.dumps(event_data(token, event_type, data))
+
+
+@override_settings(ROOT_URLCONF='pinpayments.urls', PIN_ENVIRONMENTS=ENVIRONMENTS)
+class WebhookTests(TestCase):
+    """ Test receiving events from Pin """
+    def post(self, body, secret='hush'):
+        url = reverse('pinpayments_webhook', kwargs={'environment': 'test', 'secret': secret})
+        return self.client.post(url, body, content_type='application/json')
+
+    def test_stores_event(self):
+        """ Events are stored once, even when delivered again """
+        body = event_body('evt_1', 'charge.captured', {'token': 'ch_1'})
+        self.assertEqual(self.post(body).status_code, 200)
+        self.assertEqual(self.post(body).status_code, 200)
+        event = PinEvent.objects.get()
+        self.assertEqual((event.token, event.event_type, event.environment), ('evt_1', 'charge.captured', 'test'))
+        self.assertEqual(event.payload, body)
+        self.assertIsNone(event.processed)
+
+    def test_rejects(self):
+        """ Requests with the wrong secret or without an event are rejected """
+        self.assertEqual(self.post(event_body('evt_1', 'charge.captured', {}), secret='wrong').status_code, 404)
+        self.assertEqual(self.post('not json').status_code, 400)
+        self.assertEqual(self.post(json.dumps({'type': 'charge.captured'})).status_code, 400)
+        self.assertFalse(PinEvent.objects.exists())
+
+
+class ProcessEventsTests(TestCase):
+    """ Test applying stored events """
+    def setUp(self):
+        super(ProcessEventsTests, self).setUp()
+        for token in ('ch_1', 'ch_2'):
+            PinTransaction.objects.create(
+                transaction_token=token, card_token='card_1', amount=Decimal('10.00'),
+                ip_address='127.0.0.1', email_address='test@example.com', processed=True
+            )
+        PinTransfer.objects.create(transfer_token='tfer_1', status='pending', currency='AUD', amount=100)
+        customer = CustomerToken.objects.create(user=get_user_model().objects.create(), token='cus_1')
+        CardToken.objects.create(token='card_1', customer=customer, display_number='old')
+
+    def record(self, token, event_type, data):
+        return PinEvent.objects.record('test', event_body(token, event_type, data))[0]
+
+    def test_process_pending(self):
+        """ Events are applied in order, in batches, and marked processed """
+        self.record('evt_1', 'charge.failed', {'token': 'ch_1', 'success': False, 'error_message': 'Declined'})
+        self.record('evt_2', 'charge.captured', {
+            'token': 'ch_2', 'success': True, 'status_message': 'Success', 'total_fees': 42, 'currency': 'AUD',
+        })
+        self.record('evt_3', 'transfer.created', {'token': 'tfer_1', 'status': 'pending'})
+        self.record('evt_4', 'transfer.succeeded', {'token': 'tfer_1', 'status': 'paid'})
+        self.record('evt_5', 'customer.updated', {'token': 'cus_1', 'card': {
+            'token': 'card_1', 'display_number': 'XXXX-1111', 'primary': True,
+        }})
+        self.record('evt_6', 'dispute.opened', {'token': 'dis_1'})
+        bad = self.record('evt_7', 'transfer.created', {})
+
+        self.assertEqual(PinEvent.objects.process_pending(batch_size=3), 7)
+        self.assertEqual(PinEvent.objects.process_pending(), 0)
+
+        self.assertEqual(
+            list(PinTransaction.objects.order_by('pk').values_list('succeeded', 'pin_response', 'fees')),
+            [(False, 'Declined', Decimal('0.00')), (True, 'Success', Decimal('0.42'))]
+        )
+        self.assertEqual(PinTransfer.objects.get().status, 'paid')
+        self.assertEqual(CardToken.objects.get().display_number, 'XXXX-1111')
+        self.assertFalse(PinEvent.objects.filter(processed__isnull=True).exists())
+        self.assertIn('status', PinEvent.objects.get(pk=bad.pk).error)
+
+    def test_sends_signals(self):
+        """ Changes applied from events send the same signals as changes made locally """
+        receivers = dict(
+            (signal, Mock()) for signal in
+            (signals.charge_succeeded, signals.charge_failed, signals.transfer_status_changed)
+        )
+        for signal, receiver in receivers.items():
+            signal.connect(receiver)
+            self.addCleanup(signal.disconnect, receiver)
+
+        self.record('evt_1', 'charge.failed', {'token': 'ch_1', 'success': False, 'error_message': 'Declined'})
+        self.record('evt_2', 'charge.captured', {'token': 'ch_2', 'success': True, 'status_message': 'Success'})
+        self.record('evt_3', 'transfer.succeeded', {'token': 'tfer_1', 'status': 'paid'})
+        PinEvent.objects.process_pending()
+
+        transaction = receivers[signals.charge_succeeded].call_args[1]['transaction']
+        self.assertEqual((transaction.transaction_token, transaction.succeeded), ('ch_2', True))
+        transaction = receivers[signals.charge_failed].call_args[1]['transaction']
+        self.assertEqual((transaction.transaction_token, transaction.pin_response), ('ch_1', 'Declined'))
+        transfer = receivers[signals.transfer_status_changed].call_args[1]['transfer']
+        self.assertEqual((transfer.transfer_token, transfer.status), ('tfer_1', 'paid'))
+        for receiver in receivers.values():
+            self.assertEqual(receiver.call_count, 1)
+
+        # an event that changes nothing sends nothing again
+        self.record('evt_4', 'charge.captured', {'token': 'ch_2', 'success': True, 'status_message': 'Success'})
+        PinEvent.objects.process_pending()
+        self.assertEqual(receivers[signals.charge_succeeded].call_count, 1)
+
+
+class PollEventsTests(TestCase):
+    """ Test fetching events from Pin """
+    def setUp(self):
+        super(PollEventsTests, self).setUp()
+        PinTransfer.objects.create(transfer_token='tfer_1', status='pending', currency='AUD', amount=100)
+        self.events = [
+            event_data('evt_{0}'.format(index), 'transfer.created', {'token': 'tfer_1', 'status': status},
+                       '2015-06-01T10:00:0{0}Z'.format(index))
+            for index, status in ((1, 'pending'), (2, 'pending'), (3, 'paid'), (4, 'failed'))
+        ]
+
+    def pages(self, *pages):
+        """ Responses for pages of events, newest first """
+        return [
+            FakeResponse(200, json.dumps({
+                'response': list(reversed(events)),
+                'pagination': {'current': number, 'next': number + 1 if number < len(pages) else None},
+            }))
+            for number, events in enumerate(pages, 1)
+        ]
+
+    @patch('requests.get')
+    def test_poll(self, mock_request):
+        """ Only new events are fetched, stored once and applied """
+        PinEvent.objects.record('test', json.dumps(self.events[1]))
+        mock_request.side_effect = self.pages(self.events[2:3], self.events[0:2])
+        self.assertEqual(PinEnvironment('test').poll_events(), 2)
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual(PinTransfer.objects.get().status, 'paid')
+        self.assertEqual(json.loads(Checkpoint.objects.get(name='pinpayments:events:test').value)['token'], 'evt_3')
+
+        mock_request.reset_mock()
+        mock_request.side_effect = self.pages(self.events[2:4], self.events[0:2])
+        self.assertEqual(PinEnvironment('test').poll_events(), 1)
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(PinTransfer.objects.get().status, 'failed')
+        self.assertEqual(PinEvent.objects.count(), 4)
+        self.assertFalse(PinEvent.objects.filter(processed__isnull=True).exists())
@@ -0,0 +1,108 @@
+""" Background job test classes """
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+from datetime import timedelta
+from decimal import Decimal
+
+from pinpayments.jobs import reprocess_transaction, resume_stale_jobs, run_job, run_job_or_fail, start_job
+from pinpayments.models import BackgroundJob, CardToken, CustomerToken, PinTransaction
+from pinpayments.tests.models import FakeResponse
+from pinpayments.utils import get_user_model
+
+from django.test import TestCase
+from django.utils import timezone
+from mock import patch
+
+
+def fake_charge(url, **kwargs):
+    """ Pin /charges/{token} responses, not found for tokens ending in 'x' """
+    token = url.rsplit('/', 1)[1]
+    if token.endswith('x'):
+        return FakeResponse(404, json.dumps({'error': 'not_found', 'error_description': 'No such charge'}))
+    return FakeResponse(200, json.dumps({'response': {
+        'token': token, 'success': True, 'status_message': 'Success', 'total_fees': 42,
+    }}))
+
+
+class BackgroundJobTests(TestCase):
+    """ Test running actions on objects in the background """
+    def setUp(self):
+        super(BackgroundJobTests, self).setUp()
+        self.transactions = [
+            PinTransaction.objects.create(
+                transaction_token=token, card_token='card_1', amount=Decimal('1.00'),
+                ip_address='127.0.0.1', email_address='test@example.com', processed=True
+            )
+            for token in ('ch_1', 'ch_2', 'ch_x')
+        ]
+
+    @patch('requests.get', side_effect=fake_charge)
+    def test_resync_transactions(self, mock_request):
+        """ Each object is processed, failures are counted and recorded """
+        job = start_job('resync_transactions', [transaction.pk for transaction in self.transactions])
+        run_job(job.pk, max_workers=1)
+
+        job = BackgroundJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, 'finished')
+        self.assertEqual((job.total, job.succeeded, job.failed), (3, 2, 1))
+        self.assertIn('No such charge', job.errors)
+        transaction = PinTransaction.objects.get(transaction_token='ch_1')
+        self.assertTrue(transaction.succeeded)
+        self.assertEqual(transaction.fees, Decimal('0.42'))
+
+    def test_reprocess_skips_processed(self):
+        """ Transactions already sent to Pin are not charged again """
+        job = start_job('reprocess_transactions', [self.transactions[0].pk])
+        run_job(job.pk, max_workers=1)
+        self.assertEqual(BackgroundJob.objects.get(pk=job.pk).failed, 1)
+
+    def test_failed_job(self):
+        """ A job that raises is marked failed with the error """
+        job = start_job('resync_transactions', [self.transactions[0].pk])
+        with patch('pinpayments.jobs.iterate_queryset', side_effect=ValueError('database is gone')):
+            run_job_or_fail(job.pk, max_workers=1)
+        job = BackgroundJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('database is gone', job.errors)
+
+    @patch('requests.get', side_effect=fake_charge)
+    def test_resume_stale_jobs(self, mock_request):
+        """ Jobs left running by a stopped process are run again once stale """
+        job = start_job('resync_transactions', [self.transactions[0].pk])
+        BackgroundJob.objects.filter(pk=job.pk).update(status='running')
+        self.assertEqual(resume_stale_jobs(max_workers=1), [])
+
+        BackgroundJob.objects.filter(pk=job.pk).update(updated=timezone.now() - timedelta(hours=1))
+        self.assertEqual(resume_stale_jobs(max_workers=1), [job.pk])
+        job = BackgroundJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.succeeded), ('finished', 1))
+
+    @patch('requests.post')
+    def test_reprocess_claims_transaction(self, mock_request):
+        """ A transaction sent to Pin since it was loaded is not charged again """
+        stale = PinTransaction.objects.get(pk=self.transactions[0].pk)
+        stale.processed = False
+        with self.assertRaises(ValueError):
+            reprocess_transaction(stale)
+        self.assertFalse(mock_request.called)
+
+    @patch('requests.get')
+    def test_refresh_customers(self, mock_request):
+        """ Cards are updated, added and removed to match Pin """
+        customer = CustomerToken.objects.create(user=get_user_model().objects.create(), token='cus_1')
+        CardToken.objects.create(token='card_1', customer=customer, display_number='old')
+        CardToken.objects.create(token='card_gone', customer=customer)
+        mock_request.return_value = FakeResponse(200, json.dumps({
+            'response': [
+                {'token': 'card_1', 'display_number': 'XXXX-1111', 'primary': True},
+                {'token': 'card_2', 'display_number': 'XXXX-2222', 'primary': False},
+            ],
+            'pagination': {'current': 1, 'next': None},
+        }))
+        run_job(start_job('refresh_customers', [customer.pk]).pk, max_workers=1)
+        self.assertEqual(
+            sorted(customer.cards.values_list('token', 'display_number')),
+            [('card_1', 'XXXX-1111'), ('card_2', 'XXXX-2222')]
+        )
@@ -3,17 +3,31 @@
 from __future__ import absolute_import, unicode_literals
 
 import json
+import warnings
+from datetime import timedelta
+from decimal import Decimal
+from pinpayments import cache, objects
 from pinpayments.models import (
+    BalanceSnapshot,
+    BankAccount,
     ConfigError,
     CustomerToken,
     PinError,
-    PinTransaction
+    PinRecipient,
+    PinTransaction,
+    PinTransfer,
+    PinTransferLineItem
 , CardToken)
-from pinpayments.utils import get_user_model
+from pinpayments.objects import PinEnvironment
+from pinpayments.utils import (
+    SINGLE_UNIT_CURRENCIES, add_months, concurrent_map, get_base_amount, get_user_model, get_value
+)
 
 from django.conf import settings
-from django.test import TestCase
-from django.test.utils import override_settings
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import modify_settings, override_settings
+from django.utils import timezone
 from mock import patch
 from requests import Response
 from six import binary_type
@@ -170,6 +184,148 @@ class CardTokenTests(TestCase):
         self.assertEqual(old_primary_card.primary, False)
 
 
+class DeleteCardTests(TestCase):
+    """ Test removing cards from customers """
+    def setUp(self):
+        """ Two customers with a card each """
+        super(DeleteCardTests, self).setUp()
+        user = User.objects.create()
+        self.customer = CustomerToken.objects.create(user=user, token='cus_1', environment='test')
+        self.other_customer = CustomerToken.objects.create(user=user, token='cus_2', environment='test')
+        self.card = CardToken.objects.create(token='card_1', customer=self.customer)
+        self.other_card = CardToken.objects.create(token='card_2', customer=self.other_customer)
+
+    @patch('requests.delete')
+    def test_delete_card(self, mock_request):
+        """ An existence check and a single DELETE """
+        mock_request.return_value = FakeResponse(204, '')
+        with self.assertNumQueries(2):
+            self.assertTrue(self.customer.delete_card(self.card))
+        self.assertFalse(CardToken.objects.filter(pk=self.card.pk).exists())
+        self.assertTrue(CardToken.objects.filter(pk=self.other_card.pk).exists())
+
+    @patch('requests.delete')
+    def test_delete_other_customers_card(self, mock_request):
+        """ Cards of other customers cannot be deleted """
+        with self.assertRaises(PinError):
+            self.customer.delete_card(self.other_card)
+        self.assertFalse(mock_request.called)
+        self.assertTrue(CardToken.objects.filter(pk=self.other_card.pk).exists())
+
+
+class TokenCacheTests(TransactionTestCase):
+    """ Test resolving tokens through the cache, with real commits """
+    def setUp(self):
+        """ A customer with two cards, and empty caches """
+        super(TokenCacheTests, self).setUp()
+        cache.local_cache.clear()
+        cache.get_shared_cache().clear()
+        self.customer = CustomerToken.objects.create(
+            user=User.objects.create(), token='cus_1', environment='test'
+        )
+        self.card = CardToken.objects.create(token='card_1', customer=self.customer, primary=True)
+        self.other_card = CardToken.objects.create(token='card_2', customer=self.customer)
+
+    def test_read_through(self):
+        """ Only the first lookup hits the database """
+        with self.assertNumQueries(1):
+            self.assertEqual(CustomerToken.objects.get_cached('cus_1'), self.customer)
+        with self.assertNumQueries(0):
+            self.assertEqual(CustomerToken.objects.get_cached('cus_1'), self.customer)
+        cache.local_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(CustomerToken.objects.get_cached('cus_1'), self.customer)
+        with self.assertRaises(CustomerToken.DoesNotExist):
+            CustomerToken.objects.get_cached('cus_missing')
+
+    def test_invalidated_on_save(self):
+        """ Saving an instance drops it from the cache """
+        CustomerToken.objects.get_cached('cus_1')
+        self.customer.active = False
+        self.customer.save()
+        self.assertFalse(CustomerToken.objects.get_cached('cus_1').active)
+
+    def test_invalidated_on_commit(self):
+        """ The cache is only invalidated once the change is committed """
+        CustomerToken.objects.get_cached('cus_1')
+        with transaction.atomic():
+            self.customer.active = False
+            self.customer.save()
+            self.assertTrue(cache.local_cache.get(cache.cache_key(CustomerToken, 'cus_1')).active)
+        self.assertFalse(CustomerToken.objects.get_cached('cus_1').active)
+
+        try:
+            with transaction.atomic():
+                self.customer.active = True
+                self.customer.save()
+                raise ValueError("roll back")
+        except ValueError:
+            pass
+        self.assertFalse(CustomerToken.objects.get_cached('cus_1').active)
+
+    @patch('requests.put')
+    def test_invalidated_on_set_primary_card(self, mock_request):
+        """ Cards updated in bulk when the primary card changes are dropped """
+        mock_request.return_value = FakeResponse(200, json.dumps({'response': {}}))
+        self.assertTrue(CardToken.objects.get_cached('card_1').primary)
+        self.customer.set_primary_card(self.other_card)
+        self.assertFalse(CardToken.objects.get_cached('card_1').primary)
+        self.assertTrue(CardToken.objects.get_cached('card_2').primary)
+
+    @patch('requests.delete')
+    def test_invalidated_on_delete_card(self, mock_request):
+        """ Deleted cards are no longer found """
+        mock_request.return_value = FakeResponse(204, '')
+        CardToken.objects.get_cached('card_2')
+        self.customer.delete_card(self.other_card)
+        with self.assertRaises(CardToken.DoesNotExist):
+            CardToken.objects.get_cached('card_2')
+
+
+class CardTokenExpiryTests(TestCase):
+    """ Test the database-side card expiry filters """
+    def setUp(self):
+        """ Create cards expiring around the current month """
+        super(CardTokenExpiryTests, self).setUp()
+        today = timezone.now().date()
+        self.cards = {}
+        for offset in (-13, -1, 0, 1, 2, 24):
+            year, month = add_months(today.year, today.month, offset)
+            self.cards[offset] = CardToken.objects.create(
+                token='card_{0}'.format(offset), expiry_year=year, expiry_month=month
+            )
+        self.no_expiry = CardToken.objects.create(token='card_none')
+
+    def tokens(self, queryset):
+        return set(queryset.values_list('token', flat=True))
+
+    def test_expired(self):
+        """ Cards whose expiry month has passed """
+        self.assertEqual(self.tokens(CardToken.objects.expired()), set(['card_-13', 'card_-1']))
+        for offset, card in self.cards.items():
+            self.assertEqual(card.has_expired, offset < 0)
+        self.assertFalse(self.no_expiry.has_expired)
+
+    def test_valid(self):
+        """ Cards that can still be charged, the current month included """
+        self.assertEqual(
+            self.tokens(CardToken.objects.valid()),
+            set(['card_0', 'card_1', 'card_2', 'card_24'])
+        )
+
+    def test_expiring_within(self):
+        """ Cards expiring in the next n months """
+        self.assertEqual(self.tokens(CardToken.objects.expiring_within()), set(['card_0']))
+        self.assertEqual(
+            self.tokens(CardToken.objects.expiring_within(months=2)),
+            set(['card_0', 'card_1'])
+        )
+        self.assertEqual(
+            self.tokens(CardToken.objects.filter(token__in=['card_2']).expiring_within(months=3)),
+            set(['card_2'])
+        )
+
+
 class CreateFromCardTokenTests(TestCase):
     """ Test the creation of customer tokens from card tokens """
     def setUp(self):
@@ -273,6 +429,46 @@ class CreateFromCardTokenTests(TestCase):
         self.assertEqual(customer.cards.all()[0].display_number, 'XXXX-XXXX-XXXX-0000')
         self.assertEqual(customer.cards.all()[0].scheme, 'master')
 
+    @patch('requests.post')
+    def test_card_customer(self, mock_request):
+        """ Cards are stored against their customer """
+        mock_request.return_value = FakeResponse(200, self.response_data)
+        customer = CustomerToken.objects.create_from_card_token(
+            '1234', self.user, environment='test'
+        )
+        card = CardToken.objects.get(token='54321')
+        self.assertEqual(card.customer, customer)
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.assertEqual(list(card.customertoken_set), [customer])
+
+
+
+@modify_settings(INSTALLED_APPS={'append': 'pinpayments.tests.customers'})
+class CustomCustomerModelTests(TestCase):
+    """ Test a CustomerTokenAbstract implementation other than CustomerToken """
+    @classmethod
+    def setUpClass(cls):
+        super(CustomCustomerModelTests, cls).setUpClass()
+        from pinpayments.tests.customers.models import MemberToken
+        cls.model = MemberToken
+        # the test app has no migrations, create its tables within the class transaction
+        with connection.schema_editor() as editor:
+            editor.create_model(MemberToken)
+
+    def test_cards_relation(self):
+        """ Cards are added to the model's own relation rather than CardToken.customer """
+        customer = self.model.objects.create(member_number='M1', token='cus_1', environment='test')
+        card = CardToken.objects.create_from_data({
+            'token': 'card_1', 'display_number': 'XXXX-XXXX-XXXX-0000', 'scheme': 'master',
+            'expiry_month': 6, 'expiry_year': 2017, 'name': 'Roland Robot', 'primary': True,
+        }, customer=customer)
+        self.assertIsNone(CardToken.objects.get(pk=card.pk).customer)
+        self.assertEqual(list(customer.cards.all()), [card])
+        self.assertEqual(list(card.member_tokens.all()), [customer])
+        self.assertEqual(customer.primary_card, card)
+        self.assertFalse(CustomerToken.objects.filter(cards=card).exists())
+
 
 class PinTransactionTests(TestCase):
     """ Transaction construction/init related tests """
@@ -463,3 +659,516 @@ class ProcessTransactionsTests(TestCase):
         self.assertEqual(self.transaction.card_country, 'Australia')
         self.assertEqual(self.transaction.card_number, 'XXXX-XXXX-XXXX-0000')
         self.assertEqual(self.transaction.card_type, 'master')
+
+
+def fake_send_transfer(url, params=None, **kwargs):
+    """
+    Pin /transfers responses, rejecting transfers to the recipient 'rp_bad',
+    and failing at a proxy for 'rp_proxy'
+    """
+    if params['recipient'] == 'rp_proxy':
+        return FakeResponse(502, '<html>Bad Gateway</html>')
+    if params['recipient'] == 'rp_bad':
+        return FakeResponse(200, json.dumps({
+            'error': 'invalid_resource', 'error_description': 'Recipient is invalid',
+        }))
+    return FakeResponse(200, json.dumps({'response': {
+        'token': 'tfer_{0}_{1}'.format(params['recipient'], params['currency']),
+        'status': 'pending',
+        'currency': params['currency'],
+        'description': params['description'],
+        'amount': params['amount'],
+    }}))
+
+
+class PinTransferBatchTests(TestCase):
+    """ Test sending batches of transfers """
+    def setUp(self):
+        super(PinTransferBatchTests, self).setUp()
+        self.alice = PinRecipient.objects.create(token='rp_alice', email='alice@example.com')
+        self.bob = PinRecipient.objects.create(token='rp_bob', email='bob@example.com')
+        self.bad = PinRecipient.objects.create(token='rp_bad', email='bad@example.com')
+        self.payouts = [
+            (self.alice, 1000, 'AUD'),
+            (self.bob, 500, 'AUD'),
+            (self.alice, 250, 'AUD'),
+            (self.alice, 300, 'USD'),
+            (self.bad, 100, 'AUD'),
+        ]
+
+    @patch('requests.post', side_effect=fake_send_transfer)
+    def test_send_batch(self, mock_request):
+        """ Amounts are aggregated per recipient and currency """
+        transfers = PinTransfer.send_batch(self.payouts, 'Payout', 'week-1', max_workers=1)
+        by_key = dict(((t.recipient.token, t.currency), t) for t in transfers)
+        self.assertEqual(len(transfers), 4)
+        self.assertEqual(by_key[('rp_alice', 'AUD')].amount, 1250)
+        self.assertEqual(by_key[('rp_alice', 'AUD')].transfer_token, 'tfer_rp_alice_AUD')
+        self.assertEqual(by_key[('rp_alice', 'AUD')].status, 'pending')
+        self.assertEqual(by_key[('rp_bob', 'AUD')].amount, 500)
+        self.assertEqual(by_key[('rp_alice', 'USD')].amount, 300)
+        self.assertEqual(by_key[('rp_bad', 'AUD')].status, 'error')
+        self.assertIsNone(by_key[('rp_bad', 'AUD')].transfer_token)
+        self.assertEqual(mock_request.call_count, 4)
+
+    @patch('requests.post', side_effect=fake_send_transfer)
+    def test_rerun_batch(self, mock_request):
+        """ Re-running a batch only retries the transfers that were not made """
+        PinTransfer.send_batch(self.payouts, 'Payout', 'week-1', max_workers=1)
+        PinTransfer.objects.filter(recipient=self.bob).update(status='sending', transfer_token=None)
+        mock_request.reset_mock()
+
+        transfers = PinTransfer.send_batch(self.payouts, 'Payout', 'week-1', max_workers=1)
+        self.assertEqual(len(transfers), 4)
+        self.assertEqual(
+            [call[1]['params']['recipient'] for call in mock_request.call_args_list], ['rp_bad']
+        )
+
+    @patch('requests.post', side_effect=fake_send_transfer)
+    def test_send_new(self, mock_request):
+        """ Single transfers are still sent and saved """
+        transfer = PinTransfer.send_new(1000, 'Payout', self.alice)
+        self.assertIsNotNone(transfer.pk)
+        self.assertEqual(transfer.transfer_token, 'tfer_rp_alice_AUD')
+        self.assertEqual(transfer.value, 10)
+        self.assertEqual(transfer.environment, 'test')
+
+    @patch('requests.post', side_effect=fake_send_transfer)
+    def test_no_response(self, mock_request):
+        """ Transfers Pin may have made are left 'sending', and not sent again """
+        proxy = PinRecipient.objects.create(token='rp_proxy', email='proxy@example.com')
+        PinTransfer.send_batch([(proxy, 100, 'AUD')], 'Payout', 'week-1', max_workers=1)
+        self.assertEqual(PinTransfer.objects.get(recipient=proxy).status, 'sending')
+        PinTransfer.send_batch([(proxy, 100, 'AUD')], 'Payout', 'week-1', max_workers=1)
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_one_transfer_per_recipient_and_currency(self):
+        """ A batch can't hold two transfers to a recipient in one currency """
+        PinTransfer.objects.create(batch_reference='week-1', recipient=self.alice, currency='AUD', amount=1)
+        with self.assertRaises(IntegrityError):
+            PinTransfer.objects.create(batch_reference='week-1', recipient=self.alice, currency='AUD', amount=1)
+
+
+class PinTransferRefreshTests(TestCase):
+    """ Test refreshing the status of transfers """
+    def setUp(self):
+        super(PinTransferRefreshTests, self).setUp()
+        recipient = PinRecipient.objects.create(token='rp_1', email='test@example.com')
+        for token, status in (('tfer_1', 'pending'), ('tfer_2', 'pending'), ('tfer_3', 'paid'),
+                              (None, 'error')):
+            PinTransfer.objects.create(
+                transfer_token=token, status=status, currency='AUD', amount=100, recipient=recipient
+            )
+        self.pages = {
+            '1': {'response': [
+                {'token': 'tfer_new', 'status': 'pending'},
+                {'token': 'tfer_2', 'status': 'pending'},
+            ], 'pagination': {'current': 1, 'next': 2}},
+            '2': {'response': [
+                {'token': 'tfer_1', 'status': 'paid'},
+            ], 'pagination': {'current': 2, 'next': 3}},
+        }
+
+    def statuses(self):
+        return dict(PinTransfer.objects.exclude(transfer_token=None).values_list('transfer_token', 'status'))
+
+    def test_in_flight(self):
+        """ Only transfers accepted by Pin without a final status are in flight """
+        self.assertEqual(
+            set(PinTransfer.objects.in_flight().values_list('transfer_token', flat=True)),
+            set(['tfer_1', 'tfer_2'])
+        )
+
+    @patch('requests.get')
+    def test_refresh_by_page(self, mock_request):
+        """ Pages are fetched until every transfer was seen, changes saved at once """
+        mock_request.side_effect = lambda url, **kwargs: FakeResponse(
+            200, json.dumps(self.pages[url.rsplit('=', 1)[1]])
+        )
+        with self.assertNumQueries(2):
+            changes = PinTransfer.objects.refresh_statuses()
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual(self.statuses(), {'tfer_1': 'paid', 'tfer_2': 'pending', 'tfer_3': 'paid'})
+
+    @patch('requests.get')
+    def test_refresh_by_token(self, mock_request):
+        """ Transfers can be fetched one by one """
+        mock_request.side_effect = lambda url, **kwargs: FakeResponse(200, json.dumps({
+            'response': {'token': url.rsplit('/', 1)[1], 'status': 'failed'}
+        }))
+        PinTransfer.objects.refresh_statuses(by_token=True, max_workers=1)
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual(self.statuses(), {'tfer_1': 'failed', 'tfer_2': 'failed', 'tfer_3': 'paid'})
+
+    @override_settings(PIN_ENVIRONMENTS={
+        'test': {'key': 'k', 'secret': 's', 'host': 'test-api.pin.net.au'},
+        'live': {'key': 'k', 'secret': 's', 'host': 'api.pin.net.au'},
+    })
+    @patch('requests.get')
+    def test_refresh_per_environment(self, mock_request):
+        """ Transfers are fetched from the environment they were sent from """
+        mock_request.side_effect = lambda url, **kwargs: FakeResponse(200, json.dumps({'response': {
+            'token': url.rsplit('/', 1)[1],
+            'status': 'failed' if url.startswith('https://test-api.') else 'paid',
+        }}))
+        PinTransfer.objects.create(
+            transfer_token='tfer_live', status='pending', currency='AUD', amount=100, environment='live'
+        )
+        self.assertEqual(
+            list(PinTransfer.objects.in_flight().for_environment('live').values_list('transfer_token', flat=True)),
+            ['tfer_live']
+        )
+        PinTransfer.objects.refresh_statuses(environment='live', by_token=True, max_workers=1)
+        self.assertEqual(mock_request.call_count, 1)
+        PinTransfer.objects.refresh_statuses(by_token=True, max_workers=1)
+        self.assertEqual(
+            self.statuses(),
+            {'tfer_1': 'failed', 'tfer_2': 'failed', 'tfer_3': 'paid', 'tfer_live': 'paid'}
+        )
+        self.assertEqual(PinTransfer.objects.get(transfer_token='tfer_live').refresh_status(), 'paid')
+
+
+class PinTransferLineItemTests(TestCase):
+    """ Test importing the line items of a transfer """
+    def setUp(self):
+        super(PinTransferLineItemTests, self).setUp()
+        self.transfer = PinTransfer.objects.create(
+            transfer_token='tfer_1', status='paid', currency='AUD', amount=300
+        )
+        self.charge = PinTransaction.objects.create(
+            transaction_token='ch_2', card_token='card_1', amount=2, ip_address='127.0.0.1',
+            email_address='test@example.com'
+        )
+        items = [
+            {'type': 'charge', 'object': 'charge', 'token': 'ch_{0}'.format(index), 'amount': 100,
+             'currency': 'AUD', 'created_at': '2015-06-22T12:00:00Z'}
+            for index in range(5)
+        ]
+        self.pages = dict(
+            ('{0}'.format(page), json.dumps({
+                'response': items[(page - 1) * 2:page * 2],
+                'pagination': {'current': page, 'per_page': 2, 'pages': 3, 'count': 5},
+            }))
+            for page in (1, 2, 3)
+        )
+
+    @patch('requests.get')
+    def test_import(self, mock_request):
+        """ Every page is imported in order, and charges are linked """
+        mock_request.side_effect = lambda url, **kwargs: FakeResponse(200, self.pages[url.rsplit('=', 1)[1]])
+        self.assertEqual(
+            PinTransferLineItem.objects.import_for_transfer(self.transfer, max_workers=1, batch_size=3), 5
+        )
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(
+            list(self.transfer.line_items.values_list('record_token', flat=True)),
+            ['ch_{0}'.format(index) for index in range(5)]
+        )
+        self.assertEqual(list(self.charge.transfer_line_items.values_list('position', flat=True)), [2])
+
+        # a second import replaces the first
+        self.transfer.import_line_items(max_workers=1)
+        self.assertEqual(self.transfer.line_items.count(), 5)
+
+    @patch('requests.get')
+    def test_failed_page(self, mock_request):
+        """ A page that cannot be fetched leaves the previous import in place """
+        mock_request.side_effect = lambda url, **kwargs: FakeResponse(200, self.pages[url.rsplit('=', 1)[1]])
+        self.transfer.import_line_items(max_workers=1)
+        self.pages['3'] = json.dumps({'error': 'server_error', 'error_description': 'Oops'})
+        with self.assertRaises(PinError):
+            self.transfer.import_line_items(max_workers=1)
+        self.assertEqual(self.transfer.line_items.count(), 5)
+
+
+def fake_create_recipient(url, params=None, **kwargs):
+    """ Pin /recipients responses, rejecting account numbers starting with 'bad' """
+    if 'bank_account_token' in params:
+        bank_account = {'token': params['bank_account_token'], 'number': 'XXX'}
+    elif params['bank_account[number]'].startswith('bad'):
+        return FakeResponse(422, json.dumps({
+            'error': 'invalid_resource', 'error_description': 'Invalid account number',
+        }))
+    else:
+        bank_account = {
+            'token': 'ba_{0}'.format(params['bank_account[number]']),
+            'number': 'XXX{0}'.format(params['bank_account[number]'][-3:]),
+        }
+    bank_account.update({'name': 'Account', 'bsb': '123456', 'bank_name': '', 'branch': ''})
+    return FakeResponse(201, json.dumps({'response': {
+        'token': 'rp_{0}'.format(params['email']),
+        'email': params['email'],
+        'name': params['name'],
+        'bank_account': bank_account,
+    }}))
+
+
+@override_settings(PIN_ENVIRONMENTS={
+    'test': {'key': 'key1', 'secret': 'secret1', 'host': 'test-api.pin.net.au'},
+    'live': {'key': 'key2', 'secret': 'secret2', 'host': 'api.pin.net.au'},
+})
+class PinRecipientCreationTests(TestCase):
+    """ Test creating recipients with their bank accounts """
+    def account(self, email, number):
+        return {'email': email, 'account_name': 'Account', 'bsb': 123456, 'number': number}
+
+    @patch('requests.post', side_effect=fake_create_recipient)
+    def test_create_with_bank_account(self, mock_request):
+        """ The recipient is created in the requested environment """
+        recipient = PinRecipient.create_with_bank_account(
+            'a@example.com', 'Account', 123456, '987654321', environment='live'
+        )
+        self.assertEqual(recipient.environment, 'live')
+        self.assertEqual(recipient.bank_account.token, 'ba_987654321')
+        self.assertEqual(recipient.bank_account.environment, 'live')
+        self.assertIn('api.pin.net.au', mock_request.call_args[0][0])
+
+    @patch('requests.post', side_effect=fake_create_recipient)
+    def test_bulk_create(self, mock_request):
+        """ Bank accounts are sent to Pin and stored once, failures are reported """
+        accounts = [
+            self.account('a@example.com', '111111'),
+            self.account('b@example.com', '222222'),
+            self.account('c@example.com', '111111'),
+            self.account('d@example.com', 'bad111'),
+            self.account('e@example.com', 'bad111'),
+            self.account('f@example.com', '111111'),
+        ]
+        results = list(PinRecipient.objects.bulk_create_with_bank_accounts(
+            accounts, environment='live', max_workers=1, batch_size=4
+        ))
+        recipients = dict(
+            (account['email'], recipient) for account, recipient, error in results if error is None
+        )
+        failed = sorted(account['email'] for account, recipient, error in results if error is not None)
+        self.assertEqual(failed, ['d@example.com', 'e@example.com'])
+        self.assertEqual(sorted(recipients), ['a@example.com', 'b@example.com', 'c@example.com', 'f@example.com'])
+        self.assertEqual(mock_request.call_count, 5)
+        self.assertEqual(BankAccount.objects.filter(environment='live').count(), 2)
+        for email in ('c@example.com', 'f@example.com'):
+            self.assertEqual(recipients[email].bank_account, recipients['a@example.com'].bank_account)
+        self.assertEqual(PinRecipient.objects.get(token='rp_f@example.com').environment, 'live')
+
+
+class EnvironmentRegistryTests(TestCase):
+    """ Test sharing PinEnvironments """
+    def test_shared(self):
+        """ Environments are created once, and again when the Pin settings change """
+        pin_env = PinEnvironment.get('test')
+        self.assertIs(PinEnvironment.get('test'), pin_env)
+        with override_settings(PIN_ENVIRONMENTS={'test': {'key': 'k2', 'secret': 's2', 'host': 'h'}}):
+            self.assertEqual(PinEnvironment.get('test').secret, 's2')
+        self.assertEqual(PinEnvironment.get('test').secret, pin_env.secret)
+        self.assertIsNot(PinEnvironment.get('test'), pin_env)
+
+    @override_settings(PIN_ENVIRONMENTS={'live': {'key': 'k', 'secret': 's', 'host': 'h'}},
+                       PIN_DEFAULT_ENVIRONMENT='live')
+    def test_exact_name(self):
+        """ Only a missing name means the default environment, 'test' must be configured """
+        self.assertEqual(PinEnvironment.get().name, 'live')
+        self.assertRaises(ConfigError, PinEnvironment.get, 'test')
+        transaction = PinTransaction(
+            card_token='card_1', ip_address='127.0.0.1', amount=1, email_address='test@example.com',
+            environment='test'
+        )
+        self.assertRaises(PinError, transaction.save)
+
+    @override_settings(PIN_ENVIRONMENTS=ENV_MISSING_SECRET)
+    def test_invalid(self):
+        """ Environments that are not correctly defined raise every time """
+        for _attempt in range(2):
+            self.assertRaises(ConfigError, PinEnvironment.get, 'test')
+
+
+class ConnectionWarmupTests(TestCase):
+    """ Test pooled sessions and opening connections ahead of time """
+    def test_session_per_process(self):
+        """ Sessions are shared within a process, not with forked ones """
+        session = objects.get_session('test-api.pin.net.au')
+        self.assertIs(objects.get_session('test-api.pin.net.au'), session)
+        with patch('pinpayments.objects.os.getpid', return_value=-1):
+            self.assertIsNot(objects.get_session('test-api.pin.net.au'), session)
+
+    @override_settings(PIN_HTTP_WARMUP=2, PIN_ENVIRONMENTS={
+        'test': {'key': 'k', 'secret': 's', 'host': 'test-api.pin.net.au'},
+        'live': {'key': 'k', 'secret': 's', 'host': 'api.pin.net.au'},
+        'live2': {'key': 'k', 'secret': 's', 'host': 'api.pin.net.au'},
+    })
+    @patch('requests.Session.head')
+    def test_warmup(self, mock_head):
+        """ Each host gets the configured number of connections, and the time taken is recorded """
+        times = objects.warmup()
+        self.assertEqual(sorted(times), ['api.pin.net.au', 'test-api.pin.net.au'])
+        self.assertEqual(mock_head.call_count, 4)
+        self.assertEqual(objects.warmup_times['api.pin.net.au'], times['api.pin.net.au'])
+
+    @override_settings(PIN_HTTP_WARMUP=True)
+    @patch('requests.Session.get')
+    def test_requests_use_session(self, mock_get):
+        """ With PIN_HTTP_WARMUP, calls to Pin go through the pooled session """
+        mock_get.return_value = FakeResponse(200, json.dumps({'response': {'available': [], 'pending': []}}))
+        PinEnvironment.get('test').pin_get('/balance')
+        self.assertTrue(mock_get.called)
+
+
+class BalanceTests(TestCase):
+    """ Test fetching the balances of a Pin account """
+    def setUp(self):
+        super(BalanceTests, self).setUp()
+        cache.get_shared_cache().clear()
+        self.response = FakeResponse(200, json.dumps({'response': {
+            'available': [{'amount': 1000, 'currency': 'AUD'}, {'amount': 50, 'currency': 'USD'}],
+            'pending': [{'amount': 200, 'currency': 'AUD'}, {'amount': 0, 'currency': 'USD'},
+                        {'amount': 70, 'currency': 'NZD'}],
+        }}))
+
+    @patch('requests.get')
+    def test_balances(self, mock_request):
+        """ Every currency comes from one cached request """
+        mock_request.return_value = self.response
+        pin_env = PinEnvironment('test')
+        self.assertEqual(pin_env.get_balances(), {
+            'AUD': (1000, 200), 'USD': (50, 0), 'NZD': (None, 70),
+        })
+        self.assertEqual(pin_env.get_available_balance('AUD'), 1000)
+        self.assertEqual(pin_env.get_pending_balance('USD'), 0)
+        self.assertEqual(pin_env.get_balance('USD'), (50, 0))
+        with self.assertRaises(PinError):
+            pin_env.get_balance('NZD')
+        self.assertEqual(mock_request.call_count, 1)
+
+        pin_env.get_balances(use_cache=False)
+        self.assertEqual(mock_request.call_count, 2)
+
+    @override_settings(PIN_BALANCE_CACHE_TIMEOUT=0)
+    @patch('requests.get')
+    def test_cache_disabled(self, mock_request):
+        """ The cache can be turned off """
+        mock_request.return_value = self.response
+        PinEnvironment('test').get_available_balance()
+        PinEnvironment('test').get_pending_balance()
+        self.assertEqual(mock_request.call_count, 2)
+
+
+class BalanceSnapshotTests(TestCase):
+    """ Test thinning out old balance snapshots """
+    def test_downsample(self):
+        """ Recent snapshots are kept, older ones hourly, then daily, then none """
+        now = timezone.now()
+        day = now.replace(hour=12, minute=0, second=0, microsecond=0)
+        times = []
+        for days_ago in (0, 10, 100, 500):
+            for minutes in (0, 10, 70):
+                times.append(day - timedelta(days=days_ago) + timedelta(minutes=minutes))
+        BalanceSnapshot.objects.bulk_create([
+            BalanceSnapshot(environment='test', currency=currency, available=1, pending=0, recorded=recorded)
+            for recorded in times for currency in ('AUD', 'USD')
+        ])
+
+        BalanceSnapshot.objects.downsample(now=now + timedelta(days=1))
+
+        remaining = BalanceSnapshot.objects.filter(currency='AUD').order_by('recorded')
+        self.assertEqual(list(remaining.values_list('recorded', flat=True)), [
+            # daily
+            times[8],
+            # hourly
+            times[4], times[5],
+            # recent
+            times[0], times[1], times[2],
+        ])
+        self.assertEqual(BalanceSnapshot.objects.filter(currency='USD').count(), 6)
+
+    @override_settings(PIN_DEFAULT_ENVIRONMENT='live', PIN_ENVIRONMENTS={
+        'test': {'key': 'k', 'secret': 's', 'host': 'test-api.pin.net.au'},
+        'live': {'key': 'k', 'secret': 's', 'host': 'api.pin.net.au'},
+    })
+    @patch('requests.get')
+    def test_record_each_environment(self, mock_request):
+        """ Each environment's own balances are recorded, 'test' isn't the default one """
+        def balance(url, **kwargs):
+            amount = 100 if url.startswith('https://test-api.') else 900
+            return FakeResponse(200, json.dumps({'response': {
+                'available': [{'amount': amount, 'currency': 'AUD'}], 'pending': [],
+            }}))
+        mock_request.side_effect = balance
+        BalanceSnapshot.objects.record(max_workers=1)
+        self.assertEqual(
+            sorted(BalanceSnapshot.objects.values_list('environment', 'available')),
+            [('live', 900), ('test', 100)]
+        )
+
+
+class CurrencyValueTests(TestCase):
+    """ Test converting amounts between base units and values """
+    def setUp(self):
+        super(CurrencyValueTests, self).setUp()
+        for amount, currency in ((5000, 'AUD'), (1000, 'JPY'), (150, 'USD'), (1234, 'KWD')):
+            PinTransfer.objects.create(amount=amount, currency=currency, transfer_token=currency)
+
+    def test_get_value(self):
+        """ Values follow the exponent of each currency """
+        self.assertEqual(SINGLE_UNIT_CURRENCIES, ('JPY',))
+        self.assertEqual(get_value(1000, 'AUD'), Decimal('10.00'))
+        self.assertEqual(get_value(1000, 'JPY'), Decimal('1000'))
+        with override_settings(PIN_CURRENCY_EXPONENTS={'KWD': 3}):
+            self.assertEqual(get_value(1234, 'KWD'), Decimal('1.234'))
+
+    @override_settings(PIN_CURRENCY_EXPONENTS={'KWD': 3})
+    def test_transfer_display_value(self):
+        """ The database computes the same values as PinTransfer.value """
+        transfers = PinTransfer.objects.with_display_value().order_by('display_value')
+        self.assertEqual(
+            [(transfer.currency, transfer.display_value) for transfer in transfers],
+            [('KWD', Decimal('1.234')), ('USD', Decimal('1.50')), ('AUD', Decimal('50.00')),
+             ('JPY', Decimal('1000'))]
+        )
+        for transfer in transfers:
+            self.assertEqual(transfer.display_value, transfer.value)
+
+    def test_transaction_base_amount(self):
+        """ Charge amounts are converted to base units in the database """
+        for amount, currency in ((Decimal('10.50'), 'AUD'), (Decimal('1000'), 'JPY')):
+            PinTransaction.objects.create(
+                amount=amount, currency=currency, card_token='card_1', ip_address='127.0.0.1',
+                email_address='test@example.com'
+            )
+        self.assertEqual(
+            dict(PinTransaction.objects.with_base_amount().values_list('currency', 'base_amount')),
+            {'AUD': 1050, 'JPY': 1000}
+        )
+
+    def test_base_amount_rounding(self):
+        """ Values are rounded to the currency's decimal places, not truncated """
+        self.assertEqual(get_base_amount(19.99, 'AUD'), 1999)
+        self.assertEqual(get_base_amount(Decimal('19.99'), 'AUD'), 1999)
+        self.assertEqual(get_base_amount('19.995', 'AUD'), 2000)
+        self.assertEqual(get_base_amount(Decimal('19.994'), 'AUD'), 1999)
+        self.assertEqual(get_base_amount(Decimal('1000.5'), 'JPY'), 1001)
+
+    def test_unknown_currency(self):
+        """ Currencies missing from the registry have two decimal places """
+        self.assertEqual(get_value(1234, 'MYR'), Decimal('12.34'))
+        self.assertEqual(get_base_amount(Decimal('12.34'), 'MYR'), 1234)
+        transfer = PinTransfer.objects.with_display_value().get(currency='KWD')
+        self.assertEqual(transfer.display_value, Decimal('12.34'))
+        PinTransaction.objects.create(
+            amount=Decimal('12.34'), currency='MYR', card_token='card_1', ip_address='127.0.0.1',
+            email_address='test@example.com'
+        )
+        self.assertEqual(PinTransaction.objects.with_base_amount().get().base_amount, 1234)
+
+
+class ConcurrentMapTests(TestCase):
+    """ Test calling a function on many items in threads """
+    @patch('pinpayments.utils.connections')
+    def test_concurrent_map(self, mock_connections):
+        """ Every item is yielded once, worker connections closed once per thread """
+        results = list(concurrent_map(lambda item: 10 // item, range(20), max_workers=3))
+        self.assertEqual(sorted(item for item, result, error in results), list(range(20)))
+        self.assertEqual(
+            sorted((item, result) for item, result, error in results if error is None),
+            [(item, 10 // item) for item in range(1, 20)]
+        )
+        self.assertIsInstance([error for item, result, error in results if error][0], ZeroDivisionError)
+        self.assertEqual(mock_connections.close_all.call_count, 3)
@@ -0,0 +1,81 @@
+""" Signal test classes """
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+from pinpayments import signals
+from pinpayments.models import PinTransaction
+from pinpayments.tests.models import FakeResponse
+
+from django.test import TestCase
+from mock import Mock, patch
+
+CHARGE_RESPONSE = json.dumps({'response': {
+    'token': 'ch_1', 'success': True, 'total_fees': 42, 'status_message': 'Success!',
+    'card': {
+        'address_line1': None, 'address_line2': None, 'address_city': None, 'address_state': None,
+        'address_postcode': None, 'address_country': None, 'display_number': 'XXXX-0000', 'scheme': 'visa',
+    },
+}})
+
+
+class SignalTests(TestCase):
+    """ Test the signals sent while charging """
+    def setUp(self):
+        super(SignalTests, self).setUp()
+        self.transaction = PinTransaction.objects.create(
+            card_token='card_1', ip_address='127.0.0.1', amount=5, currency='AUD',
+            email_address='test@example.com', environment='test'
+        )
+        self.receiver = Mock()
+        self.failed_receiver = Mock()
+        signals.charge_succeeded.connect(self.receiver)
+        signals.charge_failed.connect(self.failed_receiver)
+        self.addCleanup(signals.charge_succeeded.disconnect, self.receiver)
+        self.addCleanup(signals.charge_failed.disconnect, self.failed_receiver)
+
+    @patch('requests.post')
+    def test_charge_succeeded(self, mock_request):
+        """ Receivers get the processed transaction, and their errors are logged, not raised """
+        mock_request.return_value = FakeResponse(200, CHARGE_RESPONSE)
+        self.receiver.side_effect = ValueError('receiver failed')
+        self.assertEqual(self.transaction.process_transaction(), 'Success!')
+        self.receiver.assert_called_once_with(
+            signal=signals.charge_succeeded, sender=PinTransaction, transaction=self.transaction
+        )
+        self.assertFalse(self.failed_receiver.called)
+
+    @patch('requests.post')
+    def test_pre_charge_stops_charge(self, mock_request):
+        """ A pre_charge receiver raising stops the charge """
+        def stop(**kwargs):
+            raise ValueError('Out of stock')
+        signals.pre_charge.connect(stop)
+        self.addCleanup(signals.pre_charge.disconnect, stop)
+        self.assertRaises(ValueError, self.transaction.process_transaction)
+        self.assertFalse(mock_request.called)
+        self.assertFalse(PinTransaction.objects.get(pk=self.transaction.pk).processed)
+
+    @patch('pinpayments.signals.transaction.on_commit')
+    @patch('requests.post')
+    def test_on_commit(self, mock_request, mock_on_commit):
+        """ With the on_commit dispatch mode, receivers run once the transaction commits """
+        mock_request.return_value = FakeResponse(200, CHARGE_RESPONSE)
+        with self.settings(PIN_SIGNAL_DISPATCH='on_commit'):
+            self.transaction.process_transaction()
+        self.assertFalse(self.receiver.called)
+        mock_on_commit.call_args[0][0]()
+        self.assertTrue(self.receiver.called)
+
+    @patch('pinpayments.signals._get_executor')
+    @patch('pinpayments.signals.transaction.on_commit', side_effect=lambda func: func())
+    @patch('requests.post')
+    def test_thread(self, mock_request, mock_on_commit, mock_executor):
+        """ With the thread dispatch mode, receivers are queued on the thread pool """
+        mock_request.return_value = FakeResponse(200, CHARGE_RESPONSE)
+        with self.settings(PIN_SIGNAL_DISPATCH='thread'):
+            self.transaction.process_transaction()
+        self.assertFalse(self.receiver.called)
+        submitted = mock_executor.return_value.submit.call_args[0]
+        self.assertEqual(submitted[:3], (signals._send_in_thread, signals.charge_succeeded, PinTransaction))
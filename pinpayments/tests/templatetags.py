@@ -14,6 +14,19 @@ ENV_OK = {
     },
 }
 
+ENV_TEST_AND_LIVE = {
+    'test': {
+        'key': 'pk_test',
+        'secret': 'secret1',
+        'host': 'test-api.pin.net.au',
+    },
+    'live': {
+        'key': 'pk_live',
+        'secret': 'secret2',
+        'host': 'api.pin.net.au',
+    },
+}
+
 ENV_MISSING_KEY = {
     'test': {
         'secret': 'secret1',
@@ -83,3 +96,11 @@ class TemplateTagsTests(TestCase):
         self.assertEqual(header['pin_environment'], 'staging')
         self.assertEqual(header['pin_public_key'], 'key1')
         self.assertEqual(header['pin_host'], 'test-api.pin.net.au')
+
+    @override_settings(PIN_ENVIRONMENTS=ENV_TEST_AND_LIVE, PIN_DEFAULT_ENVIRONMENT='live')
+    def test_pin_header_test_env_not_default(self):
+        """ Check 'test' means the test environment when another is the default """
+        header = pin_header(self.context, environment='test')
+        self.assertEqual(header['pin_public_key'], 'pk_test')
+        self.assertEqual(header['pin_host'], 'test-api.pin.net.au')
+        self.assertEqual(pin_header(self.context)['pin_public_key'], 'pk_live')
@@ -0,0 +1,10 @@
+"""
+URLs receiving notifications from Pin, eg url(r'^pin/', include('pinpayments.urls'))
+"""
+from django.conf.urls import url
+
+from pinpayments import views
+
+urlpatterns = [
+    url(r'^webhook/(?P<environment>[\w-]+)/(?P<secret>[\w-]+)/$', views.webhook, name='pinpayments_webhook'),
+]
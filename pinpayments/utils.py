@@ -1,61 +1,287 @@
 """
 Utility functions without objects
 """
-from decimal import Decimal
-from django import VERSION
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import ROUND_HALF_UP, Decimal
 from django.conf import settings
+from django.db import connections
+from django.db.models import Case, DecimalField, F, Value, When
 from pinpayments.exceptions import ConfigError
 
-CURRENCIES = (
-    "AUD",
-    "USD",
-    "NZD",
-    "SGD",
-    "EUR",
-    "GBP",
-    "CAD",
-    "HKD",
-    "JPY",
-)
+# Number of digits after the decimal point in each currency, that is
+# amounts in the base unit are divided by 10 ** exponent to get their value.
+# Extend or override this with the PIN_CURRENCY_EXPONENTS setting.
+CURRENCY_EXPONENTS = OrderedDict((
+    ("AUD", 2),
+    ("USD", 2),
+    ("NZD", 2),
+    ("SGD", 2),
+    ("EUR", 2),
+    ("GBP", 2),
+    ("CAD", 2),
+    ("HKD", 2),
+    ("JPY", 0),
+))
+
+
+# Exponent of currencies that are not in the registry, as most have two
+DEFAULT_CURRENCY_EXPONENT = 2
+
 
+CURRENCIES = tuple(CURRENCY_EXPONENTS)
 
-DECIMAL_CURRENCIES = (
-    "AUD",
-    "USD",
-    "NZD",
-    "SGD",
-    "EUR",
-    "GBP",
-    "CAD",
-    "HKD",
+
+DECIMAL_CURRENCIES = tuple(
+    currency for currency, exponent in CURRENCY_EXPONENTS.items() if exponent
 )
 
 
-SINGLE_UNIT_CURRENCIES = (
-    "JPY"
+SINGLE_UNIT_CURRENCIES = tuple(
+    currency for currency, exponent in CURRENCY_EXPONENTS.items() if not exponent
 )
 
 
+def get_currency_exponents():
+    """
+    Returns the exponent of each known currency, including those from the
+    PIN_CURRENCY_EXPONENTS setting
+    """
+    exponents = CURRENCY_EXPONENTS.copy()
+    exponents.update(getattr(settings, 'PIN_CURRENCY_EXPONENTS', {}))
+    return exponents
+
+
+def get_exponent(currency):
+    """
+    Returns the number of digits after the decimal point in currency,
+    DEFAULT_CURRENCY_EXPONENT for unknown currencies
+    """
+    return get_currency_exponents().get(currency, DEFAULT_CURRENCY_EXPONENT)
+
+
 def get_value(amount, currency):
     """
     Returns the value of the transfer in the representation of the
     currency it is in, without symbols
     That is, 1000 cents as 10.00, 1000 yen as 1000
     """
-    if currency in DECIMAL_CURRENCIES:
-        return Decimal(amount) / Decimal(100)
-    return Decimal(amount)
+    return Decimal(amount) / Decimal(10 ** get_exponent(currency))
 
 
-def get_user_model():
+def get_base_amount(value, currency):
+    """
+    Returns the amount in the base unit of the currency for a value,
+    the reverse of get_value()
+    That is, 10.00 dollars as 1000, 1000 yen as 1000
+    Values with more decimal places than the currency has are rounded
+    half up, rather than truncated
     """
-        Loads the User model class across different Django versions
+    exponent = get_exponent(currency)
+    # str() so floats like 19.99 aren't converted from their binary approximation
+    value = Decimal(str(value)).quantize(Decimal(1).scaleb(-exponent), rounding=ROUND_HALF_UP)
+    return int(value.scaleb(exponent))
+
+
+def _currencies_by_exponent():
+    """
+    Returns lists of the currencies whose exponent isn't
+    DEFAULT_CURRENCY_EXPONENT, by exponent
+    """
+    by_exponent = {}
+    for code, exponent in get_currency_exponents().items():
+        if exponent != DEFAULT_CURRENCY_EXPONENT:
+            by_exponent.setdefault(exponent, []).append(code)
+    return by_exponent
+
+
+def currency_value_expression(amount='amount', currency='currency'):
     """
-    VERSION_MINOR = VERSION[1]
-    if VERSION_MINOR >= 5:  # Django 1.5 and up recommends loading the User model class this way.
-        from django.contrib.auth import get_user_model as django_get_user_model
-        User = django_get_user_model()
-        return User
+    Returns an expression converting the base unit amount field to its
+    value in the currency field, like get_value() does but in the
+    database, eg for queryset.annotate() and order_by()
+    """
+    by_exponent = _currencies_by_exponent()
+    decimal_places = max([DEFAULT_CURRENCY_EXPONENT] + list(by_exponent))
+    output_field = DecimalField(max_digits=20 + decimal_places, decimal_places=decimal_places)
+
+    def scaled(exponent):
+        if not exponent:
+            return F(amount)
+        return F(amount) * Value(Decimal(1).scaleb(-exponent), output_field=output_field)
+
+    return Case(
+        *[
+            When(**{'{0}__in'.format(currency): codes, 'then': scaled(exponent)})
+            for exponent, codes in sorted(by_exponent.items())
+        ],
+        default=scaled(DEFAULT_CURRENCY_EXPONENT),
+        output_field=output_field
+    )
+
+
+def currency_base_amount_expression(value='amount', currency='currency'):
+    """
+    Returns an expression converting the value field to its amount in the
+    base unit of the currency field, like get_base_amount() does but in
+    the database
+    """
+    by_exponent = _currencies_by_exponent()
+    output_field = DecimalField(max_digits=30, decimal_places=0)
+
+    def scaled(exponent):
+        if not exponent:
+            return F(value)
+        return F(value) * Value(10 ** exponent)
+
+    return Case(
+        *[
+            When(**{'{0}__in'.format(currency): codes, 'then': scaled(exponent)})
+            for exponent, codes in sorted(by_exponent.items())
+        ],
+        default=scaled(DEFAULT_CURRENCY_EXPONENT),
+        output_field=output_field
+    )
 
-    from django.contrib.auth.models import User
-    return User
+
+def add_months(year, month, months):
+    """
+    Returns the (year, month) pair that lies the given number of months
+    after (or before, for negative values) the provided year and month
+    """
+    index = year * 12 + (month - 1) + months
+    return (index // 12, index % 12 + 1)
+
+
+def iterate_queryset(queryset, chunk_size=2000):
+    """
+    Streams a queryset without caching its results, fetching chunk_size
+    rows at a time where the Django version supports it
+    """
+    try:
+        return queryset.iterator(chunk_size=chunk_size)
+    except TypeError:  # Django < 2.0
+        return queryset.iterator()
+
+
+def update_by_pk(queryset, changes, chunk_size=100):
+    """
+    Sets different values on many rows with an UPDATE per chunk_size rows,
+    given a dict of {field name: value} dicts by primary key, like
+    bulk_update() in later Django versions. Returns the rows updated.
+    """
+    model = queryset.model
+    pks = list(changes)
+    updated = 0
+    for start in range(0, len(pks), chunk_size):
+        chunk = pks[start:start + chunk_size]
+        names = sorted(set(name for pk in chunk for name in changes[pk]))
+        updates = {}
+        for name in names:
+            field = model._meta.get_field(name)
+            updates[field.attname] = Case(
+                *[
+                    When(pk=pk, then=Value(changes[pk][name], output_field=field))
+                    for pk in chunk if name in changes[pk]
+                ],
+                default=F(field.attname),
+                output_field=field
+            )
+        updated += queryset.filter(pk__in=chunk).update(**updates)
+    return updated
+
+
+# Tells a concurrent_map() worker thread to stop
+_STOP = object()
+
+
+def concurrent_map(func, items, max_workers=4):
+    """
+    Calls func on each of items using a pool of max_workers threads,
+    yielding (item, result, exception) tuples in order of completion.
+    Items are pulled lazily, at most two per worker ahead of time, so
+    items can be a stream of any length.
+    With max_workers of 1 or less, everything runs in the calling thread.
+    """
+    if max_workers <= 1:
+        for item in items:
+            try:
+                result = func(item)
+            except Exception as error:
+                yield (item, None, error)
+            else:
+                yield (item, result, None)
+        return
+
+    tasks = queue.Queue()
+    results = queue.Queue()
+
+    def work():
+        try:
+            while True:
+                item = tasks.get()
+                if item is _STOP:
+                    return
+                try:
+                    results.put((item, func(item), None))
+                except Exception as error:
+                    results.put((item, None, error))
+        finally:
+            # Threads get their own database connections, close them once the thread is done
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        for _worker in range(max_workers):
+            executor.submit(work)
+        try:
+            pending = 0
+            for item in items:
+                tasks.put(item)
+                pending += 1
+                if pending >= max_workers * 2:
+                    yield results.get()
+                    pending -= 1
+            while pending:
+                yield results.get()
+                pending -= 1
+        finally:
+            for _worker in range(max_workers):
+                tasks.put(_STOP)
+
+
+def estimate_count(queryset):
+    """
+    Returns the database's estimate of the number of rows in the table of
+    an unfiltered queryset, without counting them, or None when there is
+    no estimate: for filtered querysets and databases other than
+    PostgreSQL and MySQL
+    """
+    if queryset.query.where or queryset.query.distinct:
+        return None
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = "SELECT reltuples FROM pg_class WHERE relname = %s"
+    elif connection.vendor == 'mysql':
+        sql = (
+            "SELECT table_rows FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = %s"
+        )
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+def get_user_model():
+    """
+        Loads the User model class, kept for code that used it before
+        django.contrib.auth.get_user_model() existed
+    """
+    from django.contrib.auth import get_user_model as django_get_user_model
+    return django_get_user_model()
@@ -0,0 +1,37 @@
+"""
+Views receiving notifications from Pin
+"""
+from __future__ import unicode_literals
+
+import hmac
+
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.utils.encoding import force_bytes
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from pinpayments.exceptions import ConfigError
+from pinpayments.models import PinEvent
+from pinpayments.objects import PinEnvironment
+
+
+@csrf_exempt
+@require_POST
+def webhook(request, environment, secret):
+    """
+    Stores an event Pin sent to the environment's webhook URL, which holds
+    the environment's 'webhook_secret', with a single insert, and returns.
+    The process_pin_events management command then applies the events.
+    """
+    try:
+        pin_env = PinEnvironment.get(environment)
+    except ConfigError:
+        raise Http404
+    if not pin_env.webhook_secret or not hmac.compare_digest(
+            force_bytes(secret), force_bytes(pin_env.webhook_secret)):
+        raise Http404
+    try:
+        PinEvent.objects.record(pin_env.name, request.body.decode('utf-8'))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid event")
+    return HttpResponse()
@@ -113,6 +113,7 @@ setup(
     long_description=LONG_DESCRIPTION,
     classifiers=[
         "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
         "Topic :: Software Development :: Libraries :: Python Modules",
         "Framework :: Django",
         "Environment :: Web Environment",
@@ -131,5 +132,6 @@ setup(
     package_data=find_package_data("pinpayments", only_in_packages=False),
     include_package_data=True,
     zip_safe=False,
-    install_requires=['setuptools', 'requests', 'django'],
+    python_requires='>=3.4',
+    install_requires=['setuptools', 'requests', 'django>=1.11'],
 )